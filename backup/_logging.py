@@ -17,33 +17,57 @@
 
 """Logging configuration.
 
-This module configures two logging handlers:
+This module configures three logging handlers:
 
     1.  A stream handler that writes to stdout and stderr;
-    2.  A memory handler that memorizes output for deferred writing to a
-        log file who's path is known at runtime.
+    2.  A memory handler that memorizes the output of the startup, up to
+        a number of records, for deferred writing to the first log file,
+        whose path is only known at runtime;
+    3.  A queue handler that hands records to a listener thread, which
+        writes them to the log files in batches. Threads logging, such
+        as the one reading the output of rsync, never wait for the disk,
+        unless the queue is full.
 
 The following class is defined:
     Logging
         Subclass for any class that could use a _logger attribute.
 
+Log files are MovableFileHandler or CompressedFileHandler instances.
+
 There are also the following module level functions:
-    add_file_handler():
-        This function is called when the destination directory is known,
-        which happens after parsing the configuration file and command
-        line arguments.
-    move_file_handler(dest):
-        This function is called when a backup is completed and the log file
-        can be added to the snapshot's directory.
+    attach(handler):
+        Send the records of the root and "rsync" loggers to handler,
+        through the queue. Called when the destination directory of a
+        host is known.
+    drain():
+        Wait until the queued records are handled. Called before moving
+        the log file to the snapshot's directory.
+    detach(handler):
+        Drain the queue and stop sending records to handler.
 """
 
 
+import atexit
+import collections
+import gzip
 import io
 import logging
 import logging.handlers
+import lzma
 import os.path
+import queue
 import shutil
 import sys
+import threading
+
+
+LOGFILE = "backup.log"
+
+# Suffix of the log file by log_compression.
+LOG_SUFFIXES = {'': "", 'gzip': ".gz", 'xz': ".xz"}
+
+# Every name the log file of a snapshot may have.
+LOGFILES = tuple(LOGFILE + suffix for suffix in LOG_SUFFIXES.values())
 
 
 class Logging:
@@ -66,33 +90,168 @@ class ManualFlushMemoryHandler(logging.handlers.MemoryHandler):
     """Buffer records in memory, flush them to a target handler.
 
     Contrary to its base MemoryHandler class, flushing does not occur
-    automatically. When the flush method is called by the program, it
-    does not empty the buffer.
+    automatically, and reaching capacity does not flush: the oldest
+    records are dropped instead, so memory stays bounded however much is
+    logged before a target exists. A capacity of 0 means no limit. When
+    the flush method is called by the program, the records are handed
+    to the target, preceded by a count of the records dropped, and the
+    buffer is emptied.
     """
 
+    def __init__(self, capacity, *args, **kwargs):
+        super().__init__(capacity, *args, **kwargs)
+        self.buffer = collections.deque(maxlen=capacity or None)
+        self.dropped = 0
+
     def shouldFlush(self, record):
         return False
 
+    def emit(self, record):
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+        super().emit(record)
+
     def flush(self):
         self.acquire()
         try:
             if self.target:
+                if self.dropped:
+                    self.target.handle(logging.makeLogRecord({
+                        'name': __name__,
+                        'levelno': logging.WARNING,
+                        'levelname': "WARNING",
+                        'msg': "{} earlier records were dropped.".format(
+                            self.dropped,
+                            ),
+                        }))
                 for record in self.buffer:
                     self.target.handle(record)
-                # Don't empty the buffer.
+                self.buffer.clear()
+                self.dropped = 0
         finally:
             self.release()
 
     def close(self):
         # Overridden because the superclass automaticly flushes the buffer
         # before closing.
-        self.buffer = []
+        self.buffer.clear()
         super().close()
 
 
+class BlockingQueueHandler(logging.handlers.QueueHandler):
+
+    """A QueueHandler that waits when its queue is full.
+
+    The base class drops records, with an error, when the queue is full.
+    """
+
+    def enqueue(self, record):
+        self.queue.put(record)
+
+
+class BatchQueueListener:
+
+    """Hands the records of a queue to handlers, in batches, from a thread.
+
+    Like logging.handlers.QueueListener, but up to batch_size records
+    already in the queue are taken at once. Handlers with a
+    handle_batch() method get them in a single call.
+    """
+
+    batch_size = 256
+
+    _stop = object()  # Put in the queue by stop().
+
+    def __init__(self, queue, *handlers, respect_handler_level=False):
+        """
+        queue -- The queue of a BlockingQueueHandler.
+        handlers -- The handlers of the records.
+        respect_handler_level -- If True, a handler only gets the records
+            at or above its level.
+        """
+        self.queue = queue
+        self.handlers = handlers
+        self.respect_handler_level = respect_handler_level
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._monitor,
+            name="BatchQueueListener",
+            daemon=True,
+            )
+        self._thread.start()
+
+    def stop(self):
+        """Handle the records already queued, then stop the thread."""
+        self.queue.put(self._stop)
+        self._thread.join()
+        self._thread = None
+
+    def _monitor(self):
+        q = self.queue
+        while True:
+            batch = [q.get()]
+            while batch[-1] is not self._stop and \
+                    len(batch) < self.batch_size:
+                try:
+                    batch.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            stop = batch[-1] is self._stop
+            records = [record for record in batch if record is not self._stop]
+            try:
+                self.handle_batch(records)
+            finally:
+                for record in batch:
+                    q.task_done()
+            if stop:
+                break
+
+    def handle_batch(self, records):
+        for handler in self.handlers:
+            if self.respect_handler_level:
+                wanted = [r for r in records if r.levelno >= handler.level]
+            else:
+                wanted = records
+            if hasattr(handler, "handle_batch"):
+                handler.handle_batch(wanted)
+            else:
+                for record in wanted:
+                    handler.handle(record)
+
+
 class MovableFileHandler(logging.FileHandler):
 
-    """A FileHandler with a move_to() method."""
+    """A FileHandler with a move_to() method.
+
+    Records given to handle_batch() are written with a single flush of
+    the stream.
+    """
+
+    _batching = False
+
+    def flush(self):
+        if not self._batching:
+            super().flush()
+
+    def handle_batch(self, records):
+        """Handle records, flushing the stream once at the end."""
+        self.acquire()
+        try:
+            self._batching = True
+            try:
+                for record in records:
+                    self.handle(record)
+            finally:
+                self._batching = False
+            self.flush()
+        finally:
+            self.release()
 
     def move_to(self, path):
         """Move the log file to the specified directory."""
@@ -111,6 +270,37 @@ class MovableFileHandler(logging.FileHandler):
             self.release()
 
 
+class CompressedFileHandler(MovableFileHandler):
+
+    """A MovableFileHandler writing a gzip or xz compressed stream.
+
+    Opening the file again, after move_to() or in a later run, appends a
+    new member to it; gzip and xz readers read the members as one file.
+    The gzip stream is flushed with each batch of records, so the file is
+    readable up to the last batch if the program is killed. The xz
+    stream compresses better, but only its completed members are
+    readable.
+    """
+
+    _openers = {'gzip': gzip.open, 'xz': lzma.open}
+
+    def __init__(self, filename, compression="gzip", **kwargs):
+        """
+        filename -- The path of the file, including its suffix.
+        compression -- "gzip" or "xz".
+        """
+        self.compression = compression
+        super().__init__(filename, encoding="utf-8", **kwargs)
+
+    def _open(self):
+        return self._openers[self.compression](
+            self.baseFilename,
+            "at",
+            encoding=self.encoding,
+            errors=self.errors,
+            )
+
+
 formatters = {
     'stream': logging.Formatter("%(name)s %(levelname)s: %(message)s"),
     'file': logging.Formatter(
@@ -125,9 +315,58 @@ handlers = {
     # A FileHandler will be created by the engine.Controller class. However,
     # it's file location is only known a runtime. This handler will hold
     # log record that will be written to the file when it is created.
-    'memory': ManualFlushMemoryHandler(0),
+    'memory': ManualFlushMemoryHandler(10000),
     }
 handlers['stream'].setFormatter(formatters['stream'])
 handlers['stream'].setLevel(logging.WARNING)
 handlers['memory'].setFormatter(formatters['file'])
 handlers['memory'].setLevel(logging.DEBUG)
+handlers['queue'] = BlockingQueueHandler(queue.Queue(10000))
+handlers['queue'].setLevel(logging.DEBUG)
+
+
+_listener = BatchQueueListener(
+    handlers['queue'].queue,
+    respect_handler_level=True,
+    )
+
+
+def attach(handler):
+    """Send the records of the root and "rsync" loggers to handler.
+
+    Records go through the queue and are handled by the listener thread,
+    started with the first handler.
+    """
+    if not _listener.running:
+        logging.getLogger().addHandler(handlers['queue'])
+        logging.getLogger("rsync").addHandler(handlers['queue'])
+        _listener.start()
+    _listener.handlers += (handler,)
+
+
+def drain():
+    """Wait until every record queued so far is handled."""
+    if _listener.running:
+        handlers['queue'].queue.join()
+
+
+def detach(handler):
+    """Drain the queue, then stop sending records to handler.
+
+    The listener thread stops with the last handler.
+    """
+    drain()
+    _listener.handlers = tuple(
+        h for h in _listener.handlers if h is not handler
+        )
+    if not _listener.handlers and _listener.running:
+        logging.getLogger().removeHandler(handlers['queue'])
+        logging.getLogger("rsync").removeHandler(handlers['queue'])
+        _listener.stop()
+
+
+@atexit.register
+def _shutdown():
+    # Registered after logging's own, so it runs before logging.shutdown().
+    for handler in _listener.handlers:
+        detach(handler)
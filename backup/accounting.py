@@ -0,0 +1,260 @@
+#   Alexandre's backup script
+#   Copyright © 2014  Alexandre A. de Verteuil
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""This module provides space accounting for hard-linked snapshots.
+
+Classes:
+    SpaceIndex
+        Maps the inodes of a host's snapshots to the snapshots that
+        reference them.
+
+Functions:
+    format_size(n)
+        Format a number of bytes the way du -h would.
+    parse_size(s)
+        Parse a number of bytes with an optional K, M, G or T suffix.
+"""
+
+
+import os
+import os.path
+import sqlite3
+import time
+
+from . import _logging
+
+
+def format_size(n):
+    """Format a number of bytes the way du -h would."""
+    for unit in ("B", "K", "M", "G", "T"):
+        if n < 1024 or unit == "T":
+            break
+        n /= 1024
+    if unit == "B":
+        return "{}{}".format(int(n), unit)
+    return "{:.1f}{}".format(n, unit)
+
+
+def parse_size(s):
+    """Parse a number of bytes with an optional K, M, G or T suffix.
+
+    Suffixes are powers of 1024 and are case insensitive.
+    """
+    s = s.strip().upper()
+    for exponent, unit in enumerate(("K", "M", "G", "T"), start=1):
+        if s.endswith(unit):
+            return int(float(s[:-1]) * 1024**exponent)
+    return int(s)
+
+
+class SpaceIndex(_logging.Logging):
+
+    """Maps the inodes of a host's snapshots to the snapshots using them.
+
+    The index is an SQLite database stored in "<hostdir>/.space.db".
+    Snapshots are identified by their timestamp string, which does not
+    change when a snapshot moves from the hourly to the daily cycle.
+
+    Adding a snapshot walks that snapshot only. Removing one only touches
+    the database. Sizes are allocated sizes (st_blocks * 512), i. e. what
+    the filesystem would actually get back.
+
+    Only links between snapshots of the same host are accounted for.
+    """
+
+    _schema = (
+        "CREATE TABLE IF NOT EXISTS inodes "
+        "(ino INTEGER PRIMARY KEY, size INTEGER NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS refs "
+        "(ino INTEGER NOT NULL, snapshot TEXT NOT NULL, "
+        "PRIMARY KEY (snapshot, ino)) WITHOUT ROWID",
+        "CREATE INDEX IF NOT EXISTS refs_ino ON refs (ino)",
+        "CREATE TABLE IF NOT EXISTS snapshots "
+        "(snapshot TEXT PRIMARY KEY, indexed REAL NOT NULL)",
+        )
+
+    def __init__(self, dir, **kwargs):
+        """
+        dir -- The host directory, where snapshots are located.
+        """
+        super().__init__(**kwargs)
+        self.dir = dir
+        self.path = os.path.join(dir, ".space.db")
+        self._db = sqlite3.connect(self.path)
+        with self._db:
+            for statement in self._schema:
+                self._db.execute(statement)
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def snapshots(self):
+        """The set of timestamp strings of indexed snapshots."""
+        rows = self._db.execute("SELECT snapshot FROM snapshots")
+        return {row[0] for row in rows}
+
+    def add(self, name, path):
+        """Walk the tree at path and record its inodes under name."""
+        start_time = time.monotonic()
+        with self._db:
+            self._db.execute("DELETE FROM refs WHERE snapshot = ?", (name,))
+            count = 0
+            for batch in self._walk(path):
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO inodes (ino, size) VALUES (?, ?)",
+                    batch,
+                    )
+                self._db.executemany(
+                    "INSERT OR IGNORE INTO refs (ino, snapshot) VALUES (?, ?)",
+                    [(ino, name) for ino, size in batch],
+                    )
+                count += len(batch)
+            self._db.execute(
+                "INSERT OR REPLACE INTO snapshots VALUES (?, ?)",
+                (name, time.time()),
+                )
+        self._logger.debug(
+            "Indexed {} inodes of {} in {:.1f} seconds.".format(
+                count, path, time.monotonic() - start_time,
+                )
+            )
+
+    def _walk(self, path, batch_size=10000):
+        """Yield lists of (inode, size) tuples for the tree at path."""
+        batch = []
+        stack = [path]
+        while stack:
+            dir = stack.pop()
+            st = os.stat(dir, follow_symlinks=False)
+            batch.append((st.st_ino, st.st_blocks * 512))
+            with os.scandir(dir) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                        continue
+                    st = entry.stat(follow_symlinks=False)
+                    batch.append((st.st_ino, st.st_blocks * 512))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def remove(self, name):
+        """Forget the snapshot called name and the inodes only it used."""
+        with self._db:
+            self._db.execute("DELETE FROM refs WHERE snapshot = ?", (name,))
+            self._db.execute(
+                "DELETE FROM snapshots WHERE snapshot = ?",
+                (name,),
+                )
+            self._db.execute(
+                "DELETE FROM inodes WHERE NOT EXISTS "
+                "(SELECT 1 FROM refs WHERE refs.ino = inodes.ino)"
+                )
+
+    def sync(self, snapshots):
+        """Bring the index up to date with a list of Snapshot instances.
+
+        Snapshots not yet indexed are walked. Indexed snapshots that are
+        not in the list are removed from the index.
+        """
+        indexed = self.snapshots
+        current = {s.stimestamp: s for s in snapshots}
+        for name in sorted(indexed - set(current)):
+            self._logger.debug("Unindexing {}.".format(name))
+            self.remove(name)
+        for name in sorted(set(current) - indexed):
+            self.add(name, current[name].path)
+
+    def usage(self):
+        """Return {name: (unique_bytes, shared_bytes)} for every snapshot.
+
+        Unique bytes are what deleting the snapshot alone would free.
+        """
+        rows = self._db.execute(
+            "SELECT refs.snapshot, "
+            "SUM(CASE WHEN counts.n = 1 THEN inodes.size ELSE 0 END), "
+            "SUM(CASE WHEN counts.n > 1 THEN inodes.size ELSE 0 END) "
+            "FROM refs "
+            "JOIN inodes ON inodes.ino = refs.ino "
+            "JOIN (SELECT ino, COUNT(*) AS n FROM refs GROUP BY ino) "
+            "AS counts "
+            "ON counts.ino = refs.ino "
+            "GROUP BY refs.snapshot"
+            )
+        return {name: (unique, shared) for name, unique, shared in rows}
+
+    def reclaimable(self, names):
+        """Return the number of bytes freed by deleting all named snapshots."""
+        names = list(names)
+        if not names:
+            return 0
+        marks = ", ".join("?" * len(names))
+        row = self._db.execute(
+            "SELECT SUM(size) FROM inodes WHERE ino IN "
+            "(SELECT ino FROM refs WHERE snapshot IN ({0})) "
+            "AND NOT EXISTS (SELECT 1 FROM refs AS other "
+            "WHERE other.ino = inodes.ino "
+            "AND other.snapshot NOT IN ({0}))".format(marks),
+            names + names,
+            ).fetchone()
+        return row[0] or 0
+
+    def report(self, cycles):
+        """Return a du-like report as a list of lines.
+
+        cycles -- A list of Cycle instances of the same host.
+        """
+        usage = self.usage()
+        names = [
+            os.path.basename(snapshot.path)
+            for cycle in cycles
+            for snapshot in cycle.snapshots
+            ]
+        width = max([len(name) for name in names] + [len("snapshot")])
+        line = "{:<{}}  {:>8}  {:>8}"
+        lines = [line.format("snapshot", width, "unique", "shared")]
+        for cycle in cycles:
+            names = []
+            for snapshot in cycle.snapshots:
+                name = snapshot.stimestamp
+                if name not in usage:
+                    continue
+                names.append(name)
+                unique, shared = usage[name]
+                lines.append(
+                    line.format(
+                        os.path.basename(snapshot.path), width,
+                        format_size(unique), format_size(shared),
+                        )
+                    )
+            if names:
+                lines.append(
+                    line.format(
+                        "{} cycle".format(cycle.interval), width,
+                        format_size(self.reclaimable(names)), "",
+                        )
+                    )
+        return lines
@@ -0,0 +1,338 @@
+#   Alexandre's backup script
+#   Copyright © 2014  Alexandre A. de Verteuil
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""This module provides the cold storage of old snapshots.
+
+Classes:
+    Pack
+        Reads a snapshot pack, one member at a time.
+    Archiver
+        Replaces the tree of old snapshots with a pack.
+"""
+
+
+import json
+import os
+import os.path
+import stat
+import struct
+import time
+import zlib
+
+from . import _logging
+from .accounting import format_size
+from .dry_run import if_not_dry_run
+from .snapshot import Snapshot, Status
+
+
+_MAGIC = b"BKPACK1\n"
+_FOOTER = struct.Struct("<QQ8s")  # Index offset, index length, magic.
+_FOOTER_MAGIC = b"BKPACKIX"
+_BLOCK = 1024 * 1024
+
+
+class Pack(_logging.Logging):
+
+    """Reads a snapshot pack, one member at a time.
+
+    A pack is one file holding a whole snapshot tree. It starts with a
+    magic string, followed by the contents of every regular file, each
+    compressed as a separate zlib stream. Files hard linked together are
+    stored once. The index of members comes last, itself compressed, and
+    is located by a fixed-size footer. Listing a pack reads the index
+    only; extracting a file reads the index and that file's stream.
+
+    Each member of the index is a dict with the keys path, type (one of
+    "dir", "file", "symlink", "special"), mode, uid, gid and mtime_ns, and
+    depending on the type, size, offset and length (of the compressed
+    stream), target or rdev.
+    """
+
+    def __init__(self, path, **kwargs):
+        """
+        path -- The path to the pack file.
+        """
+        super().__init__(**kwargs)
+        self.path = path
+        self._members = None
+
+    def __repr__(self):
+        return "{}({})".format(self.__class__.__name__, self.path)
+
+    @staticmethod
+    def find(path):
+        """Return (Pack, relpath) for a path in an archived snapshot.
+
+        Return (None, None) if no snapshot above path is archived.
+        """
+        relpath = ""
+        path = os.path.abspath(path)
+        while True:
+            packfile = os.path.join(path, Snapshot.packname)
+            if os.path.isfile(packfile):
+                return Pack(packfile), relpath
+            parent, name = os.path.split(path)
+            if parent == path:
+                return None, None
+            relpath = os.path.join(name, relpath) if relpath else name
+            path = parent
+
+    @property
+    def members(self):
+        """The index of the pack, a dict of member dicts by path."""
+        if self._members is None:
+            with open(self.path, "rb") as f:
+                f.seek(-_FOOTER.size, os.SEEK_END)
+                offset, length, magic = _FOOTER.unpack(f.read(_FOOTER.size))
+                if magic != _FOOTER_MAGIC:
+                    raise ValueError(
+                        "{} is incomplete or not a pack.".format(self.path)
+                        )
+                f.seek(offset)
+                index = json.loads(zlib.decompress(f.read(length)).decode())
+            self._members = {member['path']: member for member in index}
+        return self._members
+
+    def list(self, prefix=""):
+        """Return the members at or below prefix, in tree order."""
+        prefix = prefix.strip("/")
+        return [
+            member for path, member in sorted(self.members.items())
+            if not prefix or
+            path == prefix or
+            path.startswith(prefix + "/")
+            ]
+
+    def read(self, path):
+        """Yield the contents of a file member in blocks."""
+        member = self.members[path]
+        decompressor = zlib.decompressobj()
+        with open(self.path, "rb") as f:
+            f.seek(member['offset'])
+            remaining = member['length']
+            while remaining:
+                data = f.read(min(remaining, _BLOCK))
+                if not data:
+                    raise ValueError("{} is truncated.".format(self.path))
+                remaining -= len(data)
+                yield decompressor.decompress(data)
+        yield decompressor.flush()
+
+    def extract(self, relpath, target):
+        """Extract the member at relpath, and below, to target.
+
+        target must not exist. Return the number of members extracted.
+        """
+        members = self.list(relpath)
+        if not members:
+            raise FileNotFoundError(
+                "{} is not in {}.".format(relpath, self.path)
+                )
+        root = relpath.strip("/")
+        if not root:
+            os.mkdir(target)  # The root of the snapshot is not a member.
+        for member in members:
+            path = member['path']
+            dest = os.path.join(target, os.path.relpath(path, root or "."))
+            self._extract_member(member, os.path.normpath(dest))
+        # Directory times last, since creating entries changes them.
+        for member in reversed(members):
+            if member['type'] == "dir":
+                dest = os.path.join(
+                    target,
+                    os.path.relpath(member['path'], root or "."),
+                    )
+                os.utime(
+                    os.path.normpath(dest),
+                    ns=(member['mtime_ns'], member['mtime_ns']),
+                    )
+        return len(members)
+
+    def _extract_member(self, member, dest):
+        kind = member['type']
+        if kind == "dir":
+            os.makedirs(dest, exist_ok=True)
+        elif kind == "file":
+            with open(dest, "xb") as f:
+                for data in self.read(member['path']):
+                    f.write(data)
+        elif kind == "symlink":
+            os.symlink(member['target'], dest)
+            self._chown(dest, member)
+            return  # Permissions and times of links are not restored.
+        else:
+            os.mknod(dest, member['mode'], member['rdev'])
+        self._chown(dest, member)
+        os.chmod(dest, stat.S_IMODE(member['mode']))
+        if kind != "dir":
+            os.utime(dest, ns=(member['mtime_ns'], member['mtime_ns']))
+
+    def _chown(self, dest, member):
+        try:
+            os.chown(
+                dest, member['uid'], member['gid'], follow_symlinks=False,
+                )
+        except PermissionError:
+            pass
+
+
+class Archiver(_logging.Logging):
+
+    """Replaces the tree of old snapshots with a pack.
+
+    Old daily snapshots are seldom read, but each one holds a whole tree
+    of inodes that every walk of the destination goes through. Archiving
+    a snapshot writes its tree into a single Pack, at Snapshot.packname
+    inside the snapshot directory, then removes the tree. Only the pack
+    and backup.log remain. The snapshot's status becomes archived.
+
+    The pack is written under a temporary name and renamed when complete,
+    so an interrupted archiving leaves a complete snapshot.
+
+    Files hard linked to other snapshots are copied into the pack, so
+    archiving only frees space once the snapshots sharing them are
+    archived or deleted too.
+    """
+
+    _keep = frozenset(_logging.LOGFILES + (Snapshot.packname,))
+    _skip = _keep | {Snapshot.packname + ".tmp"}
+
+    def __init__(self, level=6, **kwargs):
+        """
+        level -- The zlib compression level.
+        """
+        super().__init__(**kwargs)
+        self.level = level
+
+    def archive(self, snapshot):
+        """Pack the tree of a complete snapshot and remove it.
+
+        An archived snapshot whose tree was not completely removed, by an
+        interrupted run, has the rest removed.
+        """
+        if snapshot.status is Status.archived:
+            if set(snapshot.fs.listdir(snapshot.path)) - self._keep:
+                self._logger.info(
+                    "Removing the rest of the tree of {}.".format(
+                        snapshot.path,
+                        )
+                    )
+                self._remove_tree(snapshot)
+            return
+        if snapshot.status is not Status.complete or snapshot.is_alias:
+            raise RuntimeError(
+                "{} is {}, must be a complete tree.".format(
+                    snapshot.path, snapshot.status.name,
+                    )
+                )
+        start_time = time.monotonic()
+        self._logger.info("Archiving {}.".format(snapshot.path))
+        size, length = self._pack(snapshot.path, snapshot.packfile)
+        self._remove_tree(snapshot)
+        snapshot.infer_status()
+        self._logger.info(
+            "Archived {} ({} in {}) in {:.0f} seconds.".format(
+                snapshot.path,
+                format_size(size),
+                format_size(length),
+                time.monotonic() - start_time,
+                )
+            )
+
+    @if_not_dry_run
+    def _pack(self, root, packfile):
+        """Write the tree at root to packfile. Return the sizes in and out."""
+        index = []
+        inodes = {}  # (st_dev, st_ino) to the first member with the inode.
+        size = 0
+        tmp = packfile + ".tmp"
+        with open(tmp, "wb") as out:
+            out.write(_MAGIC)
+            stack = [""]
+            while stack:
+                reldir = stack.pop()
+                with os.scandir(os.path.join(root, reldir)) as entries:
+                    entries = sorted(entries, key=lambda e: e.name)
+                for entry in entries:
+                    if not reldir and entry.name in self._skip:
+                        continue
+                    relpath = os.path.join(reldir, entry.name)
+                    st = entry.stat(follow_symlinks=False)
+                    member = {
+                        'path': relpath,
+                        'mode': st.st_mode,
+                        'uid': st.st_uid,
+                        'gid': st.st_gid,
+                        'mtime_ns': st.st_mtime_ns,
+                        }
+                    if stat.S_ISDIR(st.st_mode):
+                        member['type'] = "dir"
+                        stack.append(relpath)
+                    elif stat.S_ISLNK(st.st_mode):
+                        member['type'] = "symlink"
+                        member['target'] = os.readlink(entry.path)
+                    elif stat.S_ISREG(st.st_mode):
+                        member['type'] = "file"
+                        member['size'] = st.st_size
+                        key = (st.st_dev, st.st_ino)
+                        if key in inodes:
+                            first = inodes[key]
+                            member['offset'] = first['offset']
+                            member['length'] = first['length']
+                        else:
+                            member['offset'] = out.tell()
+                            member['length'] = self._write(entry.path, out)
+                            inodes[key] = member
+                            size += st.st_size
+                    else:
+                        member['type'] = "special"
+                        member['rdev'] = st.st_rdev
+                    index.append(member)
+            data = zlib.compress(json.dumps(index).encode(), self.level)
+            offset = out.tell()
+            out.write(data)
+            out.write(_FOOTER.pack(offset, len(data), _FOOTER_MAGIC))
+            length = out.tell()
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp, packfile)
+        return size, length
+
+    def _write(self, path, out):
+        """Compress the file at path to out. Return the compressed length."""
+        compressor = zlib.compressobj(self.level)
+        start = out.tell()
+        with open(path, "rb") as f:
+            while True:
+                data = f.read(_BLOCK)
+                if not data:
+                    break
+                out.write(compressor.compress(data))
+        out.write(compressor.flush())
+        return out.tell() - start
+
+    @if_not_dry_run
+    def _remove_tree(self, snapshot):
+        fs = snapshot.fs
+        for name in fs.listdir(snapshot.path):
+            if name in self._keep:
+                continue
+            path = os.path.join(snapshot.path, name)
+            if fs.isdir(path) and not fs.islink(path):
+                fs.rmtree(path)
+            else:
+                fs.remove(path)
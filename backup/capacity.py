@@ -0,0 +1,148 @@
+#   Alexandre's backup script
+#   Copyright © 2014  Alexandre A. de Verteuil
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""This module provides the CapacityPlanner class.
+
+CapacityPlanner
+    Deletes old snapshots until a destination has enough free space.
+"""
+
+
+import os
+import os.path
+
+from . import _logging
+from .accounting import SpaceIndex, format_size
+from .cycle import Cycle
+from .locking import LockError
+from .snapshot import Status
+
+
+class CapacityPlanner(_logging.Logging):
+
+    """Deletes old snapshots until a destination has enough free space.
+
+    Every host backed up to the same destination competes for its space,
+    so candidates are taken from all of them and from all their cycles.
+    The most recent complete snapshot of each host is never a candidate:
+    it is the next link-dest.
+
+    Candidates are deleted oldest first, except that when bytes are short
+    and a host has a space index (see accounting.SpaceIndex), snapshots
+    known to free no bytes are tried last. Free space is measured again
+    with os.statvfs() after each deletion.
+    """
+
+    intervals = ("hourly", "daily", "weekly")
+
+    def __init__(self, dest, hosts, min_free=0, min_free_inodes=0,
+                 fs=None, **kwargs):
+        """
+        dest -- The destination directory, holding one directory per host.
+        hosts -- Names of the hosts backed up to dest.
+        min_free -- Number of bytes that must be available.
+        min_free_inodes -- Number of inodes that must be available.
+        fs -- Passed on to the Cycle instances. Deletions must be
+            immediate, so it must not defer them to a trash, nor leave
+            btrfs to reclaim subvolumes in the background (see
+            BtrfsFilesystem's sync_deletes).
+        """
+        super().__init__(**kwargs)
+        self.dest = dest
+        self.hosts = hosts
+        self.min_free = min_free
+        self.min_free_inodes = min_free_inodes
+        self.fs = fs
+        self.deleted = []  # Paths of the snapshots deleted by free_space().
+
+    def shortage(self):
+        """Return the numbers of bytes and inodes missing, or zeros."""
+        st = os.statvfs(self.dest)
+        free = st.f_bavail * st.f_frsize
+        free_inodes = st.f_favail
+        return (
+            max(0, self.min_free - free),
+            max(0, self.min_free_inodes - free_inodes) if st.f_files else 0,
+            )
+
+    def candidates(self):
+        """Return the list of snapshots that may be deleted, in order."""
+        candidates = []
+        for host in self.hosts:
+            hostdir = os.path.join(self.dest, host)
+            if not os.access(hostdir, os.F_OK):
+                continue
+            snapshots = [
+                snapshot
+                for interval in self.intervals
+                for snapshot in Cycle(hostdir, interval, fs=self.fs).snapshots
+                if snapshot.status in (Status.complete, Status.archived)
+                ]
+            snapshots.sort(key=lambda s: s.timestamp)
+            useless = set()
+            if os.access(os.path.join(hostdir, ".space.db"), os.F_OK):
+                with SpaceIndex(hostdir) as index:
+                    usage = index.usage()
+                for snapshot in snapshots:
+                    if usage.get(snapshot.stimestamp, (None,))[0] == 0:
+                        useless.add(snapshot.path)
+            # Keep the most recent one.
+            for snapshot in snapshots[:-1]:
+                candidates.append((snapshot.path in useless, snapshot))
+        candidates.sort(key=lambda c: c[1].timestamp)
+        if self.shortage()[0]:
+            candidates.sort(key=lambda c: c[0])  # Stable sort.
+        return [snapshot for useless, snapshot in candidates]
+
+    def free_space(self):
+        """Delete candidates until there is no shortage.
+
+        Return True if enough space is available in the end.
+        """
+        missing_bytes, missing_inodes = self.shortage()
+        if not missing_bytes and not missing_inodes:
+            return True
+        self._logger.warning(
+            "{} is short of {} and {} inodes. Deleting old snapshots.".format(
+                self.dest, format_size(missing_bytes), missing_inodes,
+                )
+            )
+        for snapshot in self.candidates():
+            try:
+                with snapshot:
+                    snapshot.delete()
+            except LockError:
+                self._logger.info(
+                    "Not deleting {}, it is locked.".format(snapshot.path)
+                    )
+                continue
+            self.deleted.append(snapshot.path)
+            missing_bytes, missing_inodes = self.shortage()
+            if not missing_bytes and not missing_inodes:
+                self._logger.info(
+                    "Deleted {} snapshots to free space.".format(
+                        len(self.deleted)
+                        )
+                    )
+                return True
+        self._logger.error(
+            "Unable to free enough space on {}: still short of {} and {} "
+            "inodes.".format(
+                self.dest, format_size(missing_bytes), missing_inodes,
+                )
+            )
+        return False
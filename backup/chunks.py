@@ -0,0 +1,425 @@
+#   Alexandre's backup script
+#   Copyright © 2014  Alexandre A. de Verteuil
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""This module provides the ChunkStore class.
+
+ChunkStore
+    Stores files of old snapshots as content-defined chunks.
+
+Functions:
+    chunks(f)
+        Yield the content-defined chunks of a binary file object.
+"""
+
+
+import glob
+import hashlib
+import os
+import os.path
+import re
+import shutil
+import sqlite3
+import stat
+import time
+
+from . import _logging
+from .accounting import format_size
+from .archive import Pack
+from .largefiles import match
+from .locking import AlreadyLocked, Lockable
+from .snapshot import Snapshot
+
+
+MIN_CHUNK = 256 * 1024
+MAX_CHUNK = 4 * 1024 * 1024
+# A chunk ends after this 2-byte sequence, found with C speed by re.
+# On random data, one is found every 64 KiB, past MIN_CHUNK.
+_ANCHOR = re.compile(b"\x9e\x37")
+
+
+def chunks(f, min_size=MIN_CHUNK, max_size=MAX_CHUNK):
+    """Yield the content-defined chunks of a binary file object.
+
+    Boundaries depend on the contents around them only, so an edit in
+    the middle of a file leaves the chunks before and after it as they
+    were.
+    """
+    buffer = b""
+    start = 0
+    eof = False
+    while True:
+        if not eof and len(buffer) - start < max_size:
+            # Read ahead, so the buffer is copied once per read.
+            data = f.read(max_size * 4)
+            eof = not data
+            buffer = buffer[start:] + data
+            start = 0
+            continue
+        if start == len(buffer):
+            return
+        found = _ANCHOR.search(buffer, start + min_size, start + max_size)
+        if found is not None:
+            end = found.end()
+        else:
+            end = min(start + max_size, len(buffer))
+        yield buffer[start:end]
+        start = end
+
+
+class ChunkStore(_logging.Logging, Lockable):
+
+    """Stores files of old snapshots as content-defined chunks.
+
+    A large file that changes a little every hour costs a whole new copy
+    in every snapshot. The ChunkStore splits such files into chunks with
+    content-defined boundaries and keeps every distinct chunk once, in
+    "<dest>/.chunks", named after its BLAKE2b digest. An SQLite index of
+    the chunks, "<dest>/.chunks/index.db", saves a stat() per lookup.
+
+    In the snapshot, the file is replaced with a small recipe, called
+    "<name>.backup-recipe", which lists the file's metadata and chunks.
+    The relative paths of the recipes of a snapshot are listed in its
+    ".backup-recipes" manifest.
+
+    Only snapshots older than the most recent one are converted: rsync
+    needs real files to compare with. restore() puts files back together.
+
+    Chunks no longer referenced by any recipe are deleted by collect().
+    The store is locked while files are converted or garbage collected.
+    """
+
+    SUFFIX = ".backup-recipe"
+    MANIFEST = ".backup-recipes"
+    _header = "backup-recipe 1"
+
+    def __init__(self, dest, **kwargs):
+        """
+        dest -- The destination directory, holding one directory per host.
+        """
+        super().__init__(**kwargs)
+        self.dest = dest
+        self.path = os.path.join(dest, ".chunks")
+        self.lockfile = self.path + ".lock"
+        self._db = None
+
+    def __repr__(self):
+        return "{}({})".format(self.__class__.__name__, self.path)
+
+    @staticmethod
+    def find(path):
+        """Return the ChunkStore of the destination path belongs to."""
+        path = os.path.abspath(path)
+        while True:
+            if os.path.isdir(os.path.join(path, ".chunks")):
+                return ChunkStore(path)
+            parent = os.path.dirname(path)
+            if parent == path:
+                raise FileNotFoundError(
+                    "No chunk store above {}.".format(path)
+                    )
+            path = parent
+
+    def _open(self):
+        if self._db is None:
+            os.makedirs(self.path, exist_ok=True)
+            self._db = sqlite3.connect(os.path.join(self.path, "index.db"))
+            with self._db:
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS chunks "
+                    "(digest TEXT PRIMARY KEY, size INTEGER NOT NULL)"
+                    )
+        return self._db
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _chunk_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest)
+
+    def _put(self, data):
+        """Store a chunk unless it is known. Return its digest.
+
+        The index is trusted: collect() forgets a chunk before deleting
+        its file, never after.
+        """
+        digest = hashlib.blake2b(data, digest_size=32).hexdigest()
+        db = self._open()
+        row = db.execute(
+            "SELECT 1 FROM chunks WHERE digest = ?", (digest,)
+            ).fetchone()
+        if row is None:
+            path = self._chunk_path(digest)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path+".tmp", "wb") as f:
+                f.write(data)
+            os.replace(path+".tmp", path)
+            with db:
+                db.execute(
+                    "INSERT OR REPLACE INTO chunks VALUES (?, ?)",
+                    (digest, len(data)),
+                    )
+            self.stored += len(data)
+        return digest
+
+    def convert(self, snapshot_path, patterns):
+        """Replace the files matching patterns with recipes.
+
+        patterns -- Glob patterns as for largefiles.match().
+        Return the number of files converted, or None if the store is
+        locked by an other process.
+        """
+        try:
+            self.acquire(timeout=0)
+        except AlreadyLocked:
+            self._logger.info(
+                "{} is locked, not converting files of {}.".format(
+                    self.path, snapshot_path,
+                    )
+                )
+            return None
+        start_time = time.monotonic()
+        self.stored = 0
+        count = 0
+        size = 0
+        try:
+            manifest = open(os.path.join(snapshot_path, self.MANIFEST), "a")
+            with manifest:
+                stack = [""]
+                while stack:
+                    reldir = stack.pop()
+                    dir = os.path.join(snapshot_path, reldir)
+                    with os.scandir(dir) as entries:
+                        entries = list(entries)
+                    for entry in entries:
+                        relpath = os.path.join(reldir, entry.name)
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(relpath)
+                        elif (entry.is_file(follow_symlinks=False) and
+                              match(relpath, patterns) and
+                              not entry.name.endswith(self.SUFFIX)):
+                            size += self._convert_file(entry.path)
+                            # Listed before the file is gone, in case of
+                            # a crash.
+                            manifest.write(relpath + self.SUFFIX + "\n")
+                            manifest.flush()
+                            os.unlink(entry.path)
+                            count += 1
+        finally:
+            self.close()
+            self.release()
+        if count:
+            self._logger.info(
+                "Converted {} files ({}) of {} to recipes in {:.1f} "
+                "seconds, storing {} of new chunks.".format(
+                    count,
+                    format_size(size),
+                    snapshot_path,
+                    time.monotonic() - start_time,
+                    format_size(self.stored),
+                    )
+                )
+        return count
+
+    def _convert_file(self, path):
+        """Write the recipe of the file at path. Return its size."""
+        st = os.stat(path, follow_symlinks=False)
+        lines = [
+            self._header,
+            "{} {} {} {} {}".format(
+                st.st_size,
+                stat.S_IMODE(st.st_mode),
+                st.st_uid,
+                st.st_gid,
+                st.st_mtime_ns,
+                ),
+            ]
+        with open(path, "rb") as f:
+            for data in chunks(f):
+                lines.append("{} {}".format(self._put(data), len(data)))
+        recipe = path + self.SUFFIX
+        with open(recipe+".tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(recipe+".tmp", recipe)
+        os.utime(recipe, ns=(st.st_atime_ns, st.st_mtime_ns))
+        return st.st_size
+
+    def _read_recipe(self, path):
+        """Return ((size, mode, uid, gid, mtime_ns), [(digest, size), …])."""
+        with open(path) as f:
+            return self._parse_recipe(f.read(), path)
+
+    def _parse_recipe(self, text, path):
+        lines = text.splitlines()
+        if not lines or lines[0] != self._header:
+            raise ValueError("{} is not a recipe.".format(path))
+        metadata = tuple(int(field) for field in lines[1].split())
+        chunks = []
+        for line in lines[2:]:
+            digest, size = line.split()
+            chunks.append((digest, int(size)))
+        return metadata, chunks
+
+    def restore_file(self, recipe, target):
+        """Put the file described by recipe back together at target."""
+        (size, mode, uid, gid, mtime_ns), chunks = self._read_recipe(recipe)
+        with open(target, "xb") as f:
+            for digest, chunk_size in chunks:
+                with open(self._chunk_path(digest), "rb") as chunk:
+                    data = chunk.read()
+                if len(data) != chunk_size:
+                    raise ValueError(
+                        "Chunk {} of {} is corrupt.".format(digest, recipe)
+                        )
+                f.write(data)
+        if os.stat(target).st_size != size:
+            raise ValueError("{} is incomplete.".format(recipe))
+        try:
+            os.chown(target, uid, gid)
+        except PermissionError:
+            pass
+        os.chmod(target, mode)
+        os.utime(target, ns=(mtime_ns, mtime_ns))
+
+    def restore(self, source, target):
+        """Copy the tree at source to target, putting files back together.
+
+        source -- A snapshot or a path inside one.
+        target -- A path that does not exist yet.
+        """
+        if os.path.isdir(source):
+            shutil.copytree(
+                source,
+                target,
+                symlinks=True,
+                ignore=self._ignore,
+                copy_function=self._copy,
+                )
+        elif os.path.isfile(source + self.SUFFIX):
+            self.restore_file(source + self.SUFFIX, target)
+        else:
+            shutil.copy2(source, target)
+
+    def materialize(self, path):
+        """Put the chunked files of a copied tree back together in place."""
+        for dirpath, dirnames, filenames in os.walk(path):
+            for name in filenames:
+                if not name.endswith(self.SUFFIX):
+                    continue
+                recipe = os.path.join(dirpath, name)
+                if not os.path.lexists(recipe[:-len(self.SUFFIX)]):
+                    self.restore_file(recipe, recipe[:-len(self.SUFFIX)])
+                os.unlink(recipe)
+        try:
+            os.unlink(os.path.join(path, self.MANIFEST))
+        except FileNotFoundError:
+            pass
+
+    def _ignore(self, dir, names):
+        # Recipes are restored by _copy() under the name of their file.
+        return {self.MANIFEST} & set(names)
+
+    def _copy(self, source, target):
+        if source.endswith(self.SUFFIX):
+            if os.path.lexists(source[:-len(self.SUFFIX)]):
+                return  # Interrupted conversion, the file is still there.
+            self.restore_file(source, target[:-len(self.SUFFIX)])
+        else:
+            shutil.copy2(source, target)
+
+    def _referenced(self):
+        """Return the set of digests used by the recipes of dest."""
+        referenced = set()
+        seen = set()
+        for snapshot in glob.glob(os.path.join(self.dest, "*", "*.*")):
+            real = os.path.realpath(snapshot)
+            if real in seen or not os.path.isdir(real):
+                continue
+            seen.add(real)
+            packfile = os.path.join(real, Snapshot.packname)
+            if os.path.isfile(packfile):
+                referenced.update(self._referenced_in_pack(Pack(packfile)))
+                continue
+            try:
+                with open(os.path.join(real, self.MANIFEST)) as f:
+                    recipes = f.read().splitlines()
+            except FileNotFoundError:
+                continue
+            for relpath in recipes:
+                try:
+                    metadata, chunks = self._read_recipe(
+                        os.path.join(real, relpath)
+                        )
+                except FileNotFoundError:
+                    continue  # Restored or deleted by hand.
+                referenced.update(digest for digest, size in chunks)
+        return referenced
+
+    def _referenced_in_pack(self, pack):
+        """Return the set of digests used by the recipes of an archive."""
+        referenced = set()
+        if self.MANIFEST not in pack.members:
+            return referenced
+        manifest = b"".join(pack.read(self.MANIFEST)).decode()
+        for relpath in manifest.splitlines():
+            if relpath not in pack.members:
+                continue
+            text = b"".join(pack.read(relpath)).decode()
+            metadata, chunks = self._parse_recipe(text, relpath)
+            referenced.update(digest for digest, size in chunks)
+        return referenced
+
+    def collect(self):
+        """Delete the chunks no recipe uses. Return the bytes freed."""
+        if not os.path.isdir(self.path):
+            return 0
+        try:
+            self.acquire(timeout=0)
+        except AlreadyLocked:
+            self._logger.info(
+                "{} is locked, not collecting chunks.".format(self.path)
+                )
+            return 0
+        freed = 0
+        try:
+            referenced = self._referenced()
+            db = self._open()
+            for dir in glob.glob(os.path.join(self.path, "??")):
+                for name in os.listdir(dir):
+                    digest = name.split(".")[0]
+                    if digest in referenced:
+                        continue
+                    # Forget the chunk before deleting it: interrupted in
+                    # between, the next _put() writes it again.
+                    with db:
+                        db.execute(
+                            "DELETE FROM chunks WHERE digest = ?", (digest,)
+                            )
+                    path = os.path.join(dir, name)
+                    freed += os.stat(path).st_size
+                    os.unlink(path)
+        finally:
+            self.close()
+            self.release()
+        if freed:
+            self._logger.info(
+                "Deleted {} of unused chunks from {}.".format(
+                    format_size(freed), self.path,
+                    )
+                )
+        return freed
@@ -0,0 +1,137 @@
+#   Alexandre's backup script
+#   Copyright © 2014  Alexandre A. de Verteuil
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""This module provides the cloning engine.
+
+Classes:
+    TreeCloner
+        Replicates a directory tree as hard links with worker threads.
+"""
+
+
+import concurrent.futures
+import errno
+import os
+import os.path
+import threading
+import time
+
+from . import _logging
+
+
+class TreeCloner(_logging.Logging):
+
+    """Replicates a directory tree as hard links with worker threads.
+
+    Each task scans one directory of the source tree with os.scandir(),
+    creates its subdirectories in the destination tree, hard links
+    everything else (files, symbolic links, special files) and submits
+    one new task per subdirectory.
+
+    Entries that already exist in the destination are left alone, so an
+    interrupted clone may be resumed. Files at the filesystem's link
+    limit are skipped: rsync will copy them.
+
+    Directories are created with default permissions and times. rsync
+    sets them right afterwards.
+    """
+
+    def __init__(self, workers=1, **kwargs):
+        """
+        workers -- Maximum number of threads linking files concurrently.
+        """
+        super().__init__(**kwargs)
+        self.workers = max(1, workers)
+        self.count = 0  # Number of entries created by the last clone().
+
+    def clone(self, source, dest, exclude=()):
+        """Replicate the tree at source into the directory dest.
+
+        exclude -- Names of entries at the root of source not to clone.
+        """
+        start_time = time.monotonic()
+        self.count = 0
+        self._lock = threading.Lock()
+        self._pending = 0  # Number of directories not yet scanned.
+        self._done = threading.Event()
+        self._error = None
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            self._executor = executor
+            self._submit(source, dest, set(exclude))
+            self._done.wait()
+        del self._executor
+        if self._error is not None:
+            raise self._error
+        self._logger.info(
+            "Cloned {} entries from {} in {:.1f} seconds "
+            "with {} workers.".format(
+                self.count,
+                source,
+                time.monotonic() - start_time,
+                self.workers,
+                )
+            )
+
+    def _submit(self, source, dest, exclude=()):
+        with self._lock:
+            self._pending += 1
+        self._executor.submit(self._clone_dir, source, dest, exclude)
+
+    def _clone_dir(self, source, dest, exclude):
+        if self._done.is_set():
+            return  # An other worker failed. Leave the rest alone.
+        try:
+            count = 0
+            with os.scandir(source) as entries:
+                for entry in entries:
+                    if entry.name in exclude:
+                        continue
+                    target = os.path.join(dest, entry.name)
+                    if entry.is_dir(follow_symlinks=False):
+                        try:
+                            os.mkdir(target)
+                        except FileExistsError:
+                            pass
+                        else:
+                            count += 1
+                        self._submit(entry.path, target)
+                        continue
+                    try:
+                        os.link(entry.path, target, follow_symlinks=False)
+                    except FileExistsError:
+                        continue
+                    except OSError as err:
+                        if err.errno != errno.EMLINK:
+                            raise
+                        continue
+                    count += 1
+            self._finish(count)
+        except BaseException as err:
+            self._fail(err)
+
+    def _finish(self, count):
+        with self._lock:
+            self.count += count
+            self._pending -= 1
+            if self._pending == 0:
+                self._done.set()
+
+    def _fail(self, err):
+        with self._lock:
+            if self._error is None:
+                self._error = err
+        self._done.set()
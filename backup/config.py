@@ -81,6 +81,31 @@ DEFAULTS = {
     'bw_warn': "0",
     'bw_err': "0",
     'force': "False",
+    'delete_workers': "1",
+    'deferred_delete': "False",
+    'reap_rate': "0",
+    'ionice': "/usr/bin/ionice",
+    'space_index': "False",
+    'min_free': "0",
+    'min_free_inodes': "0",
+    'dedup': "False",
+    'detect_moves': "False",
+    'skip_unchanged': "False",
+    'preclone': "False",
+    'preclone_workers': "8",
+    'large_files': "",
+    'append_only': "",
+    'chunked': "",
+    'archive_after': "0",
+    'backend': "posix",
+    'btrfs': "/usr/bin/btrfs",
+    'rotate_links': "False",
+    'link_margin': "100",
+    'lock_timeout': "0",
+    'max_concurrent_syncs': "0",
+    'log_compression': "",
+    'event_log': "",
+    'prometheus_textfile': "",
     }
 
 
@@ -143,6 +168,32 @@ class Configuration(_logging.Logging):
             help="Disable any bw_err trigger.",
             action="store_true",
             )
+        parser.add_argument("--reap",
+            help=("Only remove the expired snapshots waiting in the trash "
+                  "of each destination, then exit."),
+            action="store_true",
+            )
+        parser.add_argument("--du",
+            help=("Only print how much space is unique to each snapshot "
+                  "and each cycle, then exit."),
+            action="store_true",
+            )
+        parser.add_argument("--restore",
+            help=("Only copy SOURCE, a snapshot or a path in one, to "
+                  "TARGET, putting chunked files back together, then exit."),
+            metavar=("SOURCE", "TARGET"),
+            nargs=2,
+            )
+        parser.add_argument("--list",
+            help=("Only list the files of PATH, a snapshot or a path in one, "
+                  "including archived snapshots, then exit."),
+            metavar="PATH",
+            )
+        parser.add_argument("--profile",
+            help=("Run each host under cProfile and write its profile to "
+                  "DIR."),
+            metavar="DIR",
+            )
         parser.add_argument("-e",
             metavar="EXECUTABLE",
             help=argparse.SUPPRESS,
@@ -251,3 +302,10 @@ class Configuration(_logging.Logging):
         if self.args.e is not None:
             self.config.defaults()['rsync'] = self.args.e
         self.config.defaults()['force'] = str(self.args.force)
+        self.config.defaults()['reap'] = str(self.args.reap)
+        self.config.defaults()['du'] = str(self.args.du)
+        restore = self.args.restore or ("", "")
+        self.config.defaults()['restore_from'] = restore[0]
+        self.config.defaults()['restore_to'] = restore[1]
+        self.config.defaults()['list_path'] = self.args.list or ""
+        self.config.defaults()['profile_dir'] = self.args.profile or ""
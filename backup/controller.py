@@ -18,6 +18,8 @@
 """Controller classes that supervise backup routines."""
 
 
+import contextlib
+import cProfile
 import datetime
 import logging
 import os.path
@@ -29,10 +31,24 @@ import traceback
 
 from . import *
 from . import _logging
+from . import events
+from . import prometheus
+from . import summary
+from . import timing
+from .accounting import SpaceIndex, parse_size
+from .archive import Archiver, Pack
+from .capacity import CapacityPlanner
+from .chunks import ChunkStore
 from .config import *
 from .cycle import Cycle
+from .dedup import Deduplicator
 from .dry_run import if_not_dry_run
 from .engine import rsyncWrapper
+from .filesystem import BtrfsFilesystem, PosixFilesystem
+from .links import LinkRotator
+from .locking import SyncSemaphore
+from .snapshot import Status
+from .trash import Trash
 from .version import __version__
 
 
@@ -60,6 +76,8 @@ class Controller(_logging.Logging):
     def __init__(self, config, **kwargs):
         super().__init__(**kwargs)
         self.config = config
+        # Statistics of the hosts processed, by host.
+        self.stats = {}
 
     def run(self):
         self._logger.info("{} {}".format(sys.argv[0], __version__))
@@ -70,25 +88,83 @@ class Controller(_logging.Logging):
             self._log_exception(*sys.exc_info())
             return 1
         # Stop buffering log records. There will be a FileHandler created for
-        # each host. All of them will have the content of the memory handler
-        # flushed to them.
+        # each host. The first one will have the content of the memory
+        # handler flushed to it.
         logging.getLogger().removeHandler(_logging.handlers['memory'])
         hosts = self.config.defaults()['hosts'].split(" ")
+        if self.config.defaults()['restore_from']:
+            try:
+                self._restore(
+                    self.config.defaults()['restore_from'],
+                    self.config.defaults()['restore_to'],
+                    )
+            except Exception:
+                self._log_exception(*sys.exc_info())
+                return 1
+            return 0
+        if self.config.defaults()['list_path']:
+            try:
+                self._list(self.config.defaults()['list_path'])
+            except Exception:
+                self._log_exception(*sys.exc_info())
+                return 1
+            return 0
+        if self.config['default'].getboolean('reap'):
+            try:
+                self._reap_trash(hosts, True)
+                self._collect_chunks(hosts, True)
+            except Exception:
+                self._log_exception(*sys.exc_info())
+                return 1
+            return 0
+        if self.config['default'].getboolean('du'):
+            try:
+                self._print_space_report(hosts)
+            except Exception:
+                self._log_exception(*sys.exc_info())
+                return 1
+            return 0
         self._logger.info("Hosts to back up: {}".format(", ".join(hosts)))
+        if self.config.defaults()['event_log']:
+            events.start(self.config.defaults()['event_log'])
+        events.emit("run_start", version=__version__, hosts=hosts)
         errors = []
         for host in hosts:
+            host_start = time.monotonic()
+            events.emit("host_start", host=host)
+            status = "error"
+            span = timing.span("host", host=host)
             try:
-                self._run_host(host)
+                with span:
+                    self._profile(host, self._run_host, host)
+                status = "ok"
             except ResourceUnavailableException as err:
+                status = "skipped"
                 self._logger.warning(err.args[0])
             except Exception:
                 errors.append(host)
                 self._log_exception(*sys.exc_info())
                 self._close_logfile()
             except KeyboardInterrupt:
+                status = "interrupted"
                 errors.append(host)
                 self._logger.error("Keyboard interrupt.")
                 break
+            finally:
+                self.stats.setdefault(host, {})['phases'] = span.durations()
+                self._end_host(host, status, time.monotonic() - host_start)
+        else:
+            # Not interrupted. Deferred deletions happen last.
+            try:
+                self._reap_trash(hosts)
+            except Exception:
+                errors.append("trash")
+                self._log_exception(*sys.exc_info())
+            try:
+                self._collect_chunks(hosts)
+            except Exception:
+                errors.append("chunks")
+                self._log_exception(*sys.exc_info())
         run_time = time.monotonic() - start_time
         self._logger.info(
             "Total run time: {} minutes, {} seconds.".format(
@@ -96,6 +172,9 @@ class Controller(_logging.Logging):
                 int(run_time % 60),
                 )
             )
+        events.emit("run_end", seconds=round(run_time, 3), errors=errors)
+        events.stop()
+        self._export_metrics()
         if errors:
             self._logger.error(
                 "Exiting with errors from {}.".format(", ".join(errors))
@@ -104,6 +183,103 @@ class Controller(_logging.Logging):
             self._logger.info("Exiting normally.")
         return 1 if errors else 0
 
+    def _end_host(self, host, status, seconds):
+        """Record the outcome of a host in the stats and the event log."""
+        stats = self.stats.setdefault(host, {})
+        stats['status'] = status
+        stats['seconds'] = seconds
+        events.emit(
+            "host_end",
+            host=host,
+            status=status,
+            seconds=round(seconds, 3),
+            bytes=stats.get('bytes', 0),
+            files=stats.get('files', 0),
+            rotated=stats.get('rotated', 0),
+            )
+        try:
+            self._write_summary(host, stats)
+        except Exception:
+            # Monitoring will notice the summary getting old.
+            self._log_exception(*sys.exc_info())
+        self._export_metrics()
+
+    @if_not_dry_run
+    def _write_summary(self, host, stats):
+        """Replace the summary file of host with its latest stats."""
+        hostdir = os.path.join(self.config[host]['dest'], host)
+        if not os.path.isdir(hostdir):
+            return
+        previous = summary.read(hostdir) or {}
+        now = time.time()
+        summary.write(hostdir, {
+            'host': host,
+            'status': stats['status'],
+            'last_attempt': now,
+            'last_success': (
+                now if stats['status'] == "ok"
+                else previous.get('last_success')
+                ),
+            'seconds': stats['seconds'],
+            'bytes': stats.get('bytes', 0),
+            'files': stats.get('files', 0),
+            'snapshot': stats.get('snapshot', previous.get('snapshot')),
+            'phases': stats.get('phases') or {},
+            'snapshots': (
+                stats.get('snapshots') or previous.get('snapshots') or {}
+                ),
+            'flagged': stats.get('flagged', previous.get('flagged')),
+            'purged': stats.get('purged', 0),
+            'deleted': stats.get('deleted', 0),
+            'rotated': stats.get('rotated', 0),
+            })
+
+    def _export_metrics(self):
+        """Write the metrics of every host to prometheus_textfile."""
+        path = self.config.defaults()['prometheus_textfile']
+        if not path:
+            return
+        try:
+            self._write_metrics(path)
+        except Exception:
+            self._log_exception(*sys.exc_info())
+
+    @if_not_dry_run
+    def _write_metrics(self, path):
+        summaries = []
+        for host in self.config.sections():
+            hostdir = os.path.join(self.config[host]['dest'], host)
+            data = summary.read(hostdir)
+            if data is not None:
+                summaries.append(data)
+        prometheus.write(path, summaries)
+
+    def _profile(self, host, func, *args):
+        """Call func with args, under cProfile if --profile was given.
+
+        The profile is written to "<host>.<time>.prof" in the directory
+        given, for pstats or snakeviz.
+        """
+        profile_dir = self.config.defaults()['profile_dir']
+        if not profile_dir:
+            return func(*args)
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(func, *args)
+        finally:
+            path = os.path.join(
+                profile_dir,
+                "{}.{}.prof".format(host, time.strftime("%Y-%m-%dT%H:%M:%S")),
+                )
+            try:
+                profiler.dump_stats(path)
+            except OSError:
+                self._log_exception(*sys.exc_info())
+            else:
+                self._logger.info(
+                    "Profile of {} written to {}.".format(host, path)
+                    )
+
     def _log_exception(self, errtype, errval, tb):
         self._logger.error(
             "{}{}".format(
@@ -122,24 +298,35 @@ class Controller(_logging.Logging):
         hourlies = int(thisconfig['hourlies'])
         dailies = int(thisconfig['dailies'])
         #weeklies = int(thisconfig['weeklies'])
+        fs = self._make_filesystem(thisconfig)
+        lock_timeout = float(thisconfig['lock_timeout'])
+        stats = self.stats[host] = {'bytes': 0, 'files': 0}
         # Do checks before anything tries to touch the filesystem.
-        self._host_sanity_checks(host)
-        self._open_logfile(dest)
+        with timing.span("sanity_checks"):
+            self._host_sanity_checks(host)
+        self._open_logfile(dest, thisconfig['log_compression'])
         self._logger.info("Processing {}.".format(host))
         self._logger.debug(
             "Configuration for {}:\n{}".format(
                 host, pprint.pformat(dict(thisconfig))
                 )
             )
+        with timing.span("free_space"):
+            self._ensure_free_space(host)
         # Setup Cycle instance(s).
         if hourlies > 0:
             self._logger.info("Starting hourly backup")
-            cycle = Cycle(dest, "hourly")
-            cycle.overflow_cycle = (Cycle(dest, "daily"), dailies)
+            with timing.span("cycles"):
+                cycle = Cycle(dest, "hourly", fs=fs, lock_timeout=lock_timeout)
+                cycle.overflow_cycle = (
+                    Cycle(dest, "daily", fs=fs, lock_timeout=lock_timeout),
+                    dailies,
+                    )
             keepies = hourlies
         else:
             # Sanity checks assures that hourlies + dailies > 0.
-            cycle = Cycle(dest, "daily")
+            with timing.span("cycles"):
+                cycle = Cycle(dest, "daily", fs=fs, lock_timeout=lock_timeout)
             keepies = dailies
             a_day = datetime.timedelta(days=1)
             now = datetime.datetime.now()
@@ -152,10 +339,50 @@ class Controller(_logging.Logging):
                 cycle = None
         if cycle:
             rsync = rsyncWrapper(thisconfig)
-            cycle.create_new_snapshot(rsync, thisconfig.getboolean('force'))
-            cycle.purge(keepies)
+            with timing.span("sync"), self._sync_slot(thisconfig):
+                try:
+                    cycle.create_new_snapshot(
+                        rsync, thisconfig.getboolean('force'),
+                        )
+                finally:
+                    stats['bytes'] = rsync.bytes_count
+                    stats['files'] = rsync.files_count
+                    stats['flagged'] = (
+                        len(cycle.snapshots) > 0 and
+                        cycle.snapshots[0].status is Status.flagged
+                        )
+            alias = cycle.snapshots[0].is_alias
+            stats['snapshot'] = cycle.snapshots[0].path
+            if thisconfig.getboolean('rotate_links') and not alias:
+                with timing.span("rotate_links"):
+                    stats['rotated'] = self._rotate_links(
+                        thisconfig, cycle.snapshots[0],
+                        ) or 0
+            if thisconfig.getboolean('dedup') and not alias:
+                with timing.span("dedup"):
+                    self._dedup(thisconfig, cycle.snapshots[0])
+            if thisconfig['chunked'] and not alias:
+                with timing.span("chunk"):
+                    self._chunk_previous(thisconfig, cycle)
+            with timing.span("purge"):
+                cycle.purge(keepies)
+            cycles = [cycle]
+            if cycle.overflow_cycle is not None:
+                cycles.append(cycle.overflow_cycle[0])
+            stats['purged'] = sum(c.purged for c in cycles)
+            stats['deleted'] = sum(c.deleted for c in cycles)
+            stats['snapshots'] = {c.interval: len(c.snapshots) for c in cycles}
+            if float(thisconfig['archive_after']) > 0:
+                with timing.span("archive"):
+                    self._archive_old(thisconfig, cycles)
+            if thisconfig.getboolean('space_index'):
+                with timing.span("space_index"):
+                    self._update_space_index(dest, cycles)
             self._logger.info("Finished hourly backup")
-            self._move_logfile(cycle.snapshots[0].path)
+            if not alias:
+                # Otherwise, the log file stays in the host directory and
+                # the next runs append to it until a new tree is made.
+                self._move_logfile(cycle.snapshots[0].path)
             run_time = time.monotonic() - start_time
             self._logger.info(
                 "Run time for {}: {} minutes, {} seconds.".format(
@@ -166,23 +393,300 @@ class Controller(_logging.Logging):
                 )
         self._close_logfile()
 
+    def _sync_slot(self, config):
+        """Return a context manager holding a sync slot of the destination.
+
+        See max_concurrent_syncs.
+        """
+        slots = int(config['max_concurrent_syncs'])
+        if slots <= 0:
+            return contextlib.nullcontext()
+        return SyncSemaphore(config['dest'], slots)
+
+    @if_not_dry_run
+    def _ensure_free_space(self, host):
+        """Delete old snapshots if the destination is running out of space.
+
+        Every host sharing this host's destination is considered.
+        """
+        config = self.config[host]
+        min_free = parse_size(config['min_free'])
+        min_free_inodes = int(config['min_free_inodes'])
+        if not min_free and not min_free_inodes:
+            return
+        dest = config['dest']
+        hosts = [
+            name for name in self.config.sections()
+            if self.config[name]['dest'] == dest
+            ]
+        planner = CapacityPlanner(
+            dest,
+            hosts,
+            min_free,
+            min_free_inodes,
+            fs=self._make_filesystem(config, free_space=True),
+            )
+        if any(planner.shortage()) and config.getboolean('deferred_delete'):
+            Trash(os.path.join(dest, ".trash")).reap(
+                workers=int(config['delete_workers']),
+                )
+        planner.free_space()
+
+    def _make_filesystem(self, config, free_space=False):
+        """Return the Filesystem instance to hand down to Cycles.
+
+        free_space -- If True, deletions must actually free space before
+            they return: they bypass the trash even with deferred_delete,
+            and wait for btrfs to reclaim deleted subvolumes.
+        """
+        if not free_space and config.getboolean('deferred_delete'):
+            trash = Trash(os.path.join(config['dest'], ".trash"))
+        else:
+            trash = None
+        if config['backend'] == "btrfs":
+            return BtrfsFilesystem(
+                btrfs=config['btrfs'],
+                sync_deletes=free_space,
+                delete_workers=int(config['delete_workers']),
+                trash=trash,
+                )
+        return PosixFilesystem(
+            delete_workers=int(config['delete_workers']),
+            trash=trash,
+            )
+
+    @if_not_dry_run
+    def _reap_trash(self, hosts, all=False):
+        """Empty the trash of each destination at idle I/O priority.
+
+        Only the destinations of hosts configured with deferred_delete
+        are considered, unless all is True.
+        """
+        dests = {}
+        for host in hosts:
+            config = self.config[host]
+            if all or config.getboolean('deferred_delete'):
+                dests.setdefault(config['dest'], config)
+        if not dests:
+            return
+        self._set_idle_io_priority()
+        for dest, config in sorted(dests.items()):
+            start_time = time.monotonic()
+            count = Trash(os.path.join(dest, ".trash")).reap(
+                workers=int(config['delete_workers']),
+                rate=float(config['reap_rate']),
+                )
+            if count:
+                self._logger.info(
+                    "Reaped {} inodes from the trash of {} in {:.0f} "
+                    "seconds.".format(count, dest, time.monotonic()-start_time)
+                    )
+
+    def _set_idle_io_priority(self):
+        """Put this process in the idle I/O scheduling class."""
+        args = [
+            self.config['default']['ionice'],
+            "-c", "3",
+            "-p", str(os.getpid()),
+            ]
+        try:
+            subprocess.check_call(args)
+        except (OSError, subprocess.CalledProcessError) as err:
+            self._logger.warning(
+                "Unable to set the idle I/O priority: {}.".format(err)
+                )
+
     @if_not_dry_run
-    def _open_logfile(self, path):
+    def _dedup(self, config, snapshot):
+        """Link the new files of snapshot to identical stored files.
+
+        Not with the btrfs backend: the next snapshot would keep the
+        links, and rsync --inplace would write through them.
+        """
+        if config['backend'] == "btrfs":
+            self._logger.debug("dedup has no effect with btrfs.")
+            return
+        if config.getboolean('rotate_links'):
+            link_max = LinkRotator(
+                config['dest'], int(config['link_margin']),
+                ).ceiling
+        else:
+            link_max = None
+        with snapshot, Deduplicator(config['dest'], link_max) as deduplicator:
+            deduplicator.dedup(snapshot)
+
+    @if_not_dry_run
+    def _rotate_links(self, config, snapshot):
+        """Give the files of snapshot near the link limit fresh copies.
+
+        Return the number of files rotated.
+        """
+        with snapshot:
+            return LinkRotator(
+                config['dest'], int(config['link_margin']),
+                ).rotate(snapshot.path)
+
+    @if_not_dry_run
+    def _chunk_previous(self, config, cycle):
+        """Convert the chunked files of the previous snapshot to recipes.
+
+        The most recent snapshot keeps its files: it is the next link-dest.
+        """
+        newest = cycle.snapshots[0].resolve().path
+        for snapshot in cycle.snapshots[1:]:
+            if snapshot.status is not Status.complete:
+                continue
+            snapshot = snapshot.resolve()
+            if snapshot.path == newest:
+                continue
+            break
+        else:
+            return
+        with snapshot:
+            converted = ChunkStore(config['dest']).convert(
+                snapshot.path,
+                config['chunked'].split(),
+                )
+        if converted and os.access(
+                os.path.join(snapshot.dir, ".space.db"), os.F_OK):
+            # The recipes are new inodes. Forget the snapshot, the next
+            # sync of the space index walks it again.
+            with SpaceIndex(snapshot.dir) as index:
+                index.remove(snapshot.stimestamp)
+
+    @if_not_dry_run
+    def _collect_chunks(self, hosts, all=False):
+        """Delete the chunks no longer used in each destination.
+
+        Only the destinations of hosts configured with chunked are
+        considered, unless all is True.
+        """
+        dests = set()
+        for host in hosts:
+            config = self.config[host]
+            if all or config['chunked']:
+                dests.add(config['dest'])
+        for dest in sorted(dests):
+            ChunkStore(dest).collect()
+
+    @if_not_dry_run
+    def _archive_old(self, config, cycles):
+        """Pack the snapshots older than archive_after days.
+
+        The most recent complete snapshot is never archived: it is the
+        next link-dest.
+        """
+        cutoff = datetime.datetime.now() - datetime.timedelta(
+            days=float(config['archive_after']),
+            )
+        linkdest = cycles[0].get_linkdest()
+        archiver = Archiver()
+        for cycle in cycles:
+            for snapshot in cycle.snapshots:
+                if (snapshot.status not in (Status.complete, Status.archived)
+                    or snapshot.is_alias
+                    or snapshot.timestamp is None
+                    or snapshot.timestamp > cutoff
+                    or linkdest is not None and
+                    snapshot.path == linkdest.path):
+                    continue
+                with snapshot:
+                    archiver.archive(snapshot)
+
+    @if_not_dry_run
+    def _restore(self, source, target):
+        """Copy source to target, putting chunked files back together.
+
+        source may be in an archived snapshot, then only the needed
+        members of its pack are read.
+        """
+        if os.path.lexists(target):
+            raise FileExistsError("{} already exists.".format(target))
+        try:
+            store = ChunkStore.find(source)
+        except FileNotFoundError:
+            store = ChunkStore(os.path.dirname(os.path.abspath(source)))
+        self._logger.info("Restoring {} to {}.".format(source, target))
+        pack, relpath = Pack.find(source)
+        if pack is None:
+            store.restore(source, target)
+        elif relpath and relpath + store.SUFFIX in pack.members:
+            pack.extract(relpath + store.SUFFIX, target + store.SUFFIX)
+            store.restore_file(target + store.SUFFIX, target)
+            os.unlink(target + store.SUFFIX)
+        else:
+            pack.extract(relpath, target)
+            if os.path.isdir(target):
+                store.materialize(target)
+
+    def _list(self, path):
+        """Print the entries at and below path, in a snapshot or a pack."""
+        pack, relpath = Pack.find(path)
+        if pack is not None:
+            for member in pack.list(relpath):
+                suffix = "/" if member['type'] == "dir" else ""
+                print(member['path'] + suffix)
+            return
+        root = os.path.abspath(path)
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for name in dirnames:
+                print(os.path.relpath(os.path.join(dirpath, name), root) + "/")
+            for name in sorted(filenames):
+                print(os.path.relpath(os.path.join(dirpath, name), root))
+
+    @if_not_dry_run
+    def _update_space_index(self, dest, cycles):
+        """Index new snapshots and forget the deleted ones."""
+        snapshots = [
+            snapshot
+            for cycle in cycles
+            for snapshot in cycle.snapshots
+            # Walking an alias would only count its target twice.
+            if snapshot.status is Status.complete and not snapshot.is_alias
+            ]
+        with SpaceIndex(dest) as index:
+            index.sync(snapshots)
+
+    def _print_space_report(self, hosts):
+        """Print unique and shared bytes per snapshot and per cycle."""
+        for host in hosts:
+            dest = os.path.join(self.config[host]['dest'], host)
+            if not os.access(dest, os.F_OK):
+                self._logger.warning("{} does not exist.".format(dest))
+                continue
+            cycles = [Cycle(dest, "hourly"), Cycle(dest, "daily")]
+            self._update_space_index(dest, cycles)
+            with SpaceIndex(dest) as index:
+                print(host)
+                for line in index.report(cycles):
+                    print("    " + line)
+
+    @if_not_dry_run
+    def _open_logfile(self, path, compression=""):
         """Create a log file handler and add it to the "rsync" logger.
 
-        All the logging done so far was buffered. Just after the handler is
-        created and before any further logging, we flush (actually, copy) the
-        buffered records to the file handler.
+        The logging done during startup was buffered. Just after the first
+        handler is created and before any further logging, the buffered
+        records are flushed to it. The handler of the previous host, if it
+        was left open, is closed, so records only go to this host's file.
         """
-        logfile = os.path.join(path, "backup.log")
-        handler = _logging.MovableFileHandler(logfile)
+        self._close_logfile()
+        logfile = os.path.join(
+            path,
+            _logging.LOGFILE + _logging.LOG_SUFFIXES[compression],
+            )
+        if compression:
+            handler = _logging.CompressedFileHandler(logfile, compression)
+        else:
+            handler = _logging.MovableFileHandler(logfile)
         handler.setFormatter(_logging.formatters['file'])
         handler.setLevel(logging.DEBUG)
         _logging.handlers['memory'].setTarget(handler)
         _logging.handlers['memory'].flush()
         _logging.handlers['memory'].setTarget(None)
-        logging.getLogger().addHandler(handler)
-        logging.getLogger("rsync").addHandler(handler)  # Does not propagate.
+        # Also gets the records of "rsync", which does not propagate.
+        _logging.attach(handler)
         _logging.handlers['file'] = handler
         self._logger.debug("Log file {} created.".format(logfile))
 
@@ -195,9 +699,11 @@ class Controller(_logging.Logging):
         called to close the file handler, and move the file to the snapshot
         directory.
         """
-        path = os.path.join(path, "backup.log")
-        self._logger.debug("Moving log file to {}.".format(path))
         handler = _logging.handlers['file']
+        path = os.path.join(path, os.path.basename(handler.baseFilename))
+        self._logger.debug("Moving log file to {}.".format(path))
+        # Write the records logged so far before moving the file.
+        _logging.drain()
         handler.move_to(path)
 
     @if_not_dry_run
@@ -208,8 +714,8 @@ class Controller(_logging.Logging):
         except KeyError:
             return
         self._logger.debug("Closing log file.")
-        logging.getLogger().removeHandler(handler)
-        logging.getLogger("rsync").removeHandler(handler)
+        # Records still queued are written before the file is closed.
+        _logging.detach(handler)
         handler.acquire()
         try:
             handler.close()
@@ -249,6 +755,16 @@ class Controller(_logging.Logging):
             raise FileNotFoundError(
                 "{} does not exist.".format(config['dest'])
                 )
+        if config['backend'] not in ("posix", "btrfs"):
+            raise ValueError(
+                "Unknown backend {} for {}.".format(config['backend'], host)
+                )
+        if config['log_compression'] not in _logging.LOG_SUFFIXES:
+            raise ValueError(
+                "Unknown log_compression {} for {}.".format(
+                    config['log_compression'], host,
+                    )
+                )
         if max(int(config['hourlies']), int(config['dailies'])) <= 0:
             raise RuntimeError(
                 "Please configure to keep at least 1 daily or hourly snapshot."
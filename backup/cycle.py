@@ -30,6 +30,8 @@ import subprocess
 
 from . import *
 from . import _logging
+from . import events
+from . import timing
 from .dry_run import if_not_dry_run
 from .locking import Lockable
 from .snapshot import *
@@ -45,10 +47,23 @@ DEFAULT_TIMEDELTA = TIMEDELTA['hourly']
 
 class Cycle(Lockable, _logging.Logging):
 
-    """Manages a group of Snapshots of the same interval."""
+    """Manages a group of Snapshots of the same interval.
 
-    def __init__(self, dir, interval, **kwargs):
+    Parameters:
+        dir -- Path to the directory where snapshots are located.
+        interval -- Name of the backup cycle (i. e. hourly, daily, etc.)
+        fs -- A filesystem.Filesystem instance. It is handed down to every
+            Snapshot this Cycle creates. Defaults to the real one.
+        lock_timeout -- The default timeout of acquire(), handed down the
+            same way. See Lockable.
+    """
+
+    def __init__(self, dir, interval, fs=None, lock_timeout=None, **kwargs):
         super().__init__(**kwargs)
+        if fs is not None:
+            self.fs = fs
+        if lock_timeout is not None:
+            self.lock_timeout = lock_timeout
         self.dir = dir
         self.interval = interval
         self.timedelta = TIMEDELTA.get(interval, DEFAULT_TIMEDELTA)
@@ -57,28 +72,40 @@ class Cycle(Lockable, _logging.Logging):
         self.path = os.path.join(dir)
         self.lockfile = os.path.join(dir, "."+interval+".lock")
         self.overflow_cycle = None
+        # Counts of the snapshots purged from this cycle, by purge(), and
+        # of those deleted.
+        self.purged = 0
+        self.deleted = 0
 
     def _build_snapshots_list(self):
         self._logger.debug("Building {} snapshots list.".format(self.interval))
-        dirs = sorted(glob.glob("{}/{}.*".format(self.dir, self.interval)))
+        dirs = sorted(self.fs.glob("{}/{}.*".format(self.dir, self.interval)))
         for dir in dirs:
             self._logger.debug("Inserting {}.".format(dir))
-            self.snapshots.insert(0, Snapshot.from_path(dir))
+            self.snapshots.insert(0, Snapshot.from_path(
+                dir, fs=self.fs, lock_timeout=self.lock_timeout,
+                ))
 
     def get_linkdest(self):
-        """Return the most recent complete Snapshot in its list, or None."""
+        """Return the most recent complete Snapshot in its list, or None.
+
+        Aliases are resolved: the Snapshot returned is always a tree.
+        """
         for snapshot in self.snapshots:
-            if snapshot.status is Status.complete and not snapshot.is_locked():
+            snapshot = snapshot.resolve()
+            if (snapshot.status is Status.complete and
+                not snapshot.is_locked(exclusive=True)):
                 return snapshot
         return None
 
     def delete(self, index):
         """Delete the snapshot at the specified index."""
-        with self.snapshots[index]:
-            self._logger(
+        with timing.span("delete"), self.snapshots[index]:
+            self._logger.info(
                 "Deleting snapshot {}.".format(self.snapshots[index].path)
                 )
             self.snapshots.pop(index).delete()
+        self.deleted += 1
 
     def purge(self, maxnumber):
         """Delete snapshots exceeding maxnumber of complete backups.
@@ -113,7 +140,7 @@ class Cycle(Lockable, _logging.Logging):
         for snapshot in self.snapshots:
             if complete_count >= maxnumber:
                 break
-            if snapshot.status is Status.complete:
+            if snapshot.status in (Status.complete, Status.archived):
                 complete_count += 1
             cutoff_index += 1
         if self.overflow_cycle is not None:
@@ -132,10 +159,12 @@ class Cycle(Lockable, _logging.Logging):
                     )
                 )
             for snapshot in self.snapshots[cutoff_index:]:
-                with snapshot:
+                with timing.span("delete"), snapshot:
                     snapshot.status = Status.deleting
                     snapshot.delete()
                     snapshot.status = Status.deleted
+                self.deleted += 1
+        self.purged += len(self.snapshots[cutoff_index:])
         del self.snapshots[cutoff_index:]
 
     def feed(self, snapshots):
@@ -148,7 +177,7 @@ class Cycle(Lockable, _logging.Logging):
                 #last_snapshot_time = self.snapshots[0].timestamp
                 #this_snapshot_time = snapshot.timestamp
                 #difference = this_snapshot_time - last_snapshot_time
-                if (snapshot.status is Status.complete and
+                if (snapshot.status in (Status.complete, Status.archived) and
                     len(self.snapshots) == 0 or
                     (
                      snapshot.timestamp - self.snapshots[0].timestamp >=
@@ -162,16 +191,20 @@ class Cycle(Lockable, _logging.Logging):
                     inserted = 1
                     break
         for snapshot in snapshots:
-            with snapshot:
+            with timing.span("delete"), snapshot:
                 snapshot.status = Status.deleting
                 snapshot.delete()
                 snapshot.status = Status.deleted
+            self.deleted += 1
 
     def create_new_snapshot(self, engine, force=False):
         """Use rsyncWrapper to make a new snapshot.
 
         engine -- rsyncWrapper instance
         force -- Ignore flagged status
+
+        If the engine finds that nothing changed since the last complete
+        snapshot, an alias of it is made instead of a new tree.
         """
         if (len(self.snapshots) > 0 and
             self.snapshots[0].status is Status.flagged and
@@ -190,53 +223,64 @@ class Cycle(Lockable, _logging.Logging):
             # Resume an aborted sync.
             snapshot = self.snapshots[0]
             msg = "Resuming snapshot {}.".format(snapshot.path)
+            kind = "resumed"
+        elif self._make_alias_if_unchanged(engine):
+            events.emit(
+                "snapshot", path=self.snapshots[0].path, kind="alias",
+                )
+            return
         else:
-            snapshot = Snapshot(self.dir, self.interval)
+            if self.fs.native_snapshots:
+                source = self.get_linkdest()
+            else:
+                source = None
+            snapshot = Snapshot(
+                self.dir,
+                self.interval,
+                fs=self.fs,
+                lock_timeout=self.lock_timeout,
+                )
             self.snapshots.insert(0, snapshot)
             msg = "Creating a new snapshot at {}.".format(snapshot.path)
-            with snapshot:
-                snapshot.mkdir()
+            kind = "new"
+            with timing.span("mkdir"), snapshot:
+                if source is not None:
+                    with source.shared():
+                        snapshot.mkdir(source)
+                else:
+                    snapshot.mkdir()
                 snapshot.status = Status.syncing
         self._logger.info(msg)
+        events.emit("snapshot", path=snapshot.path, kind=kind)
         with snapshot:
-            # Get a clean snapshot to hardlink unchanged files to.
-            linkdest = self.get_linkdest()
+            if self.fs.native_snapshots:
+                # The snapshot is a copy of the link-dest already, rsync
+                # updates it in place.
+                linkdest = None
+            else:
+                # Get a clean snapshot to hardlink unchanged files to.
+                with timing.span("linkdest"):
+                    linkdest = self.get_linkdest()
             try:
                 if linkdest is not None:
-                    linkdest.acquire()
+                    linkdest.acquire(shared=True)
                     linkdestpath = linkdest.path
                 else:
                     linkdestpath = None
-                engine.sync_to(snapshot.path, linkdestpath)
-                while True:
-                    try:
-                        returncode = engine.wait(0.1)
-                    except subprocess.TimeoutExpired:
-                        continue  # Subprocess not finished.
-                    else:
-                        break  # Subprocess exited.
-                    finally:
-                        if engine.kill_switch_event.is_set() and not force:
-                            # PipeLogger instance logged an error.
-                            try:
-                                engine.process.kill()
-                            except OSError:
-                                # Don't care if subprocess already exited.
-                                self._logger.info(
-                                    "rsync had time to finish anyways."
-                                    )
-                            finally:
-                                snapshot.status = Status.flagged
-                                raise FlaggedSnapshotError(
-                                    "Bandwidth safety kill switch triggered."
-                                    )
-                if returncode > 0:
-                    raise RuntimeError(
-                        "Engine returned {} ({}).".format(
-                            returncode,
-                            RSYNC_E_CODES.get(returncode, "unknown error"),
+                for part in engine.parts:
+                    with timing.span("rsync"):
+                        engine.sync_to(snapshot.path, linkdestpath, part)
+                        returncode = self._wait_for_engine(
+                            engine, snapshot, force,
+                            )
+                    engine.close_pipes()
+                    if returncode > 0:
+                        raise RuntimeError(
+                            "Engine returned {} ({}).".format(
+                                returncode,
+                                RSYNC_E_CODES.get(returncode, "unknown error"),
+                                )
                             )
-                        )
             except (KeyboardInterrupt, SystemExit):
                 # Signals SIGTERM, SIGKILL, SIGHUP are handled in the
                 # controller module. The handler raises SystemExit.
@@ -254,3 +298,69 @@ class Cycle(Lockable, _logging.Logging):
                     linkdest.release()
             snapshot.status = Status.complete
             snapshot.timestamp = datetime.datetime.now()
+
+    def _wait_for_engine(self, engine, snapshot, force):
+        """Wait for the engine's subprocess and return its exit code.
+
+        Kill it and flag the snapshot if the kill switch is triggered.
+        """
+        while True:
+            try:
+                returncode = engine.wait(0.1)
+            except subprocess.TimeoutExpired:
+                continue  # Subprocess not finished.
+            else:
+                return returncode  # Subprocess exited.
+            finally:
+                if engine.kill_switch_event.is_set() and not force:
+                    # PipeLogger instance logged an error.
+                    try:
+                        engine.process.kill()
+                    except OSError:
+                        # Don't care if subprocess already exited.
+                        self._logger.info(
+                            "rsync had time to finish anyways."
+                            )
+                    finally:
+                        snapshot.status = Status.flagged
+                        events.emit(
+                            "kill_switch",
+                            path=snapshot.path,
+                            bytes=engine.loggers['stdout'].bytes_count,
+                            )
+                        raise FlaggedSnapshotError(
+                            "Bandwidth safety kill switch triggered."
+                            )
+
+    def _make_alias_if_unchanged(self, engine):
+        """Make an alias of the link-dest if the source did not change.
+
+        Return True if the alias was made.
+        """
+        linkdest = self.get_linkdest()
+        if linkdest is None:
+            return False
+        with linkdest.shared():
+            with timing.span("is_unchanged"):
+                unchanged = engine.is_unchanged(linkdest.path)
+            if not unchanged:
+                return False
+            snapshot = Snapshot(
+                self.dir,
+                self.interval,
+                datetime.datetime.now(),
+                fs=self.fs,
+                lock_timeout=self.lock_timeout,
+                )
+            if snapshot.status is not Status.void:
+                return False  # Less than a minute since the last one.
+            with snapshot:
+                snapshot.make_alias(linkdest)
+        self.snapshots.insert(0, snapshot)
+        self._logger.info(
+            "Nothing changed since {}. Created the alias {}.".format(
+                linkdest.path,
+                snapshot.path,
+                )
+            )
+        return True
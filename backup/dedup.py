@@ -0,0 +1,252 @@
+#   Alexandre's backup script
+#   Copyright © 2014  Alexandre A. de Verteuil
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""This module provides the Deduplicator class.
+
+Deduplicator
+    Replaces files identical to already stored ones with hard links.
+"""
+
+
+import errno
+import glob
+import hashlib
+import os
+import os.path
+import sqlite3
+import stat
+import time
+
+from . import _logging
+from . import links
+from .accounting import format_size
+
+
+class Deduplicator(_logging.Logging):
+
+    """Replaces files identical to already stored ones with hard links.
+
+    rsync's --link-dest only links a file to the file at the same path in
+    the previous snapshot. Renamed files, copies and files common to
+    several hosts are stored again. The Deduplicator catches those after
+    the fact.
+
+    Only the inodes written by the last sync are hashed, i. e. regular
+    files with a link count of 1. Their digest is looked up in an SQLite
+    database, "<dest>/.dedup.db", shared by every host of a destination.
+    A file is only replaced with a link to a file with the same content,
+    size, permissions, owner and modification time, so no metadata is
+    lost. Files already at link_max links are not linked to: the new
+    file becomes the original of the next duplicates instead.
+
+    Files are recorded by host, snapshot timestamp and relative path, so
+    records survive a snapshot moving from one cycle to another. Records
+    of deleted snapshots are forgotten at the start of every run.
+    """
+
+    _schema = (
+        "CREATE TABLE IF NOT EXISTS files "
+        "(digest BLOB NOT NULL, size INTEGER NOT NULL, "
+        "mode INTEGER NOT NULL, uid INTEGER NOT NULL, gid INTEGER NOT NULL, "
+        "mtime INTEGER NOT NULL, host TEXT NOT NULL, "
+        "snapshot TEXT NOT NULL, relpath TEXT NOT NULL, "
+        "PRIMARY KEY (digest, size, mode, uid, gid, mtime)) WITHOUT ROWID",
+        "CREATE INDEX IF NOT EXISTS files_snapshot "
+        "ON files (host, snapshot)",
+        )
+
+    _blocksize = 1 << 20
+
+    def __init__(self, dest, link_max=None, **kwargs):
+        """
+        dest -- The destination directory, holding one directory per host.
+        link_max -- The maximum link count of a file. By default, it is
+            queried from the filesystem.
+        """
+        super().__init__(**kwargs)
+        self.dest = dest
+        self.path = os.path.join(dest, ".dedup.db")
+        if link_max is None:
+            link_max = links.link_max(dest)
+        self.link_max = link_max
+        self._db = sqlite3.connect(self.path, timeout=60)
+        with self._db:
+            for statement in self._schema:
+                self._db.execute(statement)
+        self._snapshot_paths = {}
+        # Statistics of the last run.
+        self.hashed = 0
+        self.linked = 0
+        self.saved = 0
+        self.rotated = 0  # Originals replaced because they were full.
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def prune(self):
+        """Forget the files of snapshots that do not exist anymore."""
+        rows = self._db.execute("SELECT DISTINCT host, snapshot FROM files")
+        with self._db:
+            for host, snapshot in rows.fetchall():
+                if self._find_snapshot(host, snapshot) is None:
+                    self._logger.debug(
+                        "Forgetting files of {} {}.".format(host, snapshot)
+                        )
+                    self._db.execute(
+                        "DELETE FROM files WHERE host = ? AND snapshot = ?",
+                        (host, snapshot),
+                        )
+
+    def _find_snapshot(self, host, snapshot):
+        """Return the path of a host's snapshot, whatever its cycle."""
+        key = (host, snapshot)
+        if key not in self._snapshot_paths:
+            paths = glob.glob(
+                os.path.join(glob.escape(self.dest), host, "*."+snapshot)
+                )
+            self._snapshot_paths[key] = paths[0] if paths else None
+        return self._snapshot_paths[key]
+
+    def dedup(self, snapshot):
+        """Link the new files of a complete Snapshot to known duplicates."""
+        start_time = time.monotonic()
+        self.hashed = self.linked = self.saved = self.rotated = 0
+        self._snapshot_paths.clear()
+        self.prune()
+        host = os.path.basename(snapshot.dir)
+        self._snapshot_paths[(host, snapshot.stimestamp)] = snapshot.path
+        self._dev = os.stat(snapshot.path).st_dev
+        stack = [""]
+        with self._db:
+            while stack:
+                reldir = stack.pop()
+                dir = os.path.join(snapshot.path, reldir)
+                st = os.stat(dir)
+                linked = self.linked
+                with os.scandir(dir) as entries:
+                    for entry in entries:
+                        relpath = os.path.join(reldir, entry.name)
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(relpath)
+                        elif entry.is_file(follow_symlinks=False):
+                            self._dedup_file(
+                                entry.path,
+                                entry.stat(follow_symlinks=False),
+                                host,
+                                snapshot.stimestamp,
+                                relpath,
+                                )
+                if self.linked > linked:
+                    # Replacing files touched the directory.
+                    os.utime(dir, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self._logger.info(
+            "Deduplicated {} of {} new files in {:.1f} seconds, "
+            "saving {}.".format(
+                self.linked,
+                self.hashed,
+                time.monotonic() - start_time,
+                format_size(self.saved),
+                )
+            )
+        if self.rotated:
+            self._logger.info(
+                "{} files became new originals, the previous ones being "
+                "at {} links.".format(self.rotated, self.link_max)
+                )
+
+    def _dedup_file(self, path, st, host, snapshot, relpath):
+        if st.st_nlink != 1:
+            return  # Linked by rsync, or already deduplicated.
+        self.hashed += 1
+        key = (
+            self._digest(path),
+            st.st_size,
+            stat.S_IMODE(st.st_mode),
+            st.st_uid,
+            st.st_gid,
+            st.st_mtime_ns,
+            )
+        row = self._db.execute(
+            "SELECT host, snapshot, relpath FROM files "
+            "WHERE digest = ? AND size = ? AND mode = ? AND uid = ? "
+            "AND gid = ? AND mtime = ?",
+            key,
+            ).fetchone()
+        if row is not None and self._link(row, path, st):
+            self.linked += 1
+            self.saved += st.st_blocks * 512
+            return
+        # Unknown, stale or full. This file is the new original.
+        self._db.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            key + (host, snapshot, relpath),
+            )
+
+    def _digest(self, path):
+        digest = hashlib.blake2b(digest_size=20)
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(self._blocksize), b""):
+                digest.update(block)
+        return digest.digest()
+
+    def _link(self, row, path, st):
+        """Replace the file at path with a link to the recorded original.
+
+        Return False if the original is gone, changed or full.
+        """
+        host, snapshot, relpath = row
+        snapshot_path = self._find_snapshot(host, snapshot)
+        if snapshot_path is None:
+            return False
+        original = os.path.join(snapshot_path, relpath)
+        try:
+            ost = os.stat(original, follow_symlinks=False)
+        except FileNotFoundError:
+            return False
+        if (not stat.S_ISREG(ost.st_mode) or
+            ost.st_dev != self._dev or
+            ost.st_size != st.st_size or
+            ost.st_mode != st.st_mode or
+            ost.st_uid != st.st_uid or
+            ost.st_gid != st.st_gid or
+            ost.st_mtime_ns != st.st_mtime_ns):
+            return False
+        if ost.st_nlink >= self.link_max:
+            self.rotated += 1
+            return False
+        tmp = os.path.join(
+            os.path.dirname(path),
+            ".{}.dedup".format(os.path.basename(path)),
+            )
+        try:
+            os.unlink(tmp)  # Left over by an interrupted run.
+        except FileNotFoundError:
+            pass
+        try:
+            os.link(original, tmp)
+        except OSError as err:
+            if err.errno in (errno.EMLINK, errno.EXDEV):
+                return False
+            raise
+        os.replace(tmp, path)  # Atomic operation.
+        return True
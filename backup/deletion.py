@@ -0,0 +1,148 @@
+#   Alexandre's backup script
+#   Copyright © 2014  Alexandre A. de Verteuil
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""This module provides the deletion engine.
+
+Classes:
+    TreeDeleter
+        Removes a directory tree with a pool of worker threads.
+"""
+
+
+import concurrent.futures
+import os
+import threading
+import time
+
+from . import _logging
+
+
+class _PendingDir:
+
+    """A directory waiting for its subdirectories to be removed."""
+
+    def __init__(self, path, parent, count):
+        self.path = path
+        self.parent = parent
+        self.count = count  # Number of subdirectories not yet removed.
+
+
+class TreeDeleter(_logging.Logging):
+
+    """Removes a directory tree with a pool of worker threads.
+
+    Each task scans one directory with os.scandir(), unlinks the files it
+    contains and submits one new task per subdirectory. A directory is
+    removed as soon as its last subdirectory is gone, so the tree is
+    emptied bottom-up without any worker waiting on another.
+
+    If the deletion is interrupted, whatever is left is still a valid
+    directory tree and calling rmtree() again finishes the job.
+    """
+
+    def __init__(self, workers=1, rate=0, **kwargs):
+        """
+        workers -- Maximum number of threads removing files concurrently.
+        rate -- Maximum number of inodes removed per second, all workers
+            combined. 0 means as fast as possible.
+        """
+        super().__init__(**kwargs)
+        self.workers = max(1, workers)
+        self.rate = rate
+        self.count = 0  # Number of inodes removed by the last rmtree().
+
+    def rmtree(self, path):
+        """Remove the directory tree rooted at path."""
+        start_time = time.monotonic()
+        self._start_time = start_time
+        self.count = 0
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._error = None
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            self._executor = executor
+            self._submit(path, None)
+            self._done.wait()
+        del self._executor
+        if self._error is not None:
+            raise self._error
+        self._logger.debug(
+            "Removed {} inodes from {} in {:.1f} seconds "
+            "with {} workers.".format(
+                self.count,
+                path,
+                time.monotonic() - start_time,
+                self.workers,
+                )
+            )
+
+    def _submit(self, path, parent):
+        self._executor.submit(self._remove_dir, path, parent)
+
+    def _remove_dir(self, path, parent):
+        if self._done.is_set():
+            return  # An other worker failed. Leave the rest alone.
+        try:
+            subdirs = []
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    else:
+                        os.unlink(entry.path)
+                        self._tally(1)
+            pending = _PendingDir(path, parent, len(subdirs))
+            if subdirs:
+                for subdir in subdirs:
+                    self._submit(subdir, pending)
+            else:
+                self._finish(pending)
+        except BaseException as err:
+            self._fail(err)
+
+    def _finish(self, pending):
+        """Remove an empty directory and notify its parent."""
+        while pending is not None:
+            os.rmdir(pending.path)
+            self._tally(1)
+            parent = pending.parent
+            if parent is None:
+                self._done.set()
+                return
+            with self._lock:
+                parent.count -= 1
+                if parent.count > 0:
+                    return
+            pending = parent
+
+    def _tally(self, count):
+        """Count removed inodes and sleep if going faster than rate."""
+        with self._lock:
+            self.count += count
+            if not self.rate:
+                return
+            delay = (
+                self._start_time + self.count / self.rate - time.monotonic()
+                )
+        if delay > 0:
+            time.sleep(delay)
+
+    def _fail(self, err):
+        with self._lock:
+            if self._error is None:
+                self._error = err
+        self._done.set()
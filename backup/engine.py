@@ -34,7 +34,13 @@ import time
 import threading
 
 from . import _logging
+from . import events
+from . import timing
+from .clone import TreeCloner
 from .config import DEFAULTS
+from .dry_run import if_not_dry_run
+from .largefiles import AppendOnlyFiles, LargeFiles
+from .moves import MoveDetector
 
 
 class rsyncWrapper(_logging.Logging):
@@ -51,6 +57,10 @@ class rsyncWrapper(_logging.Logging):
         # stdin. If the bandwidth kill switch is triggered, the event will be
         # set so that the main thread can kill rsync.
         self.kill_switch_event = threading.Event()
+        # Tallies of the files transferred by every run so far.
+        self.bytes_count = 0
+        self.files_count = 0
+        self._run = None  # The rsync run not tallied yet.
 
     @property
     def args(self):
@@ -59,14 +69,51 @@ class rsyncWrapper(_logging.Logging):
         The last item of the list -- the destination directory -- is left out.
         It will be passed as a parameter of the sync_to() method.
         """
+        return self._args()
+
+    @property
+    def large_files(self):
+        """A LargeFiles instance, or None if large_files is not set."""
+        patterns = self.options.get('large_files', "").split()
+        return LargeFiles(patterns) if patterns else None
+
+    @property
+    def append_only(self):
+        """An AppendOnlyFiles instance, or None if append_only is not set."""
+        patterns = self.options.get('append_only', "").split()
+        return AppendOnlyFiles(patterns) if patterns else None
+
+    def _args(self, part=None):
+        """Construct args list for one part of the source.
+
+        part -- None for the whole source, "main" for everything but the
+            large and append-only files, "large" for the large files,
+            "append" and "rotated" for the append-only files that are not
+            large files.
+        """
         options = self.options
+        large_files = self.large_files
+        append_only = self.append_only
+        large_patterns = large_files.rsync_patterns if large_files else []
+        append_patterns = append_only.rsync_patterns if append_only else []
+        # --partial-dir conflicts with --inplace and --append-verify.
+        if part in ("large", "rotated"):
+            transfer = "--inplace"
+        elif options.get('backend') == "btrfs" and part in (None, "main"):
+            # The destination is a copy of the previous snapshot whose
+            # blocks are shared, not hard linked.
+            transfer = "--inplace"
+        elif part == "append":
+            transfer = "--append-verify"
+        else:
+            transfer = "--partial-dir=.rsync-partial"
         args = [
             options['rsync'],
             "--delete",
             "--archive",
             "--one-file-system",
             "--numeric-ids",
-            "--partial-dir=.rsync-partial",
+            transfer,
             "--verbose",
             "--out-format=#%l#%f",  # Format: "#" + file_size + "#" + file_name
             ]
@@ -74,6 +121,17 @@ class rsyncWrapper(_logging.Logging):
             args.append("--bwlimit={}".format(options['bwlimit']))
         if options.getboolean('dry-run'):
             args.append("--dry-run")
+        if options.getboolean('detect_moves'):
+            # Keep the listing of MoveDetector.
+            args.append("--filter=P /{}".format(MoveDetector.LISTING))
+            if part in (None, "main"):
+                # A moved file may have been linked into an excluded
+                # directory, don't keep it.
+                args.append("--delete-excluded")
+        if part == "main":
+            # Before the user's rules, which could include them.
+            for pattern in large_patterns + append_patterns:
+                args.append("--exclude={}".format(pattern))
         # Append --filter=merge filterfile
         filterfile = os.path.join(
             options['configdir'],
@@ -88,6 +146,19 @@ class rsyncWrapper(_logging.Logging):
             )
         if os.access(excludefile, os.F_OK):
             args.append("--exclude-from={}".format(excludefile))
+        if part in ("large", "append", "rotated"):
+            # After the user's rules, which may exclude some of them.
+            args.append("--include=*/")
+            if part == "large":
+                included = large_patterns
+            else:
+                # Large files are updated in the large part only.
+                for pattern in large_patterns:
+                    args.append("--exclude={}".format(pattern))
+                included = append_patterns
+            for pattern in included:
+                args.append("--include={}".format(pattern))
+            args.append("--exclude=*")
         # Append source directories.
         sourcedirs = options['sourcedirs'].split(":")
         if options['sourcehost'] != DEFAULTS['sourcehost']:
@@ -101,7 +172,60 @@ class rsyncWrapper(_logging.Logging):
         args += sourcedirs
         return args
 
-    def sync_to(self, dest, linkdest=None):
+    def is_unchanged(self, snapshot):
+        """Return True if the source is identical to a snapshot.
+
+        Only if the skip_unchanged option is set; otherwise, always return
+        False. rsync does a dry run against the snapshot and itemizes
+        changes. Directory modification times are ignored. Any error
+        counts as a change.
+        """
+        if not self.options.getboolean('skip_unchanged'):
+            return False
+        args = [
+            arg for arg in self.args
+            if arg != "--verbose" and not arg.startswith("--out-format=")
+            ]
+        # Insert rather than append because the source directories are
+        # already appended to the args list. These files are not part of
+        # the source, they are added to snapshots by this program.
+        args[1:1] = [
+            "--dry-run",
+            "--itemize-changes",
+            "--omit-dir-times",
+            "--filter=P /backup.log*",
+            "--filter=P /{}".format(MoveDetector.LISTING),
+            ]
+        args.append(snapshot)
+        self._logger.debug(
+            "Looking for changes with arguments {}.".format(args)
+            )
+        process = subprocess.run(
+            args,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            )
+        if process.returncode:
+            self._logger.debug(
+                "rsync returned {} ({}), assuming changes.".format(
+                    process.returncode,
+                    process.stderr.strip(),
+                    )
+                )
+            return False
+        changes = [line for line in process.stdout.splitlines() if line]
+        if changes:
+            self._logger.debug(
+                "{} changes since {}, the first one is {}.".format(
+                    len(changes),
+                    snapshot,
+                    changes[0],
+                    )
+                )
+        return not changes
+
+    def sync_to(self, dest, linkdest=None, part=None):
         """Invoke rsync and log its outputs.
 
         All the information rsyncWrapper needs to build the arguments list is
@@ -112,8 +236,33 @@ class rsyncWrapper(_logging.Logging):
             dest -- The destination directory.
             linkdest -- If not None, the directory to hardlink unchanged
                 files from.
+            part -- One of the items of the parts property.
+
+        For the "large" part, the large files of linkdest are copied into
+        dest, then updated in place. See largefiles.LargeFiles. Likewise,
+        for the "append" part, the append-only files are copied, then
+        their new tails are appended. See largefiles.AppendOnlyFiles.
+
+        If the preclone option is set, linkdest is first cloned into dest
+        as hard links. See clone.TreeCloner.
+
+        If the detect_moves option is set, files moved on the source since
+        linkdest are then linked into dest. See moves.MoveDetector.
         """
-        args = self.args
+        if part in ("large", "append", "rotated"):
+            if linkdest is not None and part != "rotated":
+                with timing.span("seed"):
+                    self._seed(part, dest, linkdest)
+            # These files are never hard linked.
+            linkdest = None
+        else:
+            if self.options.getboolean('preclone') and linkdest is not None:
+                with timing.span("preclone"):
+                    self._preclone(dest, linkdest)
+            if self.options.getboolean('detect_moves'):
+                with timing.span("detect_moves"):
+                    MoveDetector(self.options).prepare(dest, linkdest)
+        args = self._args(part)
         if linkdest is not None:
             # Insert rather than append because the source directories are
             # already appended to the args list.
@@ -122,6 +271,7 @@ class rsyncWrapper(_logging.Logging):
         self._logger.debug(
             "Invoking rsync with arguments {}.".format(args)
             )
+        self._run = {'dest': dest, 'part': part, 'start': time.monotonic()}
         self.process = subprocess.Popen(
             args,
             stdout=subprocess.PIPE,
@@ -144,8 +294,39 @@ class rsyncWrapper(_logging.Logging):
         for logger in self.loggers.values():
             logger.start()
 
+    @property
+    def parts(self):
+        """The parts of the source to sync, one rsync run each."""
+        parts = ["main"]
+        if self.large_files is not None:
+            parts.append("large")
+        if self.append_only is not None:
+            parts += ["append", "rotated"]
+        if len(parts) == 1:
+            return [None]
+        return parts
+
+    @if_not_dry_run
+    def _seed(self, part, dest, linkdest):
+        """Copy the large or append-only files of linkdest into dest."""
+        if part == "large":
+            self.large_files.seed(linkdest, dest)
+        else:
+            self.append_only.seed(linkdest, dest)
+
+    @if_not_dry_run
+    def _preclone(self, dest, linkdest):
+        """Populate dest with hard links to the files of linkdest."""
+        cloner = TreeCloner(int(self.options['preclone_workers']))
+        # The log file of linkdest is not part of the source.
+        cloner.clone(linkdest, dest, exclude=_logging.LOGFILES)
+
     def wait(self, timeout=None):
-        """Wait on the subprocess and both logger threads."""
+        """Wait on the subprocess and both logger threads.
+
+        When they are done, the files transferred are added to the
+        tallies and an rsync event is emitted.
+        """
         start = time.perf_counter()
         returncode = self.process.wait(timeout=timeout) # Raises TimeoutExpired
         for logger in self.loggers.values():
@@ -156,6 +337,21 @@ class rsyncWrapper(_logging.Logging):
             logger.join(timeout=timeout)  # Always returns None
             if logger.is_alive():
                 raise subprocess.TimeoutExpired(logger, timeout)
+        run = self._run
+        if run is not None:
+            self._run = None  # Tally once, even if called again.
+            stdout = self.loggers['stdout']
+            self.bytes_count += stdout.bytes_count
+            self.files_count += stdout.files_count
+            events.emit(
+                "rsync",
+                dest=run['dest'],
+                part=run['part'],
+                returncode=returncode,
+                seconds=round(time.monotonic() - run['start'], 3),
+                bytes=stdout.bytes_count,
+                files=stdout.files_count,
+                )
         return returncode
 
     def close_pipes(self):
@@ -197,6 +393,7 @@ class PipeLogger(_logging.Logging, threading.Thread):
         self.bw_err = bw_err
         self.biggest_files = []
         self.bytes_count = 0
+        self.files_count = 0
         super().__init__(**kwargs)
 
     def run(self):
@@ -213,8 +410,9 @@ class PipeLogger(_logging.Logging, threading.Thread):
                 # Format is: "#" + file_size + "#" + file_name
                 size, line = line[1:].split("#", 1)
                 size = int(size)  # in bytes
-                # Update the tally.
+                # Update the tallies.
                 self.bytes_count += size
+                self.files_count += 1
                 # Update the biggest files list: append, sort, truncate.
                 self.biggest_files.append((size, line))
                 self.biggest_files.sort(key=lambda f: f[0], reverse=True)
@@ -0,0 +1,139 @@
+#   Alexandre's backup script
+#   Copyright © 2014  Alexandre A. de Verteuil
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""This module provides the machine-readable event log.
+
+Classes:
+    EventLog
+        Appends events, one JSON object per line, to a file.
+
+Functions:
+    start(path)
+        Send the events of this process to the EventLog at path.
+    stop()
+        Close the EventLog.
+    emit(event, **fields)
+        Record an event, if an EventLog was started.
+
+Events and their fields, besides time, event and pid:
+    run_start -- version, hosts
+    run_end -- seconds, errors
+    host_start -- host
+    host_end -- host, status ("ok", "error", "skipped" or "interrupted"),
+        seconds, bytes, files, rotated
+    phase -- host, phase (a path of nested phases, such as
+        "host/sync/rsync"), seconds
+    rsync -- dest, part, returncode, seconds, bytes, files
+    snapshot -- path, kind ("new", "resumed" or "alias")
+    status -- path, old, new
+    kill_switch -- path, bytes
+"""
+
+
+import json
+import os
+import threading
+import time
+
+from . import _logging
+from .dry_run import if_not_dry_run
+
+
+class EventLog(_logging.Logging):
+
+    """Appends events, one JSON object per line, to a file.
+
+    Each event is a single line, written with a single write(2) to a
+    file opened in append mode, so several processes may share the file
+    and readers never see half an event. Every event has the keys time
+    (seconds since the epoch), event (its name) and pid, and fields
+    depending on the event.
+
+    Monitoring reads the events as they come, with no parsing of the
+    messages of the human log.
+
+    An EventLog that fails to write logs an error once, then drops the
+    events: the backups matter more than their monitoring.
+    """
+
+    def __init__(self, path, **kwargs):
+        """
+        path -- The path of the file, created if needed.
+        """
+        super().__init__(**kwargs)
+        self.path = path
+        self._fd = None
+        self._failed = False
+        self._lock = threading.Lock()  # PipeLogger threads emit too.
+
+    def __repr__(self):
+        return "{}({})".format(self.__class__.__name__, self.path)
+
+    @if_not_dry_run
+    def emit(self, event, **fields):
+        """Append an event with fields, which must be JSON serializable."""
+        record = {'time': round(time.time(), 3), 'event': event}
+        record['pid'] = os.getpid()
+        record.update(fields)
+        line = (json.dumps(record, default=str) + "\n").encode()
+        with self._lock:
+            if self._failed:
+                return
+            try:
+                if self._fd is None:
+                    self._fd = os.open(
+                        self.path,
+                        os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC,
+                        0o644,
+                        )
+                os.write(self._fd, line)
+            except OSError as err:
+                self._failed = True
+                self._logger.error(
+                    "Cannot write to the event log {}: {}. Events are "
+                    "dropped.".format(self.path, err)
+                    )
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+
+_log = None
+
+
+def start(path):
+    """Send the events of this process to the EventLog at path."""
+    global _log
+    stop()
+    _log = EventLog(path)
+
+
+def stop():
+    """Close the EventLog. Later events are dropped."""
+    global _log
+    if _log is not None:
+        _log.close()
+        _log = None
+
+
+def emit(event, **fields):
+    """Record an event, if an EventLog was started."""
+    if _log is not None:
+        _log.emit(event, **fields)
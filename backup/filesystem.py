@@ -0,0 +1,658 @@
+#   Alexandre's backup script
+#   Copyright © 2014  Alexandre A. de Verteuil
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""This module provides the filesystem layer.
+
+Snapshot, Cycle and Lockable never call os, glob or shutil directly. They
+go through the object held in their fs attribute instead, so the same
+code may run against a real directory tree or an in-memory one.
+
+Classes:
+    Filesystem
+        Abstract base class of all implementations.
+    PosixFilesystem
+        Thin wrapper around os, glob and shutil.
+    BtrfsFilesystem
+        Makes snapshot directories btrfs subvolumes.
+    MemoryFilesystem
+        Directory tree held in nested dicts. Useful for unit tests and
+        for benchmarking the planning logic without touching a disk.
+
+Module attributes:
+    default -- The PosixFilesystem instance used unless told otherwise.
+"""
+
+
+import abc
+import copy
+import errno
+import fcntl
+import fnmatch
+import glob
+import os
+import os.path
+import shutil
+import subprocess
+import threading
+import time
+
+from . import deletion
+
+
+class Filesystem(abc.ABC):
+
+    """Interface to the filesystem operations needed by this program.
+
+    Paths are always strings. Errors are reported with the same OSError
+    subclasses os would raise (FileNotFoundError, FileExistsError, etc.)
+    so callers need not know which implementation they are using.
+
+    mksnapshotdir() and rmsnapshotdir() create and delete the directory
+    of a snapshot. If native_snapshots is True, mksnapshotdir() can make
+    a writable copy of an other snapshot in constant time, and rsync then
+    updates it in place rather than hard linking from a link-dest.
+    """
+
+    native_snapshots = False
+
+    @abc.abstractmethod
+    def exists(self, path):
+        """Return True if path exists, following symlinks."""
+
+    @abc.abstractmethod
+    def isdir(self, path):
+        """Return True if path is a directory, following symlinks."""
+
+    @abc.abstractmethod
+    def islink(self, path):
+        """Return True if path is a symbolic link."""
+
+    @abc.abstractmethod
+    def readlink(self, path):
+        """Return the target of the symbolic link at path."""
+
+    @abc.abstractmethod
+    def symlink(self, target, path):
+        """Make a symbolic link at path pointing to target."""
+
+    @abc.abstractmethod
+    def listdir(self, path):
+        """Return the names of the entries of the directory at path."""
+
+    @abc.abstractmethod
+    def glob(self, pattern):
+        """Return the paths matching pattern, as glob.glob() does."""
+
+    @abc.abstractmethod
+    def mkdir(self, path):
+        """Create the directory at path. Its parent must exist."""
+
+    @abc.abstractmethod
+    def makedirs(self, path):
+        """Create the directory at path and its parents, if needed."""
+
+    @abc.abstractmethod
+    def rmdir(self, path):
+        """Remove the empty directory at path."""
+
+    @abc.abstractmethod
+    def rename(self, old, new):
+        """Rename old to new."""
+
+    @abc.abstractmethod
+    def remove(self, path):
+        """Remove the file or symbolic link at path."""
+
+    @abc.abstractmethod
+    def read_text(self, path):
+        """Return the content of the text file at path."""
+
+    @abc.abstractmethod
+    def write_text(self, path, content):
+        """Replace the content of the text file at path."""
+
+    @abc.abstractmethod
+    def rmtree(self, path):
+        """Delete the directory at path and everything in it."""
+
+    @abc.abstractmethod
+    def lock(self, path, shared=False):
+        """Lock the file at path, creating it.
+
+        The lock is exclusive, or shared with other shared locks if
+        shared is True. Return a handle for owns() and unlock(). Raise
+        BlockingIOError if a conflicting lock is held through an other
+        handle. Locks held by a process are released when it dies.
+        """
+
+    @abc.abstractmethod
+    def owns(self, handle, path):
+        """Return True if handle holds the lock of the file at path.
+
+        False if the file was removed or replaced since it was locked.
+        """
+
+    @abc.abstractmethod
+    def unlock(self, handle, path):
+        """Release a lock and remove its file.
+
+        The file is only removed if it is still at path and no other
+        handle holds a shared lock on it.
+        """
+
+    @abc.abstractmethod
+    def locked(self, path, exclusive=False):
+        """Return True if the file at path is locked.
+
+        If exclusive is True, shared locks are not counted.
+        """
+
+    def mksnapshotdir(self, path, source=None):
+        """Create the directory of a snapshot.
+
+        source -- The path of a snapshot to copy, only used if
+            native_snapshots is True.
+        """
+        self.mkdir(path)
+
+    def rmsnapshotdir(self, path):
+        """Delete the directory of a snapshot and everything in it."""
+        self.rmtree(path)
+
+
+class PosixFilesystem(Filesystem):
+
+    """The real thing."""
+
+    # lock() retries this many times, this many seconds apart, before
+    # giving up on a conflicting lock. Some are only held for a moment:
+    # by a process probing the file in locked(), or by the last reader
+    # upgrading its lock to remove the file in unlock().
+    lock_retries = (10, 0.005)
+
+    def __init__(self, delete_workers=1, trash=None):
+        """
+        delete_workers -- If greater than 1, rmtree() uses a
+            deletion.TreeDeleter with this many threads.
+        trash -- If not None, a trash.Trash instance. rmtree() then moves
+            trees into it instead of deleting them.
+        """
+        self.delete_workers = delete_workers
+        self.trash = trash
+
+    def exists(self, path):
+        return os.access(path, os.F_OK)
+
+    def isdir(self, path):
+        return os.path.isdir(path)
+
+    def islink(self, path):
+        return os.path.islink(path)
+
+    def readlink(self, path):
+        return os.readlink(path)
+
+    def symlink(self, target, path):
+        os.symlink(target, path)
+
+    def listdir(self, path):
+        return os.listdir(path)
+
+    def glob(self, pattern):
+        return glob.glob(pattern)
+
+    def mkdir(self, path):
+        os.mkdir(path)
+
+    def makedirs(self, path):
+        os.makedirs(path, exist_ok=True)
+
+    def rmdir(self, path):
+        os.rmdir(path)
+
+    def rename(self, old, new):
+        os.rename(old, new)
+
+    def remove(self, path):
+        os.remove(path)
+
+    def read_text(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def write_text(self, path, content):
+        with open(path, "w") as f:
+            f.write(content)
+
+    def rmtree(self, path):
+        if self.trash is not None:
+            self.trash.put(path)
+        elif self.delete_workers > 1:
+            deletion.TreeDeleter(self.delete_workers).rmtree(path)
+        else:
+            shutil.rmtree(path)
+
+    def lock(self, path, shared=False):
+        # Handles are file descriptors locked with flock(2).
+        operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        retries, delay = self.lock_retries
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+            try:
+                fcntl.flock(fd, operation | fcntl.LOCK_NB)
+            except BlockingIOError:
+                replaced = not self.owns(fd, path)
+                os.close(fd)
+                if replaced:
+                    # The holder removed the file and released its lock.
+                    continue
+                if retries <= 0:
+                    raise
+                retries -= 1
+                time.sleep(delay)
+                continue
+            except BaseException:
+                os.close(fd)
+                raise
+            if self.owns(fd, path):
+                if not shared:
+                    # For whoever wonders who holds the lock.
+                    os.ftruncate(fd, 0)
+                    os.write(fd, "{}\n".format(os.getpid()).encode())
+                return fd
+            # The previous holder removed the file between open() and
+            # flock(). Try again with a new file.
+            os.close(fd)
+
+    def owns(self, handle, path):
+        try:
+            st = os.stat(path, follow_symlinks=False)
+        except FileNotFoundError:
+            return False
+        fst = os.fstat(handle)
+        return (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino)
+
+    def unlock(self, handle, path):
+        try:
+            # Only the last holder may remove the file: readers still
+            # holding it would not exclude the next writer otherwise.
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(handle)
+            return
+        try:
+            if self.owns(handle, path):
+                # Removed while still locked, see lock().
+                os.remove(path)
+        finally:
+            os.close(handle)
+
+    def locked(self, path, exclusive=False):
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+        except FileNotFoundError:
+            return False
+        # A shared lock only conflicts with an exclusive one.
+        operation = fcntl.LOCK_SH if exclusive else fcntl.LOCK_EX
+        try:
+            fcntl.flock(fd, operation | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        finally:
+            os.close(fd)  # Also releases the lock just taken.
+        return False
+
+
+class BtrfsFilesystem(PosixFilesystem):
+
+    """Makes snapshot directories btrfs subvolumes.
+
+    A new snapshot is a writable btrfs snapshot of the link-dest, made
+    and deleted in constant time, whatever the number of files. Blocks
+    are shared until rsync overwrites them.
+
+    Snapshot directories that are not subvolumes, made before switching
+    to this backend, are deleted like any directory. Only a subvolume is
+    snapshotted; otherwise an empty subvolume is created.
+    """
+
+    native_snapshots = True
+
+    _subvolume_ino = 256  # The inode number of the root of a subvolume.
+
+    def __init__(self, btrfs="/usr/bin/btrfs", sync_deletes=False, **kwargs):
+        """
+        btrfs -- The path to the btrfs(8) executable.
+        sync_deletes -- If True, rmsnapshotdir() waits until the space of
+            a deleted subvolume is reclaimed, so that os.statvfs() sees
+            it. Otherwise the space comes back later, in the background.
+        """
+        super().__init__(**kwargs)
+        self.btrfs = btrfs
+        self.sync_deletes = sync_deletes
+
+    def is_subvolume(self, path):
+        st = os.stat(path, follow_symlinks=False)
+        return st.st_ino == self._subvolume_ino
+
+    def mksnapshotdir(self, path, source=None):
+        if source is not None and self.is_subvolume(source):
+            args = [self.btrfs, "subvolume", "snapshot", source, path]
+        else:
+            args = [self.btrfs, "subvolume", "create", path]
+        self._run(args)
+
+    def rmsnapshotdir(self, path):
+        if not self.is_subvolume(path):
+            self.rmtree(path)
+        elif self.sync_deletes:
+            # The cleaner thread only frees the extents of a subvolume
+            # once its deletion is committed.
+            self._run([
+                self.btrfs, "subvolume", "delete", "--commit-each", path,
+                ])
+            self._run([
+                self.btrfs, "subvolume", "sync", os.path.dirname(path),
+                ])
+        else:
+            # Faster than the trash, the space is reclaimed in the
+            # background.
+            self._run([self.btrfs, "subvolume", "delete", path])
+
+    def _run(self, args):
+        process = subprocess.run(
+            args,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            )
+        if process.returncode:
+            raise OSError(
+                "{} exited with status {}: {}".format(
+                    " ".join(args[:3]),
+                    process.returncode,
+                    process.stderr.strip(),
+                    )
+                )
+
+
+class _Symlink:
+
+    """A symbolic link in a MemoryFilesystem."""
+
+    def __init__(self, target):
+        self.target = target
+
+
+class _LockFile:
+
+    """A lock file in a MemoryFilesystem."""
+
+    def __init__(self):
+        self.holders = set()  # Tokens of the handles holding the lock.
+        self.shared = False
+
+
+class MemoryFilesystem(Filesystem):
+
+    """A directory tree that lives in memory.
+
+    Directories are dicts mapping names to children, files are str
+    objects, symbolic links are _Symlink objects and lock files are
+    _LockFile objects. Only absolute paths
+    are meaningful; relative ones are resolved against the current
+    working directory like os would.
+
+    glob() only supports wildcards in the last path component, which is
+    all this program needs.
+
+    With native_snapshots, mksnapshotdir() copies the source tree, like
+    BtrfsFilesystem does. This is the fake backend of the unit tests.
+    """
+
+    def __init__(self, native_snapshots=False):
+        self._root = {}
+        self._lock = threading.RLock()
+        self.native_snapshots = native_snapshots
+
+    def _split(self, path):
+        path = os.path.abspath(path)
+        return [name for name in path.split(os.sep) if name]
+
+    def _error(self, code, path):
+        return OSError(code, os.strerror(code), path)
+
+    def _lookup(self, path, follow=True, depth=0):
+        """Return the node at path or raise FileNotFoundError.
+
+        Symbolic links are followed, except the last component of path
+        if follow is False.
+        """
+        names = self._split(path)
+        node = self._root
+        for i, name in enumerate(names):
+            if not isinstance(node, dict):
+                raise self._error(errno.ENOTDIR, path)
+            try:
+                node = node[name]
+            except KeyError:
+                raise self._error(errno.ENOENT, path) from None
+            if isinstance(node, _Symlink) and (follow or i < len(names)-1):
+                if depth >= 40:
+                    raise self._error(errno.ELOOP, path)
+                target = os.path.join(
+                    os.sep + os.sep.join(names[:i]),
+                    node.target,
+                    )
+                node = self._lookup(target, True, depth+1)
+        return node
+
+    def _parent(self, path):
+        """Return (parent_dict, name) for path."""
+        names = self._split(path)
+        if not names:
+            raise self._error(errno.EBUSY, path)
+        parent = self._lookup(os.sep + os.sep.join(names[:-1]))
+        if not isinstance(parent, dict):
+            raise self._error(errno.ENOTDIR, path)
+        return parent, names[-1]
+
+    def exists(self, path):
+        with self._lock:
+            try:
+                self._lookup(path)
+            except OSError:
+                return False
+            return True
+
+    def isdir(self, path):
+        with self._lock:
+            try:
+                return isinstance(self._lookup(path), dict)
+            except OSError:
+                return False
+
+    def islink(self, path):
+        with self._lock:
+            try:
+                return isinstance(self._lookup(path, False), _Symlink)
+            except OSError:
+                return False
+
+    def readlink(self, path):
+        with self._lock:
+            node = self._lookup(path, False)
+            if not isinstance(node, _Symlink):
+                raise self._error(errno.EINVAL, path)
+            return node.target
+
+    def symlink(self, target, path):
+        with self._lock:
+            parent, name = self._parent(path)
+            if name in parent:
+                raise self._error(errno.EEXIST, path)
+            parent[name] = _Symlink(target)
+
+    def listdir(self, path):
+        with self._lock:
+            node = self._lookup(path)
+            if not isinstance(node, dict):
+                raise self._error(errno.ENOTDIR, path)
+            return list(node)
+
+    def glob(self, pattern):
+        dirname, basename = os.path.split(pattern)
+        with self._lock:
+            try:
+                names = self.listdir(dirname or os.curdir)
+            except OSError:
+                return []
+        if not basename.startswith("."):
+            # Like glob.glob(), wildcards do not match hidden files.
+            names = [name for name in names if not name.startswith(".")]
+        return [
+            os.path.join(dirname, name)
+            for name in fnmatch.filter(names, basename)
+            ]
+
+    def mkdir(self, path):
+        with self._lock:
+            parent, name = self._parent(path)
+            if name in parent:
+                raise self._error(errno.EEXIST, path)
+            parent[name] = {}
+
+    def makedirs(self, path):
+        with self._lock:
+            node = self._root
+            for name in self._split(path):
+                node = node.setdefault(name, {})
+                if not isinstance(node, dict):
+                    raise self._error(errno.ENOTDIR, path)
+
+    def rmdir(self, path):
+        with self._lock:
+            parent, name = self._parent(path)
+            node = self._lookup(path, False)
+            if not isinstance(node, dict):
+                raise self._error(errno.ENOTDIR, path)
+            if node:
+                raise self._error(errno.ENOTEMPTY, path)
+            del parent[name]
+
+    def rename(self, old, new):
+        with self._lock:
+            oldparent, oldname = self._parent(old)
+            newparent, newname = self._parent(new)
+            node = self._lookup(old, False)
+            target = newparent.get(newname)
+            if target is not None:
+                if isinstance(node, dict) and not isinstance(target, dict):
+                    raise self._error(errno.ENOTDIR, new)
+                if not isinstance(node, dict) and isinstance(target, dict):
+                    raise self._error(errno.EISDIR, new)
+                if isinstance(target, dict) and target:
+                    raise self._error(errno.ENOTEMPTY, new)
+            del oldparent[oldname]
+            newparent[newname] = node
+
+    def remove(self, path):
+        with self._lock:
+            parent, name = self._parent(path)
+            if isinstance(self._lookup(path, False), dict):
+                raise self._error(errno.EISDIR, path)
+            del parent[name]
+
+    def read_text(self, path):
+        with self._lock:
+            node = self._lookup(path)
+            if isinstance(node, dict):
+                raise self._error(errno.EISDIR, path)
+            return node
+
+    def write_text(self, path, content):
+        with self._lock:
+            parent, name = self._parent(path)
+            if isinstance(parent.get(name), dict):
+                raise self._error(errno.EISDIR, path)
+            parent[name] = content
+
+    def rmtree(self, path):
+        with self._lock:
+            parent, name = self._parent(path)
+            if not isinstance(self._lookup(path, False), dict):
+                raise self._error(errno.ENOTDIR, path)
+            del parent[name]
+
+    def lock(self, path, shared=False):
+        # Handles are (_LockFile, token) tuples.
+        with self._lock:
+            parent, name = self._parent(path)
+            node = parent.get(name)
+            if isinstance(node, dict):
+                raise self._error(errno.EISDIR, path)
+            if not isinstance(node, _LockFile):
+                node = parent[name] = _LockFile()
+            if node.holders and not (shared and node.shared):
+                raise BlockingIOError(
+                    errno.EWOULDBLOCK, os.strerror(errno.EWOULDBLOCK), path,
+                    )
+            token = object()
+            node.holders.add(token)
+            node.shared = shared
+            return (node, token)
+
+    def owns(self, handle, path):
+        with self._lock:
+            node, token = handle
+            try:
+                return self._lookup(path, False) is node and \
+                    token in node.holders
+            except OSError:
+                return False
+
+    def unlock(self, handle, path):
+        with self._lock:
+            node, token = handle
+            if self.owns(handle, path) and len(node.holders) == 1:
+                self.remove(path)
+            node.holders.discard(token)
+
+    def locked(self, path, exclusive=False):
+        with self._lock:
+            try:
+                node = self._lookup(path, False)
+            except OSError:
+                return False
+            if not isinstance(node, _LockFile) or not node.holders:
+                return False
+            return not (exclusive and node.shared)
+
+    def mksnapshotdir(self, path, source=None):
+        with self._lock:
+            if not self.native_snapshots or source is None:
+                return self.mkdir(path)
+            tree = self._lookup(source)
+            if not isinstance(tree, dict):
+                raise self._error(errno.ENOTDIR, source)
+            parent, name = self._parent(path)
+            if name in parent:
+                raise self._error(errno.EEXIST, path)
+            parent[name] = copy.deepcopy(tree)
+
+
+default = PosixFilesystem()
@@ -0,0 +1,212 @@
+#   Alexandre's backup script
+#   Copyright © 2014  Alexandre A. de Verteuil
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""This module provides the handling of large, slowly changing files.
+
+Classes:
+    LargeFiles
+        Seeds a new snapshot with private copies of large files.
+    AppendOnlyFiles
+        Seeds a new snapshot with private copies of growing files.
+
+Functions:
+    reflink(src, dst)
+        Copy a file, sharing its blocks with the original if possible.
+    match(relpath, patterns)
+        Return True if relpath matches one of the glob patterns.
+"""
+
+
+import errno
+import fcntl
+import fnmatch
+import os
+import os.path
+import shutil
+import stat
+
+from . import _logging
+
+
+FICLONE = 0x40049409  # From linux/fs.h.
+
+
+def reflink(src, dst):
+    """Copy a file, sharing its blocks with the original if possible.
+
+    Try the FICLONE ioctl (btrfs, XFS, …), then os.copy_file_range(),
+    which lets the kernel or a network filesystem do the copy, then a
+    plain copy. dst must not exist. Permissions and times are copied.
+
+    Return the name of the method that worked.
+    """
+    with open(src, "rb") as fsrc, \
+            open(dst, "xb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            method = "reflink"
+        except OSError as err:
+            if err.errno not in (errno.EOPNOTSUPP, errno.ENOTTY,
+                                 errno.EXDEV, errno.EINVAL):
+                raise
+            method = _copy(fsrc, fdst)
+    shutil.copystat(src, dst)
+    return method
+
+
+def _copy(fsrc, fdst):
+    """Copy the contents of a file object to an other."""
+    try:
+        size = os.fstat(fsrc.fileno()).st_size
+        while os.copy_file_range(fsrc.fileno(), fdst.fileno(), size):
+            pass
+        return "copy_file_range"
+    except AttributeError:
+        pass  # Python < 3.8.
+    except OSError as err:
+        if err.errno not in (errno.ENOSYS, errno.EXDEV, errno.EOPNOTSUPP,
+                             errno.EINVAL):
+            raise
+        fsrc.seek(0)
+        fdst.seek(0)
+        fdst.truncate()
+    shutil.copyfileobj(fsrc, fdst)
+    return "copy"
+
+
+def match(relpath, patterns):
+    """Return True if relpath matches one of the glob patterns.
+
+    A pattern without a slash matches file names anywhere in the tree.
+    A pattern with a slash matches paths from the root of the snapshot.
+    """
+    for pattern in patterns:
+        if "/" in pattern:
+            if fnmatch.fnmatchcase(relpath, pattern.lstrip("/")):
+                return True
+        elif fnmatch.fnmatchcase(os.path.basename(relpath), pattern):
+            return True
+    return False
+
+
+class LargeFiles(_logging.Logging):
+
+    """Seeds a new snapshot with private copies of large files.
+
+    Large files, such as virtual machine disk images, change a little
+    and often. With --link-dest, rsync writes a whole new copy of each
+    one in every snapshot. Instead, the engine leaves them out of the
+    main rsync pass, seeds the new snapshot with copies of the previous
+    versions, sharing their blocks when the filesystem can, and updates
+    them in a second pass with --inplace. Only changed blocks are written.
+
+    A pattern without a slash matches file names anywhere in the tree.
+    A pattern with a slash matches paths from the root of the snapshot.
+    """
+
+    def __init__(self, patterns, **kwargs):
+        """
+        patterns -- A list of glob patterns.
+        """
+        super().__init__(**kwargs)
+        self.patterns = patterns
+
+    @property
+    def rsync_patterns(self):
+        """The patterns, translated for rsync's filter rules."""
+        return [
+            "/"+pattern.lstrip("/") if "/" in pattern else pattern
+            for pattern in self.patterns
+            ]
+
+    def matches(self, relpath):
+        """Return True if relpath matches one of the patterns."""
+        return match(relpath, self.patterns)
+
+    def seed(self, linkdest, dest):
+        """Copy the large files of linkdest into dest.
+
+        A large file already in dest that is a hard link is replaced
+        with a copy, since rsync --inplace would otherwise change every
+        snapshot sharing it. Return the number of files copied.
+        """
+        count = 0
+        methods = set()
+        stack = [""]
+        while stack:
+            reldir = stack.pop()
+            with os.scandir(os.path.join(linkdest, reldir)) as entries:
+                for entry in entries:
+                    relpath = os.path.join(reldir, entry.name)
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(relpath)
+                        continue
+                    if (not entry.is_file(follow_symlinks=False) or
+                        not self.matches(relpath)):
+                        continue
+                    method = self._seed_file(
+                        entry.path,
+                        os.path.join(dest, relpath),
+                        )
+                    if method is not None:
+                        methods.add(method)
+                        count += 1
+        if count:
+            self._logger.info(
+                "Seeded {} large files into {} ({}).".format(
+                    count,
+                    dest,
+                    ", ".join(sorted(methods)),
+                    )
+                )
+        return count
+
+    def _seed_file(self, source, target):
+        try:
+            st = os.stat(target, follow_symlinks=False)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            return reflink(source, target)
+        if st.st_nlink == 1 or not stat.S_ISREG(st.st_mode):
+            return None  # Already private.
+        # Break the hard link.
+        tmp = os.path.join(
+            os.path.dirname(target),
+            ".{}.seed".format(os.path.basename(target)),
+            )
+        try:
+            os.unlink(tmp)  # Left over by an interrupted run.
+        except FileNotFoundError:
+            pass
+        method = reflink(target, tmp)
+        os.replace(tmp, target)
+        return method
+
+
+class AppendOnlyFiles(LargeFiles):
+
+    """Seeds a new snapshot with private copies of growing files.
+
+    Files such as logs and journals only grow. Instead of having rsync
+    checksum them whole and write a new copy in every snapshot, the
+    engine seeds the new snapshot with copies of the previous versions
+    and has rsync send their new tails with --append-verify.
+
+    A file that shrank, i. e. was rotated, is skipped by --append-verify.
+    The engine catches those with a last rsync run over the same files
+    without it.
+    """
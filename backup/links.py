@@ -0,0 +1,129 @@
+#   Alexandre's backup script
+#   Copyright © 2014  Alexandre A. de Verteuil
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""This module provides the handling of the hard link count limit.
+
+Classes:
+    LinkRotator
+        Replaces files near the link limit with fresh copies.
+
+Functions:
+    link_max(path)
+        Return the maximum link count of files under path.
+"""
+
+
+import os
+import os.path
+import stat
+import time
+
+from . import _logging
+from .accounting import format_size
+from .largefiles import reflink
+
+
+def link_max(path):
+    """Return the maximum link count of files under path.
+
+    If the filesystem does not tell, assume the ext4 limit.
+    """
+    try:
+        return os.pathconf(path, "PC_LINK_MAX")
+    except (OSError, ValueError):
+        return 65000
+
+
+class LinkRotator(_logging.Logging):
+
+    """Replaces files near the link limit with fresh copies.
+
+    A file unchanged for a long time is hard linked from every snapshot,
+    plus its duplicates when deduplicating. At the filesystem's link
+    limit, 65000 on ext4, os.link() fails with EMLINK and rsync silently
+    copies the file instead, every time.
+
+    After a sync, the LinkRotator looks for files of the new snapshot
+    whose link count is within margin of the limit, and replaces each
+    one with a copy of its own. The next snapshots link to the copy, a
+    fresh base with a link count of 1. Rotations happen once per base
+    and are counted, instead of a copy per snapshot going unnoticed.
+    """
+
+    def __init__(self, path, margin=100, **kwargs):
+        """
+        path -- A path on the destination filesystem.
+        margin -- How far below the link limit files are rotated.
+        """
+        super().__init__(**kwargs)
+        self.ceiling = max(2, link_max(path) - margin)
+        # Statistics of the last run.
+        self.rotated = 0
+        self.bytes = 0
+
+    def rotate(self, snapshot_path):
+        """Copy the files of a snapshot at or above the ceiling."""
+        start_time = time.monotonic()
+        self.rotated = self.bytes = 0
+        stack = [""]
+        while stack:
+            reldir = stack.pop()
+            dir = os.path.join(snapshot_path, reldir)
+            st = os.stat(dir)
+            rotated = self.rotated
+            with os.scandir(dir) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(os.path.join(reldir, entry.name))
+                    elif entry.is_file(follow_symlinks=False):
+                        fst = entry.stat(follow_symlinks=False)
+                        if fst.st_nlink >= self.ceiling:
+                            self._rotate_file(entry.path, fst)
+            if self.rotated > rotated:
+                # Replacing files touched the directory.
+                os.utime(dir, ns=(st.st_atime_ns, st.st_mtime_ns))
+        if self.rotated:
+            self._logger.warning(
+                "Rotated {} files ({}) of {} at {} links to fresh copies "
+                "in {:.1f} seconds.".format(
+                    self.rotated,
+                    format_size(self.bytes),
+                    snapshot_path,
+                    self.ceiling,
+                    time.monotonic() - start_time,
+                    )
+                )
+        return self.rotated
+
+    def _rotate_file(self, path, st):
+        tmp = os.path.join(
+            os.path.dirname(path),
+            ".{}.rotate".format(os.path.basename(path)),
+            )
+        try:
+            os.unlink(tmp)  # Left over by an interrupted run.
+        except FileNotFoundError:
+            pass
+        reflink(path, tmp)
+        try:
+            os.chown(tmp, st.st_uid, st.st_gid)
+        except PermissionError:
+            pass
+        os.chmod(tmp, stat.S_IMODE(st.st_mode))
+        os.replace(tmp, path)  # Atomic operation.
+        self.rotated += 1
+        self.bytes += st.st_size
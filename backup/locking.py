@@ -18,12 +18,14 @@
 """This module provides locking facilities.
 
 The Lockable class may be inherited by classes that must implement a
-locking mechanism over shared resources.
+locking mechanism over shared resources. The SyncSemaphore class limits
+how many processes sync to a destination at once.
 
 Exceptions:
 
     Error -- base class for other exceptions
         LockError -- base class for all locking exceptions
+            LockTimeout -- The lock was still held after waiting
             AlreadyLocked -- Another object, thread or process already holds
                              the lock
             LockFailed -- Lock failed for some other reason
@@ -36,12 +38,15 @@ Gratitude is owed to smontanaro.
 """
 
 
-import errno
+import contextlib
 import os
 import os.path
-import sys
 import threading
+import time
 
+from . import _logging
+from . import filesystem
+from . import timing
 from .dry_run import if_not_dry_run
 
 
@@ -78,6 +83,16 @@ class NotMyLock(UnlockError):
     pass
 
 
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # Someone else's process.
+    return True
+
+
 class Lockable:
 
     """An object that can be locked to limit access to a shared resource.
@@ -91,72 +106,178 @@ class Lockable:
     Optionally, if subclasses define a _logger attribute, methods of this
     class will make use of it.
 
+    All filesystem access goes through the fs attribute. It defaults to
+    filesystem.default and may be overridden per instance.
+
+    The lock is a lock on the lockfile, see Filesystem.lock(), held by
+    one instance in one thread. It is exclusive, or shared with other
+    shared locks with acquire(shared=True): readers, such as an rsync
+    using the snapshot as its link-dest, take shared locks so they may
+    run together; writers, such as rename, purge and delete, take
+    exclusive ones. The kernel releases it if the process dies, so a
+    crash leaves no stale lock behind. The file is removed on release.
+    Lock directories left by older versions, whose processes are gone,
+    are removed.
+
+    acquire() waits up to lock_timeout seconds for a lock held elsewhere,
+    backing off exponentially between attempts. Set lock_timeout on an
+    instance to change its default.
+
     Lockable has no constructor.
     """
 
-    @property
-    def _unique_name(self):
-        return os.path.join(
-            self.lockfile,
-            "{}.{}.{}".format(
-                os.getpid(),
-                hash(threading.current_thread()),
-                hash(self)
-                )
-            )
+    fs = filesystem.default
+
+    lock_timeout = 0
+
+    _backoff = (0.05, 5.0)  # First and longest sleep between attempts.
+
+    _lock_handle = None
+    _lock_thread = None
+    _lock_shared = False
 
     @if_not_dry_run
-    def acquire(self):
-        try:
-            os.mkdir(self.lockfile)  # Atomic operation.
-        except OSError as err:
-            err = sys.exc_info()[1]
-            if err.errno == errno.EEXIST:
-                # Already locked.
-                if os.access(self._unique_name, os.F_OK):
-                    # Already locked by me.
-                    return
-                else:
-                    msg = "{} is already locked.".format(self.path)
-                    raise AlreadyLocked(msg)
+    def acquire(self, timeout=None, shared=False):
+        """Lock, waiting up to timeout seconds, lock_timeout by default.
+
+        shared -- Take a shared lock instead of an exclusive one.
+
+        Raise AlreadyLocked if a conflicting lock is held elsewhere and
+        timeout is 0, LockTimeout if it is still held after waiting.
+        """
+        if timeout is None:
+            timeout = self.lock_timeout
+        start_time = time.monotonic()
+        delay = self._backoff[0]
+        while True:
+            try:
+                self._try_acquire(shared)
+            except AlreadyLocked:
+                waited = time.monotonic() - start_time
+                if waited >= timeout:
+                    if not timeout:
+                        raise
+                    raise LockTimeout(
+                        "{} is still locked after {:.0f} seconds.".format(
+                            self.path, waited,
+                            )
+                        ) from None
+                time.sleep(min(delay, timeout - waited))
+                delay = min(delay * 2, self._backoff[1])
             else:
-                msg = "Failed to lock {}.".format(self.path)
-                raise LockFailed(msg) from err
-        else:
-            open(self._unique_name, "wb").close()
-            if hasattr(self, "_logger"):
-                self._logger.debug(
-                    "Lock created: {}.".format(self._unique_name)
+                break
+        waited = time.monotonic() - start_time
+        if waited >= self._backoff[0] and hasattr(self, "_logger"):
+            self._logger.info(
+                "Waited {:.1f} seconds for the lock of {}.".format(
+                    waited, self.path,
                     )
+                )
 
     @acquire.alternative
-    def acquire(self):
+    def acquire(self, timeout=None, shared=False):
         self._locked = True  # Locking is irrelevant if dry_run is True.
 
+    def _try_acquire(self, shared):
+        if self._lock_handle is not None:
+            if self.fs.owns(self._lock_handle, self.lockfile):
+                if self._lock_thread is not threading.current_thread():
+                    raise AlreadyLocked(
+                        "{} is already locked.".format(self.path)
+                        )
+                if self._lock_shared and not shared:
+                    raise LockFailed(
+                        "{} is locked in shared mode by me.".format(
+                            self.path,
+                            )
+                        )
+                return  # Already locked by me.
+            self._drop_broken_lock()
+        if self.fs.isdir(self.lockfile):
+            self._remove_legacy_lock()
+        try:
+            self._lock_handle = self.fs.lock(self.lockfile, shared)
+        except BlockingIOError:
+            raise AlreadyLocked(
+                "{} is already locked.".format(self.path)
+                ) from None
+        except OSError as err:
+            msg = "Failed to lock {}.".format(self.path)
+            raise LockFailed(msg) from err
+        self._lock_thread = threading.current_thread()
+        self._lock_shared = shared
+        if hasattr(self, "_logger"):
+            self._logger.debug(
+                "{} lock acquired: {}.".format(
+                    "Shared" if shared else "Exclusive",
+                    self.lockfile,
+                    )
+                )
+
+    def _drop_broken_lock(self):
+        """Forget a lock whose file was removed by break_lock()."""
+        self.fs.unlock(self._lock_handle, self.lockfile)
+        self._lock_handle = None
+        self._lock_thread = None
+
+    def _legacy_lock_alive(self):
+        """True if a process holding a lock directory is still running.
+
+        Older versions locked by creating the lockfile directory, with a
+        file named "<pid>.<thread>.<object>" in it.
+        """
+        for name in self.fs.listdir(self.lockfile):
+            try:
+                pid = int(name.split(".")[0])
+            except ValueError:
+                continue
+            if _pid_alive(pid):
+                return True
+        return False
+
+    def _remove_legacy_lock(self):
+        if self._legacy_lock_alive():
+            raise AlreadyLocked("{} is already locked.".format(self.path))
+        if hasattr(self, "_logger"):
+            self._logger.warning(
+                "Removing the stale lock {}.".format(self.lockfile)
+                )
+        self.break_lock()
+
     @if_not_dry_run
     def release(self):
-        if not self.is_locked():
-            raise AlreadyUnlocked("{} is not locked".format(self.path))
-        elif not os.access(self._unique_name, os.F_OK):
-            raise NotMyLock("{} is locked, but not by me.".format(self.path))
-        else:
-            os.remove(self._unique_name)
-            os.rmdir(self.lockfile)
+        if self.i_am_locking():
+            self.fs.unlock(self._lock_handle, self.lockfile)
+            self._lock_handle = None
+            self._lock_thread = None
             if hasattr(self, "_logger"):
                 self._logger.debug(
-                    "Lock released: {}.".format(self._unique_name)
+                    "Lock released: {}.".format(self.lockfile)
                     )
+            return
+        if (self._lock_handle is not None and
+            not self.fs.owns(self._lock_handle, self.lockfile)):
+            self._drop_broken_lock()
+        if not self.is_locked():
+            raise AlreadyUnlocked("{} is not locked".format(self.path))
+        raise NotMyLock("{} is locked, but not by me.".format(self.path))
 
     @release.alternative
     def release(self):
         self._locked = False
 
     @if_not_dry_run
-    def is_locked(self):
-        return os.access(self.lockfile, os.F_OK)
+    def is_locked(self, exclusive=False):
+        """Return True if the lock is held, by anyone.
+
+        If exclusive is True, shared locks are not counted.
+        """
+        if self.fs.isdir(self.lockfile):
+            return self._legacy_lock_alive()
+        return self.fs.locked(self.lockfile, exclusive)
 
     @is_locked.alternative
-    def is_locked(self):
+    def is_locked(self, exclusive=False):
         try:
             return self._locked
         except AttributeError:
@@ -164,7 +285,11 @@ class Lockable:
 
     @if_not_dry_run
     def i_am_locking(self):
-        return self.is_locked() and os.access(self._unique_name, os.F_OK)
+        return (
+            self._lock_handle is not None and
+            self._lock_thread is threading.current_thread() and
+            self.fs.owns(self._lock_handle, self.lockfile)
+            )
 
     @i_am_locking.alternative
     def i_am_locking(self):
@@ -172,14 +297,165 @@ class Lockable:
 
     @if_not_dry_run
     def break_lock(self):
-        if os.access(self.lockfile, os.F_OK):
-            for name in os.listdir(self.lockfile):
-                os.remove(os.path.join(self.lockfile, name))
-            os.rmdir(self.lockfile)
-            if hasattr(self, "_logger"):
-                self._logger.debug(
-                    "Lock broken: {}.".format(self._unique_name)
-                    )
+        """Remove the lockfile, whoever holds it."""
+        if self.fs.isdir(self.lockfile):
+            for name in self.fs.listdir(self.lockfile):
+                self.fs.remove(os.path.join(self.lockfile, name))
+            self.fs.rmdir(self.lockfile)
+        elif self.fs.exists(self.lockfile):
+            self.fs.remove(self.lockfile)
+        else:
+            return
+        if hasattr(self, "_logger"):
+            self._logger.debug("Lock broken: {}.".format(self.lockfile))
+
+    @contextlib.contextmanager
+    def shared(self, timeout=None):
+        """Context manager holding a shared lock.
+
+        The with statement on the instance itself holds an exclusive one.
+        """
+        self.acquire(timeout, shared=True)
+        try:
+            yield self
+        finally:
+            self.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class SyncSemaphore(_logging.Logging):
+
+    """Limits how many processes sync to a destination at once.
+
+    With an instance of backup@.service per host, every host starts on
+    the hour and the destination disk thrashes under dozens of rsyncs.
+    The semaphore is a directory, "<dest>/.sync-slots", of lock files:
+    one per slot, "slot.<n>.lock", held while syncing, and one ticket per
+    waiting process, "<time>.<pid>.ticket", held while waiting. Tickets
+    are served in the order they were taken: a process only takes a
+    slot when fewer processes are ahead of it than slots are free.
+
+    Like those of Lockable, the locks are flock(2) locks, released by the
+    kernel when a process dies. Tickets left by dead processes are
+    removed by the next process to look at the queue.
+
+    Usable as a context manager.
+    """
+
+    fs = filesystem.default
+
+    _backoff = Lockable._backoff
+
+    def __init__(self, dest, slots, **kwargs):
+        """
+        dest -- The destination directory shared by the processes.
+        slots -- How many processes may sync at once.
+        """
+        super().__init__(**kwargs)
+        self.path = os.path.join(dest, ".sync-slots")
+        self.slots = slots
+        self._slot = None  # (path, handle) of the slot held.
+
+    def __repr__(self):
+        return "{}({}, {})".format(
+            self.__class__.__name__, self.path, self.slots,
+            )
+
+    @if_not_dry_run
+    def acquire(self):
+        """Wait for a slot, in order, and take it."""
+        with timing.span("queue"):
+            self.fs.makedirs(self.path)
+            start_time = time.monotonic()
+            delay = self._backoff[0]
+            ticket, handle = self._take_ticket()
+            try:
+                position = None
+                while True:
+                    ahead = self._position(ticket)
+                    if self._try_slot(ahead):
+                        break
+                    if ahead != position:
+                        self._logger.info(
+                            "Waiting for a sync slot of {}, position {} in "
+                            "the queue.".format(self.path, ahead + 1)
+                            )
+                        position = ahead
+                    time.sleep(delay)
+                    delay = min(delay * 2, self._backoff[1])
+            finally:
+                self.fs.unlock(handle, ticket)
+        waited = time.monotonic() - start_time
+        if waited >= self._backoff[0]:
+            self._logger.info(
+                "Waited {:.1f} seconds for {}.".format(waited, self._slot[0])
+                )
+
+    def _take_ticket(self):
+        ticket = os.path.join(
+            self.path,
+            "{:020d}.{}.ticket".format(time.time_ns(), os.getpid()),
+            )
+        while True:
+            try:
+                return ticket, self.fs.lock(ticket)
+            except BlockingIOError:
+                # Only a process probing the queue locks it, briefly.
+                time.sleep(self._backoff[0])
+
+    def _position(self, ticket):
+        """Return the number of live tickets ahead of ticket."""
+        name = os.path.basename(ticket)
+        ahead = 0
+        for other in sorted(self.fs.listdir(self.path)):
+            if not other.endswith(".ticket") or other >= name:
+                continue
+            path = os.path.join(self.path, other)
+            if self.fs.locked(path):
+                ahead += 1
+                continue
+            self._logger.debug("Removing the stale ticket {}.".format(path))
+            try:
+                self.fs.remove(path)
+            except FileNotFoundError:
+                pass
+        return ahead
+
+    def _try_slot(self, ahead):
+        """Take a free slot, unless the processes ahead take them all.
+
+        Return True if a slot was taken.
+        """
+        slots = [
+            os.path.join(self.path, "slot.{}.lock".format(n))
+            for n in range(self.slots)
+            ]
+        free = [slot for slot in slots if not self.fs.locked(slot)]
+        if ahead >= len(free):
+            return False
+        for slot in free:
+            try:
+                self._slot = (slot, self.fs.lock(slot))
+            except BlockingIOError:
+                continue
+            self._logger.debug("Sync slot acquired: {}.".format(slot))
+            return True
+        return False
+
+    @if_not_dry_run
+    def release(self):
+        if self._slot is None:
+            raise AlreadyUnlocked("{} is not held.".format(self.path))
+        slot, handle = self._slot
+        self.fs.unlock(handle, slot)
+        self._slot = None
+        self._logger.debug("Sync slot released: {}.".format(slot))
 
     def __enter__(self):
         self.acquire()
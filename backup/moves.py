@@ -0,0 +1,212 @@
+#   Alexandre's backup script
+#   Copyright © 2014  Alexandre A. de Verteuil
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""This module provides the MoveDetector class.
+
+MoveDetector
+    Hard links files moved on the source before rsync sends them again.
+"""
+
+
+import os
+import os.path
+import shlex
+import stat
+import subprocess
+
+from . import _logging
+from .config import DEFAULTS
+from .dry_run import if_not_dry_run
+
+
+class MoveDetector(_logging.Logging):
+
+    """Hard links files moved on the source before rsync sends them again.
+
+    rsync only finds a file in the link-dest directory at the path it
+    has on the source. A file that was moved or renamed is sent again.
+
+    Before rsync runs, the MoveDetector lists the files of the source
+    with find(1), over ssh for remote hosts. Each entry holds the path,
+    inode number, size, modification time, permissions and owner of a
+    regular file. The listing of the previous sync is saved in the
+    link-dest snapshot. A file whose inode was at an other path in that
+    listing, with the same size, time, permissions and owner, is hard
+    linked from the link-dest snapshot to its new path in the new
+    snapshot. rsync then finds it up to date.
+
+    The listing is saved as LISTING at the root of the new snapshot.
+    rsyncWrapper protects it from --delete.
+    """
+
+    LISTING = ".backup.listing"
+
+    _fields = 7  # path, inode, size, mtime, mode, uid, gid
+
+    def __init__(self, options, **kwargs):
+        """
+        options -- one section of a ConfigParser.
+        """
+        super().__init__(**kwargs)
+        self.options = options
+        self.linked = 0  # Number of files linked by the last prelink().
+        self.bytes = 0  # Their total size.
+
+    @property
+    def args(self):
+        """The find(1) command line that lists the source files."""
+        options = self.options
+        sourcedirs = options['sourcedirs'].split(":")
+        args = ["find"] + sourcedirs + [
+            "-xdev", "-type", "f",
+            "-printf", "%H\\0%P\\0%i\\0%s\\0%T@\\0%m\\0%U\\0%G\\0",
+            ]
+        if options['sourcehost'] != DEFAULTS['sourcehost']:
+            args = [
+                options['ssh'],
+                "-p", options['ssh_port'],
+                "-o", "BatchMode=yes",
+                options['sourcehost'],
+                " ".join(shlex.quote(arg) for arg in args),
+                ]
+        return args
+
+    def fetch(self):
+        """Return the listing of the source files.
+
+        The listing is a list of tuples of strings, one per file:
+            (path, inode, size, mtime, mode, uid, gid)
+        The path is relative to the root of the snapshot, following the
+        rsync convention about trailing slashes in source directories.
+        """
+        self._logger.debug("Listing source files with {}.".format(self.args))
+        process = subprocess.run(
+            self.args,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            )
+        if process.returncode:
+            # Unreadable directories are common, the rest is still good.
+            self._logger.warning(
+                "find exited with status {}, the listing of source files "
+                "may be incomplete.".format(process.returncode)
+                )
+            self._logger.debug(os.fsdecode(process.stderr))
+        fields = [
+            os.fsdecode(field) for field in process.stdout.split(b"\0")[:-1]
+            ]
+        listing = []
+        for i in range(0, len(fields), 8):
+            start, path, *attributes = fields[i:i+8]
+            if not start.endswith("/"):
+                # rsync creates a directory named after the source.
+                path = os.path.join(os.path.basename(start), path)
+            listing.append(tuple([path] + attributes))
+        self._logger.info("Listed {} source files.".format(len(listing)))
+        return listing
+
+    def load(self, snapshot_path):
+        """Return the listing saved in a snapshot, or an empty list."""
+        try:
+            with open(os.path.join(snapshot_path, self.LISTING), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        fields = [os.fsdecode(field) for field in data.split(b"\0")[:-1]]
+        return [
+            tuple(fields[i:i+self._fields])
+            for i in range(0, len(fields), self._fields)
+            ]
+
+    @if_not_dry_run
+    def save(self, listing, snapshot_path):
+        """Save a listing at the root of a snapshot."""
+        path = os.path.join(snapshot_path, self.LISTING)
+        with open(path+".tmp", "wb") as f:
+            for entry in listing:
+                for field in entry:
+                    f.write(os.fsencode(field) + b"\0")
+        os.replace(path+".tmp", path)
+
+    @if_not_dry_run
+    def prelink(self, listing, dest, linkdest):
+        """Link the files that moved since linkdest into dest."""
+        self.linked = 0
+        self.bytes = 0
+        previous = {}
+        for path, inode, *attributes in self.load(linkdest):
+            previous[inode] = [path] + attributes
+        for path, inode, size, mtime, mode, uid, gid in listing:
+            try:
+                oldpath, *attributes = previous[inode]
+            except KeyError:
+                continue  # A new file.
+            if oldpath == path:
+                continue  # Not moved, rsync links it by itself.
+            if attributes != [size, mtime, mode, uid, gid]:
+                continue  # Modified, or a new file reusing the inode.
+            source = os.path.join(linkdest, oldpath)
+            target = os.path.join(dest, path)
+            try:
+                st = os.stat(source, follow_symlinks=False)
+            except FileNotFoundError:
+                continue  # Excluded, or not synced after all.
+            if (not stat.S_ISREG(st.st_mode) or
+                st.st_size != int(size) or
+                int(st.st_mtime) != int(float(mtime)) or
+                stat.S_IMODE(st.st_mode) != int(mode, 8) or
+                st.st_uid != int(uid) or
+                st.st_gid != int(gid)):
+                continue
+            try:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.link(source, target)
+            except FileExistsError:
+                continue
+            except OSError as err:
+                self._logger.debug(
+                    "Unable to link {} to {}: {}.".format(source, target, err)
+                    )
+                continue
+            self.linked += 1
+            self.bytes += st.st_size
+        self._logger.info(
+            "Linked {} moved files ({} bytes) from {}.".format(
+                self.linked,
+                self.bytes,
+                linkdest,
+                )
+            )
+
+    def prepare(self, dest, linkdest=None):
+        """List the source, prelink moved files and save the listing.
+
+        If the source cannot be listed, the error is logged and otherwise
+        ignored: rsync will send moved files again, which is slow but
+        correct.
+        """
+        try:
+            listing = self.fetch()
+        except OSError as err:
+            self._logger.warning(
+                "Unable to list source files, not detecting moved files: "
+                "{}.".format(err)
+                )
+            return
+        if linkdest is not None:
+            self.prelink(listing, dest, linkdest)
+        self.save(listing, dest)
@@ -0,0 +1,145 @@
+#   Alexandre's backup script
+#   Copyright © 2014  Alexandre A. de Verteuil
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""This module provides the export of metrics to Prometheus.
+
+node_exporter's textfile collector reads the "*.prom" files of a
+directory. The metrics of every host are rendered from their summaries,
+see summary.py, so the file is complete whichever process writes it,
+such as one backup@.service instance per host.
+
+Functions:
+    render(summaries)
+        Return the metrics of summaries in the text exposition format.
+    write(path, summaries)
+        Replace the file at path with the metrics of summaries.
+"""
+
+
+from . import summary
+
+
+# Name, help and the function returning the samples of a summary, as
+# (labels, value) pairs.
+_METRICS = [
+    (
+        "backup_last_success_timestamp_seconds",
+        "When the last successful run of the host ended.",
+        lambda s: [({}, s.get('last_success'))],
+        ),
+    (
+        "backup_last_attempt_timestamp_seconds",
+        "When the last run of the host ended.",
+        lambda s: [({}, s.get('last_attempt'))],
+        ),
+    (
+        "backup_last_run_success",
+        "1 if the last run of the host succeeded, 0 otherwise.",
+        lambda s: [({}, int(s.get('status') == "ok"))],
+        ),
+    (
+        "backup_duration_seconds",
+        "The duration of the last run of the host.",
+        lambda s: [({}, s.get('seconds'))],
+        ),
+    (
+        "backup_phase_duration_seconds",
+        "The duration of each phase of the last run of the host.",
+        lambda s: [
+            ({'phase': phase}, seconds)
+            for phase, seconds in sorted((s.get('phases') or {}).items())
+            ],
+        ),
+    (
+        "backup_transferred_bytes",
+        "The bytes transferred by the last run of the host.",
+        lambda s: [({}, s.get('bytes'))],
+        ),
+    (
+        "backup_transferred_files",
+        "The files transferred by the last run of the host.",
+        lambda s: [({}, s.get('files'))],
+        ),
+    (
+        "backup_snapshots",
+        "The number of snapshots of each cycle of the host.",
+        lambda s: [
+            ({'cycle': interval}, count)
+            for interval, count in sorted((s.get('snapshots') or {}).items())
+            ],
+        ),
+    (
+        "backup_flagged",
+        "1 if the most recent snapshot of the host is flagged.",
+        lambda s: [({}, int(bool(s.get('flagged'))))],
+        ),
+    (
+        "backup_purged_snapshots",
+        "The snapshots purged from their cycle by the last run of the host.",
+        lambda s: [({}, s.get('purged'))],
+        ),
+    (
+        "backup_deleted_snapshots",
+        "The snapshots deleted by the last run of the host.",
+        lambda s: [({}, s.get('deleted'))],
+        ),
+    (
+        "backup_rotated_files",
+        "The files given fresh copies by the last run of the host.",
+        lambda s: [({}, s.get('rotated'))],
+        ),
+    ]
+
+
+def _escape(value):
+    return (
+        str(value).replace("\\", "\\\\").replace("\n", "\\n")
+        .replace('"', '\\"')
+        )
+
+
+def render(summaries):
+    """Return the metrics of summaries in the text exposition format.
+
+    summaries -- An iterable of host summaries. Values missing from a
+        summary, such as the last success of a host that never
+        succeeded, are left out.
+    """
+    summaries = list(summaries)
+    lines = []
+    for name, help, samples in _METRICS:
+        lines.append("# HELP {} {}".format(name, help))
+        lines.append("# TYPE {} gauge".format(name))
+        for s in summaries:
+            for labels, value in samples(s):
+                if value is None:
+                    continue
+                labels = dict(labels, host=s['host'])
+                lines.append("{}{{{}}} {}".format(
+                    name,
+                    ",".join(
+                        '{}="{}"'.format(key, _escape(labels[key]))
+                        for key in sorted(labels)
+                        ),
+                    value,
+                    ))
+    return "\n".join(lines) + "\n"
+
+
+def write(path, summaries):
+    """Replace the file at path with the metrics of summaries."""
+    summary.replace_file(path, render(summaries))
@@ -29,22 +29,22 @@ Classes:
 import datetime
 import enum
 import errno
-import glob
 import logging
 import os
 import os.path
-import shutil
 import sys
 
 
 from . import _logging
+from . import events
+from . import timing
 from .dry_run import if_not_dry_run
 from .locking import Lockable
 
 
 Status = enum.Enum(
     "Status",
-    "void, blank, syncing, flagged, complete, deleting, deleted",
+    "void, blank, syncing, flagged, complete, deleting, deleted, archived",
     )
 
 
@@ -56,6 +56,8 @@ class Snapshot(_logging.Logging, Lockable):
         dir -- Path to the directory where snapshots are located.
         interval -- Name of the backup cycle (i. e. hourly, daily, etc.)
         index -- Index number of the individual snapshot in the cycle.
+        fs -- A filesystem.Filesystem instance. Defaults to the real one.
+        lock_timeout -- The default timeout of acquire(), see Lockable.
 
     The constructor's parameters are components to build the snapshot's path:
         /dir/interval.timestamp
@@ -65,7 +67,8 @@ class Snapshot(_logging.Logging, Lockable):
     be represented.
 
     Static methods:
-        from_path(path)
+        from_path(path, fs=None, lock_timeout=None)
+        from_index(dir, interval, index, fs=None)
 
     Properties:
         timestamp
@@ -74,15 +77,21 @@ class Snapshot(_logging.Logging, Lockable):
         path
         lockfile
         statusfile
+        packfile
+        is_alias
 
     Attributes:
         dir
         interval
         index
+        fs
 
     Methods:
         infer_status
-        mkdir -- void -> blank
+        mkdir -- void -> blank, or void -> syncing with native snapshots
+        make_alias -- void -> complete
+        resolve
+        aliases
         delete -- blank, syncing, flagged, complete, deleting -> deleted
         acquire
         release
@@ -96,14 +105,26 @@ class Snapshot(_logging.Logging, Lockable):
         complete -- Clean snapshot, safe for rsync to link-dest from.
         deleting -- In the process of removing the tree. Flagged as dirty.
         deleted -- Same as VOID, but cannot change status anymore.
+        archived -- The tree was replaced with a pack, see archive.Archiver.
+            Counts as complete for retention, but cannot be a link-dest.
+
+    Aliases:
+        When nothing changed since the previous snapshot, an alias may be
+        made instead of a new tree: a relative symbolic link to the
+        previous snapshot, in the same directory. An alias is complete and
+        otherwise behaves like any snapshot. Renaming a snapshot repoints
+        its aliases. Deleting it moves its tree to its most recent alias
+        instead, and repoints the other ones there.
     """
 
     _timeformat = "%Y-%m-%dT%H:%M"  # ISO 8601 format: yyyy-mm-ddThh:mm
 
     wip_suffix = "wip"
 
+    packname = ".backup-pack"
+
     @staticmethod
-    def from_path(path):
+    def from_path(path, fs=None, lock_timeout=None):
         """Create a snapshot object from a path name.
 
         The expected string format is:
@@ -113,12 +134,20 @@ class Snapshot(_logging.Logging, Lockable):
         interval, stimestamp = os.path.basename(path).split(".")
         if stimestamp == Snapshot.wip_suffix:
             stimestamp = None
-        return Snapshot(dir, interval, timestamp=stimestamp)
+        return Snapshot(
+            dir,
+            interval,
+            timestamp=stimestamp,
+            fs=fs,
+            lock_timeout=lock_timeout,
+            )
 
     @staticmethod
-    def from_index(dir, interval, index):
+    def from_index(dir, interval, index, fs=None):
         # Try to find timestamp by index in existing directories.
-        dirs = glob.glob("{}/{}.*".format(dir, interval))
+        if fs is None:
+            fs = Snapshot.fs
+        dirs = fs.glob("{}/{}.*".format(dir, interval))
         dirs.sort(reverse=True)
         dirs[index]  # raises IndexError.
         if dirs[index].endswith("."+Snapshot.wip_suffix):
@@ -128,10 +157,15 @@ class Snapshot(_logging.Logging, Lockable):
                 dirs[index].rsplit(".")[-1],
                 Snapshot._timeformat
                 )
-        return Snapshot(dir, interval, timestamp)
+        return Snapshot(dir, interval, timestamp, fs=fs)
 
-    def __init__(self, dir, interval, timestamp=None, **kwargs):
+    def __init__(self, dir, interval, timestamp=None, fs=None,
+                 lock_timeout=None, **kwargs):
         super().__init__(**kwargs)
+        if fs is not None:
+            self.fs = fs
+        if lock_timeout is not None:
+            self.lock_timeout = lock_timeout
         self.dir = dir
         self._interval = interval
         self._status = None
@@ -171,6 +205,10 @@ class Snapshot(_logging.Logging, Lockable):
             )
         return path
 
+    @property
+    def packfile(self):
+        return os.path.join(self.path, self.packname)
+
     @property
     def timestamp(self):
         """The date and time at which this backup snapshot was made."""
@@ -186,13 +224,14 @@ class Snapshot(_logging.Logging, Lockable):
         newpath = self.path
         newlock = self.lockfile
         newstatus = self.statusfile
-        if os.access(oldlock, os.F_OK):
+        if self.fs.exists(oldlock):
             self._logger.debug("Moving {} to {}.".format(oldlock, newlock))
             self._rename(oldlock, newlock)
-        if os.access(oldpath, os.F_OK):
+        if self.fs.exists(oldpath) or self.fs.islink(oldpath):
             self._logger.debug("Moving {} to {}.".format(oldpath, newpath))
             self._rename(oldpath, newpath)
-        if os.access(oldstatus, os.F_OK):
+            self._repoint_aliases(oldpath, newpath)
+        if self.fs.exists(oldstatus):
             self._logger.debug("Moving {} to {}.".format(oldstatus, newstatus))
             self._rename(oldstatus, newstatus)
         self._logger.debug("timestamp set to {}.".format(self.stimestamp))
@@ -210,20 +249,69 @@ class Snapshot(_logging.Logging, Lockable):
         newpath = self.path
         newlock = self.lockfile
         newstatus = self.statusfile
-        if os.access(oldlock, os.F_OK):
+        if self.fs.exists(oldlock):
             self._logger.debug("Moving {} to {}.".format(oldlock, newlock))
             self._rename(oldlock, newlock)
-        if os.access(oldpath, os.F_OK):
+        if self.fs.exists(oldpath) or self.fs.islink(oldpath):
             self._logger.debug("Moving {} to {}.".format(oldpath, newpath))
             self._rename(oldpath, newpath)
-        if os.access(oldstatus, os.F_OK):
+            self._repoint_aliases(oldpath, newpath)
+        if self.fs.exists(oldstatus):
             self._logger.debug("Moving {} to {}.".format(oldstatus, newstatus))
             self._rename(oldstatus, newstatus)
         self._logger.debug("timestamp set to {}.".format(self.stimestamp))
 
     @if_not_dry_run
     def _rename(self, old, new):
-        os.rename(old, new)
+        with timing.span("rename"):
+            self.fs.rename(old, new)
+
+    @property
+    def is_alias(self):
+        """True if this snapshot is a link to an other one."""
+        return self.fs.islink(self.path)
+
+    def resolve(self):
+        """Return the Snapshot an alias points to, or self."""
+        if not self.is_alias:
+            return self
+        target = os.path.join(self.dir, self.fs.readlink(self.path))
+        return Snapshot.from_path(
+            target, fs=self.fs, lock_timeout=self.lock_timeout,
+            )
+
+    def aliases(self):
+        """Return the paths of the aliases of this snapshot, newest first."""
+        name = os.path.basename(self.path)
+        paths = [
+            path for path in self.fs.glob("{}/*.*".format(self.dir))
+            if self.fs.islink(path) and self.fs.readlink(path) == name
+            ]
+        paths.sort(key=lambda p: os.path.basename(p).split(".")[1])
+        paths.reverse()
+        return paths
+
+    def _repoint_aliases(self, oldpath, newpath):
+        """Make the aliases of the snapshot at oldpath follow it."""
+        if self.fs.islink(newpath):
+            return  # Aliases never point to aliases.
+        name = os.path.basename(oldpath)
+        for path in self.fs.glob("{}/*.*".format(self.dir)):
+            if self.fs.islink(path) and self.fs.readlink(path) == name:
+                self._logger.debug(
+                    "Pointing {} to {}.".format(path, newpath)
+                    )
+                self._replace_link(os.path.basename(newpath), path)
+
+    @if_not_dry_run
+    def _replace_link(self, target, path):
+        # A hidden name, not to be mistaken for a snapshot.
+        tmp = os.path.join(
+            os.path.dirname(path),
+            "."+os.path.basename(path)+".link",
+            )
+        self.fs.symlink(target, tmp)
+        self.fs.rename(tmp, path)  # Atomic operation.
 
     @property
     def stimestamp(self):
@@ -254,9 +342,8 @@ class Snapshot(_logging.Logging, Lockable):
     @if_not_dry_run
     def _status_file_check(self):
         if self._status in (Status.syncing, Status.flagged, Status.deleting):
-            with open(self.statusfile) as f:
-                filestatus = Status(int(f.read()))
-                assert filestatus is self._status, _status_lookup[filestatus]
+            filestatus = Status(int(self.fs.read_text(self.statusfile)))
+            assert filestatus is self._status, filestatus
 
     @status.setter
     def status(self, newstatus):
@@ -285,29 +372,37 @@ class Snapshot(_logging.Logging, Lockable):
                 self._unlink(self.statusfile)
             except FileNotFoundError:
                 pass
+        if self._status is not None and newstatus is not self._status:
+            events.emit(
+                "status",
+                path=self.path,
+                old=self._status.name,
+                new=newstatus.name,
+                )
         self._status = newstatus
 
     @if_not_dry_run
     def _create_file(self, path, content):
-        with open(path, "w") as f:
-            f.write(content)
+        self.fs.write_text(path, content)
 
     @if_not_dry_run
     def _unlink(self, path):
-        os.unlink(path)
+        self.fs.remove(path)
 
     def infer_status(self):
         """Infer status by analyzing snapshot directory and status file."""
         status = None
-        if not os.access(self.path, os.F_OK):
+        if not self.fs.exists(self.path):
+            # This includes an alias whose target is gone.
             status = Status.void
         else:
             try:
-                with open(self.statusfile) as f:
-                    # This covers the SYNCING, FLAGGED and DELETING cases.
-                    status = Status(int(f.read()))
+                # This covers the SYNCING, FLAGGED and DELETING cases.
+                status = Status(int(self.fs.read_text(self.statusfile)))
             except FileNotFoundError:
-                if os.listdir(self.path):
+                if self.fs.exists(self.packfile):
+                    status = Status.archived
+                elif self.fs.listdir(self.path):
                     status = Status.complete
                 else:
                     status = Status.blank
@@ -315,30 +410,83 @@ class Snapshot(_logging.Logging, Lockable):
         self.status = status
         return status
 
-    def mkdir(self):
-        """Create the snapshot directory on the filesystem."""
+    def mkdir(self, source=None):
+        """Create the snapshot directory on the filesystem.
+
+        source -- A Snapshot. If the filesystem has native snapshots, the
+            directory is made a copy of it, and flagged as syncing first:
+            it is not blank, and not complete either.
+        """
         if self.status != Status.void:
             msg = "status is {}, must be void.".format(
                 self.status.name,
                 )
             raise RuntimeError(msg)
+        if source is not None and self.fs.native_snapshots:
+            self.status = Status.syncing  # void -> syncing
+            self._mkdir(self.path, source.path)
+            self._logger.debug(
+                "Created {} as a copy of {}.".format(self.path, source.path)
+                )
+            return
         self._mkdir(self.path)
         self._logger.debug("Created directory {}.".format(self.path))
         self.status = Status.blank  # void -> blank
 
     @if_not_dry_run
-    def _mkdir(self, path):
-        os.mkdir(self.path)
+    def _mkdir(self, path, source=None):
+        self.fs.mksnapshotdir(path, source)
+
+    def make_alias(self, target):
+        """Make this snapshot an alias of the target Snapshot."""
+        if self.status != Status.void:
+            msg = "status is {}, must be void.".format(
+                self.status.name,
+                )
+            raise RuntimeError(msg)
+        target = target.resolve()
+        if target.dir != self.dir:
+            raise ValueError(
+                "{} is not in {}.".format(target.path, self.dir)
+                )
+        self._symlink(os.path.basename(target.path), self.path)
+        self._logger.debug(
+            "Created alias {} of {}.".format(self.path, target.path)
+            )
+        self.status = Status.complete  # void -> complete
+
+    @if_not_dry_run
+    def _symlink(self, target, path):
+        self.fs.symlink(target, path)
 
     def delete(self):
-        if self.status is Status.void:
+        if self.status is Status.void and not self.is_alias:
             raise RuntimeError("Deleting a void snapshot.")
         self._logger.info("Deleting {}.".format(self.path))
         self.status = Status.deleting
-        self._rmtree(self.path)
+        if self.is_alias:
+            self._unlink(self.path)
+        else:
+            aliases = self.aliases()
+            if aliases:
+                self._promote(aliases)
+            else:
+                self._rmtree(self.path)
         self.status = Status.deleted
         self._logger.info("Deletion complete.")
 
+    def _promote(self, aliases):
+        """Move the tree to the newest alias instead of deleting it."""
+        newest = aliases[0]
+        self._logger.info(
+            "{} has aliases, moving it to {}.".format(self.path, newest)
+            )
+        self._unlink(newest)
+        self._rename(self.path, newest)
+        for path in aliases[1:]:
+            self._replace_link(os.path.basename(newest), path)
+
     @if_not_dry_run
     def _rmtree(self, path):
-        shutil.rmtree(self.path)
+        with timing.span("rmtree"):
+            self.fs.rmsnapshotdir(path)
@@ -0,0 +1,96 @@
+#   Alexandre's backup script
+#   Copyright © 2014  Alexandre A. de Verteuil
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""This module provides the per-host summary file.
+
+The summary is a small JSON object, "<dest>/<host>/.summary.json",
+replaced at the end of each run of the host. Monitoring reads it instead
+of walking the snapshots and their logs. Its keys are:
+
+    host -- The name of the host.
+    status -- "ok", "error", "skipped" or "interrupted".
+    last_attempt -- When the last run ended, in seconds since the epoch.
+    last_success -- When the last run with status "ok" ended, or None.
+    seconds -- The duration of the last run.
+    bytes, files -- The bytes and files transferred by the last run.
+    snapshot -- The path of the most recent snapshot, or None.
+    phases -- The duration of each phase of the last run, by phase.
+    snapshots -- The number of snapshots of each cycle, by interval.
+    flagged -- True if the most recent snapshot is flagged.
+    purged, deleted -- The snapshots purged from their cycle and the
+        snapshots deleted by the last run.
+    rotated -- The files given fresh copies by the last run, see
+        rotate_links.
+
+Functions:
+    read(hostdir)
+        Return the summary of a host directory, or None.
+    write(hostdir, summary)
+        Replace the summary of a host directory.
+    replace_file(path, text)
+        Replace a file atomically.
+"""
+
+
+import json
+import os
+import os.path
+
+
+FILENAME = ".summary.json"
+
+
+def read(hostdir):
+    """Return the summary of a host directory, or None.
+
+    A corrupt summary, such as one written by hand, is as good as none:
+    the next run of the host replaces it.
+    """
+    try:
+        with open(os.path.join(hostdir, FILENAME), encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def write(hostdir, summary):
+    """Replace the summary of a host directory."""
+    replace_file(
+        os.path.join(hostdir, FILENAME),
+        json.dumps(summary, indent=1, sort_keys=True) + "\n",
+        )
+
+
+def replace_file(path, text):
+    """Replace the file at path with text.
+
+    The text is written to a temporary file, then renamed, so readers see
+    either the old file or the new one, never part of it.
+    """
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)  # Atomic operation.
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
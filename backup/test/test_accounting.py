@@ -0,0 +1,84 @@
+#   Alexandre's backup script
+#   Copyright © 2014  Alexandre A. de Verteuil
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+
+from .basic_setup import BasicSetup
+from ..accounting import *
+from ..cycle import *
+
+
+class TestSpaceIndex(BasicSetup):
+
+    def setUp(self):
+        super().setUp()
+        # Two snapshots sharing one file, each with a file of its own.
+        os.chdir(self.testdest)
+        os.mkdir("hourly.2014-07-01T00:00")
+        os.mkdir("hourly.2014-07-02T00:00")
+        for name in ("shared", "old"):
+            with open("hourly.2014-07-01T00:00/"+name, "w") as f:
+                f.write("x" * 100000)
+        with open("hourly.2014-07-02T00:00/new", "w") as f:
+            f.write("x" * 100000)
+        os.link(
+            "hourly.2014-07-01T00:00/shared",
+            "hourly.2014-07-02T00:00/shared",
+            )
+        self.size = os.stat("hourly.2014-07-01T00:00/old").st_blocks * 512
+        self.dirsize = os.stat("hourly.2014-07-01T00:00").st_blocks * 512
+        self.cycle = Cycle(self.testdest, "hourly")
+
+    def test_usage(self):
+        with SpaceIndex(self.testdest) as index:
+            index.sync(self.cycle.snapshots)
+            self.assertEqual(
+                index.snapshots,
+                {"2014-07-01T00:00", "2014-07-02T00:00"},
+                )
+            usage = index.usage()
+            unique = self.size + self.dirsize
+            self.assertEqual(usage["2014-07-01T00:00"], (unique, self.size))
+            self.assertEqual(usage["2014-07-02T00:00"], (unique, self.size))
+            self.assertEqual(
+                index.reclaimable(["2014-07-01T00:00", "2014-07-02T00:00"]),
+                2 * unique + self.size,
+                )
+            lines = index.report([self.cycle])
+            self.assertEqual(len(lines), 4)
+            self.assertTrue(lines[1].startswith("hourly.2014-07-02T00:00"))
+            self.assertTrue(lines[3].startswith("hourly cycle"))
+
+    def test_sync_forgets_deleted_snapshots(self):
+        with SpaceIndex(self.testdest) as index:
+            index.sync(self.cycle.snapshots)
+        self.cycle.purge(1)
+        # A new connection reads the persisted index.
+        with SpaceIndex(self.testdest) as index:
+            index.sync(self.cycle.snapshots)
+            self.assertEqual(index.snapshots, {"2014-07-02T00:00"})
+            unique = self.size + self.dirsize
+            self.assertEqual(
+                index.usage(),
+                {"2014-07-02T00:00": (unique + self.size, 0)},
+                )
+
+    def test_format_size(self):
+        self.assertEqual(format_size(0), "0B")
+        self.assertEqual(format_size(1536), "1.5K")
+        self.assertEqual(format_size(3 * 1024**3), "3.0G")
+        self.assertEqual(format_size(2048 * 1024**4), "2048.0T")
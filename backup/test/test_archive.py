@@ -0,0 +1,108 @@
+#   Alexandre's backup script
+#   Copyright © 2014  Alexandre A. de Verteuil
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import filecmp
+import os
+import os.path
+import shutil
+
+from .basic_setup import BasicSetup
+from ..archive import *
+from ..cycle import Cycle
+from ..snapshot import Snapshot, Status
+
+
+class TestArchiver(BasicSetup):
+
+    def setUp(self):
+        super().setUp()
+        self.hostdir = os.path.join(self.testdest, "host")
+        os.mkdir(self.hostdir)
+        self.snapshot = Snapshot(self.hostdir, "daily", "2014-01-01T00:00")
+        shutil.copytree(self.testsource, self.snapshot.path)
+        os.chdir(self.snapshot.path)
+        os.mkdir("sub")
+        os.chmod("sub", 0o750)
+        os.link("testfile_01_of_20", "sub/hardlink")
+        os.symlink("../testfile_02_of_20", "sub/symlink")
+        with open("backup.log", "w") as f:
+            f.write("log\n")
+        os.chdir(self.testdest)
+        self.original = os.path.join(self.testdest, "original")
+        shutil.copytree(self.snapshot.path, self.original, symlinks=True)
+        self.snapshot.infer_status()
+
+    def test_archive(self):
+        Archiver().archive(self.snapshot)
+        self.assertIs(self.snapshot.status, Status.archived)
+        self.assertEqual(
+            sorted(os.listdir(self.snapshot.path)),
+            [Snapshot.packname, "backup.log"],
+            )
+        self.assertIs(
+            Snapshot.from_path(self.snapshot.path).status,
+            Status.archived,
+            )
+        # Archived snapshots count for retention, but are not link-dests.
+        cycle = Cycle(self.hostdir, "daily")
+        self.assertIsNone(cycle.get_linkdest())
+        cycle.purge(1)
+        self.assertTrue(os.path.isdir(self.snapshot.path))
+
+    def test_extract(self):
+        Archiver().archive(self.snapshot)
+        pack, relpath = Pack.find(os.path.join(self.snapshot.path, "sub"))
+        self.assertEqual(relpath, "sub")
+        self.assertEqual(
+            [member['path'] for member in pack.list(relpath)],
+            ["sub", "sub/hardlink", "sub/symlink"],
+            )
+        target = os.path.join(self.testdest, "restored")
+        pack.extract("", target)
+        os.unlink(os.path.join(self.original, "backup.log"))
+        comparison = filecmp.dircmp(self.original, target)
+        self.assertEqual(comparison.left_only, [])
+        self.assertEqual(comparison.right_only, [])
+        self.assertEqual(comparison.diff_files, [])
+        self.assertEqual(
+            os.readlink(os.path.join(target, "sub/symlink")),
+            "../testfile_02_of_20",
+            )
+        self.assertEqual(
+            os.stat(os.path.join(target, "sub")).st_mode & 0o777,
+            0o750,
+            )
+        # A single file.
+        single = os.path.join(self.testdest, "single")
+        pack.extract("sub/hardlink", single)
+        self.assertTrue(filecmp.cmp(
+            single,
+            os.path.join(self.original, "testfile_01_of_20"),
+            shallow=False,
+            ))
+
+    def test_interrupted(self):
+        # The pack was written, but the tree was not completely removed.
+        archiver = Archiver()
+        archiver._pack(self.snapshot.path, self.snapshot.packfile)
+        self.snapshot.infer_status()
+        self.assertIs(self.snapshot.status, Status.archived)
+        archiver.archive(self.snapshot)
+        self.assertEqual(
+            sorted(os.listdir(self.snapshot.path)),
+            [Snapshot.packname, "backup.log"],
+            )
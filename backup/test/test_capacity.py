@@ -0,0 +1,154 @@
+#   Alexandre's backup script
+#   Copyright © 2014  Alexandre A. de Verteuil
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import sys
+import unittest.mock
+
+from .basic_setup import BasicSetup
+from ..accounting import SpaceIndex, parse_size
+from ..capacity import *
+from ..cycle import Cycle
+from ..filesystem import BtrfsFilesystem
+
+
+class TestCapacityPlanner(BasicSetup):
+
+    def setUp(self):
+        super().setUp()
+        os.chdir(self.testdest)
+        self.make_snapshots()
+        self.planner = CapacityPlanner(self.testdest, ["a", "b"], 1)
+
+    def make_snapshots(self):
+        for host, intervals in (
+                ("a", ["hourly.2014-07-03T00:00", "daily.2014-07-01T00:00"]),
+                ("b", ["hourly.2014-07-04T00:00", "hourly.2014-07-02T00:00"]),
+                ):
+            os.makedirs(host, exist_ok=True)
+            for name in intervals:
+                if os.path.exists(os.path.join(host, name)):
+                    continue
+                os.mkdir(os.path.join(host, name))
+                open(os.path.join(host, name, "file"), "w").close()
+
+    def test_candidates(self):
+        with unittest.mock.patch.object(
+                self.planner, "shortage", return_value=(0, 1)):
+            self.assertEqual(
+                [s.path for s in self.planner.candidates()],
+                [
+                    os.path.join(self.testdest, "a/daily.2014-07-01T00:00"),
+                    os.path.join(self.testdest, "b/hourly.2014-07-02T00:00"),
+                    ],
+                )
+
+    def test_candidates_that_free_nothing_come_last(self):
+        # In a, the daily snapshot only holds hard links.
+        os.unlink("a/daily.2014-07-01T00:00/file")
+        os.rmdir("a/daily.2014-07-01T00:00")
+        os.mkdir("a/daily.2014-07-01T00:00")
+        os.link(
+            "a/hourly.2014-07-03T00:00/file",
+            "a/daily.2014-07-01T00:00/file",
+            )
+        with SpaceIndex("a") as index:
+            for interval in ("hourly", "daily"):
+                index.sync(Cycle("a", interval).snapshots)
+            # Pretend directories take no space.
+            index._db.execute("UPDATE inodes SET size = 0")
+            index._db.commit()
+        with unittest.mock.patch.object(
+                self.planner, "shortage", return_value=(1, 0)):
+            self.assertEqual(
+                [s.path for s in self.planner.candidates()],
+                [
+                    os.path.join(self.testdest, "b/hourly.2014-07-02T00:00"),
+                    os.path.join(self.testdest, "a/daily.2014-07-01T00:00"),
+                    ],
+                )
+
+    def test_free_space(self):
+        shortages = [(10, 0), (10, 0), (5, 0), (0, 0)]
+        with unittest.mock.patch.object(
+                self.planner, "shortage", side_effect=shortages):
+            self.assertTrue(self.planner.free_space())
+        self.assertEqual(len(self.planner.deleted), 2)
+        self.assertEqual(os.listdir("a"), ["hourly.2014-07-03T00:00"])
+        self.assertEqual(os.listdir("b"), ["hourly.2014-07-04T00:00"])
+
+    def test_free_space_on_btrfs(self):
+        # A fake btrfs that reclaims the space of deleted subvolumes only
+        # when asked to wait for it.
+        log = os.path.join(self.testdest, "btrfs.log")
+        btrfs = os.path.join(self.testdest, "btrfs")
+        with open(btrfs, "w") as f:
+            f.write(
+                "#!{}\n"
+                "import shutil, sys\n"
+                "with open({!r}, 'a') as f:\n"
+                "    f.write(' '.join(sys.argv[1:]) + '\\n')\n"
+                "if sys.argv[1:3] == ['subvolume', 'delete']:\n"
+                "    shutil.rmtree(sys.argv[-1])\n".format(
+                    sys.executable, log,
+                    )
+                )
+        os.chmod(btrfs, 0o755)
+        def shortage():
+            try:
+                with open(log) as f:
+                    synced = "subvolume sync" in f.read()
+            except FileNotFoundError:
+                synced = False
+            return (0, 0) if synced else (10, 0)
+        for sync_deletes, deleted in ((False, 2), (True, 1)):
+            self.make_snapshots()
+            planner = CapacityPlanner(
+                self.testdest, ["a", "b"], 1,
+                fs=BtrfsFilesystem(btrfs=btrfs, sync_deletes=sync_deletes),
+                )
+            with unittest.mock.patch.object(
+                    BtrfsFilesystem, "is_subvolume", return_value=True), \
+                    unittest.mock.patch.object(
+                    planner, "shortage", side_effect=shortage):
+                planner.free_space()
+            # Without waiting, every candidate goes.
+            self.assertEqual(len(planner.deleted), deleted)
+        with open(log) as f:
+            self.assertEqual(
+                f.read().splitlines()[-2:],
+                [
+                    "subvolume delete --commit-each " + planner.deleted[0],
+                    "subvolume sync " + os.path.dirname(planner.deleted[0]),
+                    ],
+                )
+
+    def test_not_enough_space(self):
+        with unittest.mock.patch.object(
+                self.planner, "shortage", return_value=(10, 0)):
+            self.assertFalse(self.planner.free_space())
+        self.assertEqual(len(self.planner.deleted), 2)
+
+    def test_shortage(self):
+        self.assertEqual(self.planner.shortage(), (0, 0))
+        self.planner.min_free = 2**80
+        self.assertGreater(self.planner.shortage()[0], 0)
+
+    def test_parse_size(self):
+        self.assertEqual(parse_size("100"), 100)
+        self.assertEqual(parse_size("2k"), 2048)
+        self.assertEqual(parse_size("1.5G"), 3 * 2**29)
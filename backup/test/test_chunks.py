@@ -0,0 +1,126 @@
+#   Alexandre's backup script
+#   Copyright © 2014  Alexandre A. de Verteuil
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import io
+import os
+import os.path
+import random
+import shutil
+import unittest.mock
+
+from .basic_setup import BasicSetup
+from ..chunks import *
+
+
+def _random_bytes(n, seed=0):
+    return random.Random(seed).getrandbits(n * 8).to_bytes(n, "little")
+
+
+class TestChunks(BasicSetup):
+
+    def test_boundaries_resync(self):
+        data = _random_bytes(4 * 1024 * 1024)
+        kwargs = {'min_size': 16 * 1024, 'max_size': 256 * 1024}
+        before = list(chunks(io.BytesIO(data), **kwargs))
+        self.assertEqual(b"".join(before), data)
+        self.assertGreater(len(before), 10)
+        # Insert bytes near the start: only the first chunks change.
+        edited = data[:1000] + b"inserted" + data[1000:]
+        after = list(chunks(io.BytesIO(edited), **kwargs))
+        self.assertEqual(b"".join(after), edited)
+        self.assertGreater(len(set(before) & set(after)), len(before) - 3)
+
+    def test_empty_file(self):
+        self.assertEqual(list(chunks(io.BytesIO(b""))), [])
+
+
+class TestChunkStore(BasicSetup):
+
+    def setUp(self):
+        super().setUp()
+        self.snapshot = os.path.join(self.testdest, "host", "hourly.1")
+        shutil.copytree(self.testsource, self.snapshot)
+        os.mkdir(os.path.join(self.snapshot, "vm"))
+        self.image = os.path.join(self.snapshot, "vm", "disk.img")
+        with open(self.image, "wb") as f:
+            f.write(_random_bytes(3 * 1024 * 1024))
+        os.chmod(self.image, 0o600)
+        self.store = ChunkStore(self.testdest)
+
+    def test_convert_and_restore(self):
+        with open(self.image, "rb") as f:
+            data = f.read()
+        st = os.stat(self.image)
+        self.assertEqual(self.store.convert(self.snapshot, ["*.img"]), 1)
+        self.assertFalse(os.path.exists(self.image))
+        self.assertTrue(os.path.isfile(self.image + ChunkStore.SUFFIX))
+        target = os.path.join(self.testdest, "restored")
+        ChunkStore.find(self.snapshot).restore(self.snapshot, target)
+        restored = os.path.join(target, "vm", "disk.img")
+        with open(restored, "rb") as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(os.stat(restored).st_mtime_ns, st.st_mtime_ns)
+        self.assertEqual(os.stat(restored).st_mode, st.st_mode)
+        self.assertEqual(
+            sorted(os.listdir(target)),
+            sorted(os.listdir(self.testsource) + ["vm"]),
+            )
+
+    def test_collect(self):
+        self.store.convert(self.snapshot, ["*.img"])
+        self.assertEqual(self.store.collect(), 0)
+        # Once the snapshot is gone, its chunks are not needed anymore.
+        shutil.rmtree(self.snapshot)
+        self.assertEqual(self.store.collect(), 3 * 1024 * 1024)
+        for dirpath, dirnames, filenames in os.walk(self.store.path):
+            self.assertIn(filenames, ([], ["index.db"]))
+
+    def test_collect_interrupted(self):
+        with open(self.image, "rb") as f:
+            data = f.read()
+        self.store.convert(self.snapshot, ["*.img"])
+        shutil.rmtree(self.snapshot)
+        # Interrupted, e.g. by SIGTERM, after deleting the first file.
+        unlink = os.unlink
+        deleted = []
+        def interrupted(path):
+            if deleted:
+                raise SystemExit()
+            unlink(path)
+            deleted.append(path)
+        with unittest.mock.patch(
+                "backup.chunks.os.unlink", side_effect=interrupted):
+            with self.assertRaises(SystemExit):
+                self.store.collect()
+        # The same file is backed up and converted again.
+        os.makedirs(os.path.dirname(self.image))
+        with open(self.image, "wb") as f:
+            f.write(data)
+        self.assertEqual(self.store.convert(self.snapshot, ["*.img"]), 1)
+        target = os.path.join(self.testdest, "restored")
+        self.store.restore_file(self.image + ChunkStore.SUFFIX, target)
+        with open(target, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_locked(self):
+        other = ChunkStore(self.testdest)
+        other.acquire()
+        try:
+            self.assertIsNone(self.store.convert(self.snapshot, ["*.img"]))
+            self.assertTrue(os.path.isfile(self.image))
+        finally:
+            other.release()
@@ -0,0 +1,94 @@
+#   Alexandre's backup script
+#   Copyright © 2014  Alexandre A. de Verteuil
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import configparser
+import io
+import os
+import os.path
+import unittest.mock
+
+from .basic_setup import BasicSetup
+from ..clone import *
+from ..engine import *
+
+
+class TestTreeCloner(BasicSetup):
+
+    def setUp(self):
+        super().setUp()
+        self.source = self.testsource.rstrip("/")
+        os.chdir(self.source)
+        os.makedirs("dir/subdir")
+        open("dir/subdir/file", "w").close()
+        os.symlink("testfile_01_of_20", "link")
+        open("backup.log", "w").close()
+        self.dest = os.path.join(self.testdest, "hourly.wip")
+        os.mkdir(self.dest)
+
+    def test_clone(self):
+        cloner = TreeCloner(workers=4)
+        cloner.clone(self.source, self.dest, exclude=("backup.log",))
+        # 20 files, 1 link, 2 directories and 1 file in them.
+        self.assertEqual(cloner.count, 24)
+        self.assertNotIn("backup.log", os.listdir(self.dest))
+        for path in ("testfile_01_of_20", "link", "dir/subdir/file"):
+            self.assertEqual(
+                os.lstat(os.path.join(self.source, path)).st_ino,
+                os.lstat(os.path.join(self.dest, path)).st_ino,
+                )
+        self.assertTrue(os.path.islink(os.path.join(self.dest, "link")))
+
+    def test_resume(self):
+        os.mkdir(os.path.join(self.dest, "dir"))
+        with open(os.path.join(self.dest, "testfile_01_of_20"), "w") as f:
+            f.write("updated by rsync")
+        cloner = TreeCloner(workers=2)
+        cloner.clone(self.source, self.dest)
+        self.assertEqual(cloner.count, 23)
+        with open(os.path.join(self.dest, "testfile_01_of_20")) as f:
+            self.assertEqual(f.read(), "updated by rsync")
+
+    def test_missing_source(self):
+        with self.assertRaises(FileNotFoundError):
+            TreeCloner(workers=2).clone(
+                os.path.join(self.testdest, "no"),
+                self.dest,
+                )
+
+    @unittest.mock.patch("subprocess.Popen")
+    def test_sync_to_preclone(self, mockpopen):
+        mockpopen().stdout = io.StringIO()
+        mockpopen().stderr = io.StringIO()
+        options = configparser.ConfigParser(
+            defaults={
+                'rsync': "/usr/bin/rsync",
+                'sourcehost': "localhost",
+                'sourcedirs': self.testsource,
+                'dry-run': "False",
+                'configdir': self.configdir,
+                'bw_warn': "0",
+                'bw_err': "0",
+                'preclone': "True",
+                'preclone_workers': "2",
+                }
+            )['DEFAULT']
+        r = rsyncWrapper(options)
+        r.sync_to(self.dest, self.source)
+        r.wait()
+        self.assertEqual(len(os.listdir(self.dest)), 22)
+        args = mockpopen.call_args[0][0]
+        self.assertIn("--link-dest={}".format(self.source), args)
@@ -15,11 +15,13 @@
 #   along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 
+import glob
 import unittest
 import stat
 
 from .basic_setup import BasicSetup
 from ..controller import *
+from ..snapshot import Snapshot
 
 
 class TestController(BasicSetup):
@@ -41,10 +43,10 @@ class TestController(BasicSetup):
             )
         c.run()
         self.assertEqual(os.listdir(self.testdest), ["host_1_0"])
-        dir = os.listdir("host_1_0")[0]
+        dir = glob.glob("host_1_0/hourly.*")[0]
         self.assertEqual(
             sorted(os.listdir(self.testsource)+["backup.log"]),
-            sorted(os.listdir(os.path.join("host_1_0", dir))),
+            sorted(os.listdir(dir)),
             )
 
     def test_dry_run(self):
@@ -69,3 +71,94 @@ class TestController(BasicSetup):
             os.listdir(os.path.join(self.testdest, "host_1_0")),
             [],
             )
+
+    def test_reap(self):
+        trash = os.path.join(self.testdest, ".trash")
+        os.makedirs(os.path.join(trash, "host_1_0.hourly.2014-07-01T00:00"))
+        c = Controller(
+            Configuration(
+                argv=["-c", self.configfile, "--reap", "host_1_0"],
+                environ={},
+                ).configure()
+            )
+        self.assertEqual(c.run(), 0)
+        self.assertEqual(os.listdir(trash), [])
+        self.assertEqual(os.listdir(self.testdest), [".trash"])
+
+    def test_make_filesystem(self):
+        c = Controller(
+            Configuration(
+                argv=["-c", self.configfile, "host_1_0"],
+                environ={},
+                ).configure()
+            )
+        config = c.config["host_1_0"]
+        config['backend'] = "btrfs"
+        config['deferred_delete'] = "yes"
+        fs = c._make_filesystem(config)
+        self.assertIsInstance(fs, BtrfsFilesystem)
+        self.assertIsNotNone(fs.trash)
+        self.assertFalse(fs.sync_deletes)
+        # Freeing space bypasses the trash and waits for btrfs to reclaim
+        # the subvolumes deleted.
+        fs = c._make_filesystem(config, free_space=True)
+        self.assertIsInstance(fs, BtrfsFilesystem)
+        self.assertIsNone(fs.trash)
+        self.assertTrue(fs.sync_deletes)
+
+    def test_no_dedup_with_btrfs(self):
+        c = Controller(
+            Configuration(
+                argv=["-c", self.configfile, "host_1_0"],
+                environ={},
+                ).configure()
+            )
+        config = c.config["host_1_0"]
+        config['backend'] = "btrfs"
+        config['dedup'] = "yes"
+        dir = os.path.join(self.testdest, "host_1_0")
+        os.mkdir(dir)
+        snapshot = Snapshot(dir, "hourly", "2014-07-01T00:00")
+        snapshot.mkdir()
+        for name in ("a", "b"):
+            path = os.path.join(snapshot.path, name)
+            with open(path, "w") as f:
+                f.write("same")
+            os.utime(path, (1404172800, 1404172800))
+        snapshot.infer_status()
+        c._dedup(config, snapshot)
+        # The next snapshot is a copy of this one, updated in place: a
+        # change to a must not reach b.
+        with open(os.path.join(snapshot.path, "a"), "r+") as f:
+            f.write("diff")
+        with open(os.path.join(snapshot.path, "b")) as f:
+            self.assertEqual(f.read(), "same")
+
+    def test_chunked_snapshot_reindexed(self):
+        c = Controller(
+            Configuration(
+                argv=["-c", self.configfile, "host_1_0"],
+                environ={},
+                ).configure()
+            )
+        config = c.config["host_1_0"]
+        config['chunked'] = "*.img"
+        dir = os.path.join(self.testdest, "host_1_0")
+        os.mkdir(dir)
+        for stimestamp in ("2014-07-01T00:00", "2014-07-01T01:00"):
+            snapshot = Snapshot(dir, "hourly", stimestamp)
+            snapshot.mkdir()
+            with open(os.path.join(snapshot.path, "disk.img"), "wb") as f:
+                f.write(os.urandom(100000))
+            snapshot.infer_status()
+        cycle = Cycle(dir, "hourly")
+        c._update_space_index(dir, [cycle])
+        c._chunk_previous(config, cycle)
+        old = cycle.snapshots[1].stimestamp
+        with SpaceIndex(dir) as index:
+            self.assertNotIn(old, index.snapshots)
+        c._update_space_index(dir, [cycle])
+        with SpaceIndex(dir) as index:
+            self.assertIn(old, index.snapshots)
+            # The image is gone, only its recipe is left.
+            self.assertLess(index.usage()[old][0], 100000)
@@ -128,6 +128,16 @@ class TestCycle(BasicSetup):
         cycle = Cycle(self.testdest, "hourly")
         self.assertEqual(cycle.snapshots, [])
 
+    def test_lock_timeout(self):
+        os.mkdir(os.path.join(self.testdest, "daily.2014-07-01T00:00"))
+        cycle = Cycle(self.testdest, "daily", lock_timeout=30)
+        self.assertEqual(cycle.lock_timeout, 30)
+        self.assertEqual(cycle.snapshots[0].lock_timeout, 30)
+        # Other instances keep the default.
+        cycle = Cycle(self.testdest, "daily")
+        self.assertEqual(cycle.lock_timeout, 0)
+        self.assertEqual(cycle.snapshots[0].lock_timeout, 0)
+
     def test_get_linkdest(self):
         cycle = Cycle(self.testdest, "hourly")
         config = Configuration(
@@ -194,6 +204,7 @@ class TestCycle(BasicSetup):
             os.listdir(self.testdest),
             ["hourly.2014-07-04T00:00"],
             )
+        self.assertEqual((c.purged, c.deleted), (3, 3))
 
     def test_purge_nothing(self):
         c = Cycle(self.testdest, "hourly")
@@ -256,6 +267,8 @@ class TestCycle(BasicSetup):
                 "hourly.2014-07-01T04:00",
                 ],
             )
+        self.assertEqual((c.purged, c.deleted), (3, 0))
+        self.assertEqual(c.overflow_cycle[0].deleted, 2)
 
     def test_feed_to_cycle_large_amount_of_snapshots(self):
         # Preparation
@@ -305,6 +318,30 @@ class TestCycle(BasicSetup):
                 ]
             )
 
+    def test_create_alias_if_unchanged(self):
+        os.chdir(self.testdest)
+        os.mkdir("hourly.2014-07-01T00:00")
+        open("hourly.2014-07-01T00:00/file", "w").close()
+        cycle = Cycle(self.testdest, "hourly")
+        configuration = Configuration(argv=["-c", self.configfile], environ={})
+        config = configuration.configure()
+        rsync = rsyncWrapper(config['default'])
+        rsync.is_unchanged = unittest.mock.Mock(return_value=True)
+        rsync.sync_to = unittest.mock.Mock()
+        with cycle:
+            cycle.create_new_snapshot(rsync)
+        rsync.is_unchanged.assert_called_with(
+            os.path.join(self.testdest, "hourly.2014-07-01T00:00"),
+            )
+        self.assertFalse(rsync.sync_to.called)
+        self.assertEqual(len(cycle.snapshots), 2)
+        alias = cycle.snapshots[0]
+        self.assertTrue(alias.is_alias)
+        self.assertEqual(alias.status, Status.complete)
+        self.assertEqual(os.readlink(alias.path), "hourly.2014-07-01T00:00")
+        # The next link-dest is the tree, not the alias.
+        self.assertEqual(cycle.get_linkdest().path, cycle.snapshots[1].path)
+
     def test_error_code_unknown(self):
         # Test the case when rsync exits with an error code that is not
         # in RSYNC_ERROR_CODES. It should just abort and log that an
@@ -0,0 +1,117 @@
+#   Alexandre's backup script
+#   Copyright © 2014  Alexandre A. de Verteuil
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import os.path
+import shutil
+
+from .basic_setup import BasicSetup
+from ..dedup import *
+from ..snapshot import *
+
+
+class TestDeduplicator(BasicSetup):
+
+    def make_snapshot(self, host, stimestamp, files):
+        """Create a complete snapshot holding files, a {name: content} dict.
+
+        All files get the same modification time.
+        """
+        dir = os.path.join(self.testdest, host)
+        os.makedirs(dir, exist_ok=True)
+        snapshot = Snapshot(dir, "hourly", stimestamp)
+        snapshot.mkdir()
+        for name, content in files.items():
+            path = os.path.join(snapshot.path, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(content)
+            os.utime(path, (1404172800, 1404172800))
+        snapshot.infer_status()
+        return snapshot
+
+    def ino(self, snapshot, name):
+        return os.stat(os.path.join(snapshot.path, name)).st_ino
+
+    def test_renamed_and_other_host(self):
+        s1 = self.make_snapshot(
+            "host_1", "2014-07-01T00:00", {"a": "alpha", "b": "beta"},
+            )
+        s2 = self.make_snapshot(
+            "host_1", "2014-07-01T01:00", {"dir/renamed": "alpha", "c": "c"},
+            )
+        s3 = self.make_snapshot(
+            "host_2", "2014-07-01T01:00", {"b": "beta", "copy": "beta"},
+            )
+        with Deduplicator(self.testdest) as dedup:
+            dedup.dedup(s1)
+            self.assertEqual((dedup.hashed, dedup.linked), (2, 0))
+            dedup.dedup(s2)
+            self.assertEqual((dedup.hashed, dedup.linked), (2, 1))
+            dedup.dedup(s3)
+            self.assertEqual((dedup.hashed, dedup.linked), (2, 2))
+        self.assertEqual(self.ino(s1, "a"), self.ino(s2, "dir/renamed"))
+        self.assertEqual(self.ino(s1, "b"), self.ino(s3, "b"))
+        self.assertEqual(self.ino(s1, "b"), self.ino(s3, "copy"))
+        self.assertEqual(os.stat(os.path.join(s1.path, "b")).st_nlink, 3)
+        # No temporary file left behind.
+        self.assertEqual(sorted(os.listdir(s3.path)), ["b", "copy"])
+
+    def test_metadata_must_match(self):
+        s1 = self.make_snapshot("host_1", "2014-07-01T00:00", {"a": "alpha"})
+        s2 = self.make_snapshot(
+            "host_1", "2014-07-01T01:00", {"a": "alpha", "b": "alpha"},
+            )
+        os.utime(os.path.join(s2.path, "a"), (0, 0))
+        os.chmod(os.path.join(s2.path, "b"), 0o600)
+        with Deduplicator(self.testdest) as dedup:
+            dedup.dedup(s1)
+            dedup.dedup(s2)
+            self.assertEqual(dedup.linked, 0)
+
+    def test_link_max(self):
+        s1 = self.make_snapshot(
+            "host_1", "2014-07-01T00:00", {"a": "x", "b": "x", "c": "x"},
+            )
+        with Deduplicator(self.testdest, link_max=2) as dedup:
+            dedup.dedup(s1)
+            self.assertEqual(dedup.linked, 1)
+            self.assertEqual(dedup.rotated, 1)
+        # a and b are linked together, c is a new original.
+        inodes = {self.ino(s1, name) for name in ("a", "b", "c")}
+        self.assertEqual(len(inodes), 2)
+
+    def test_cycle_change_and_deletion(self):
+        s1 = self.make_snapshot("host_1", "2014-07-01T00:00", {"a": "alpha"})
+        with Deduplicator(self.testdest) as dedup:
+            dedup.dedup(s1)
+        # Records follow the snapshot to the daily cycle.
+        with s1:
+            s1.interval = "daily"
+        s2 = self.make_snapshot("host_1", "2014-07-01T01:00", {"b": "alpha"})
+        with Deduplicator(self.testdest) as dedup:
+            dedup.dedup(s2)
+            self.assertEqual(dedup.linked, 1)
+        shutil.rmtree(s1.path)
+        shutil.rmtree(s2.path)
+        # Records of deleted snapshots are forgotten.
+        s3 = self.make_snapshot("host_1", "2014-07-01T02:00", {"c": "alpha"})
+        with Deduplicator(self.testdest) as dedup:
+            dedup.dedup(s3)
+            self.assertEqual(dedup.linked, 0)
+            count = dedup._db.execute("SELECT COUNT(*) FROM files")
+            self.assertEqual(count.fetchone()[0], 1)
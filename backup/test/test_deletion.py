@@ -0,0 +1,74 @@
+#   Alexandre's backup script
+#   Copyright © 2014  Alexandre A. de Verteuil
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+
+from .basic_setup import BasicSetup
+from ..deletion import *
+from ..filesystem import PosixFilesystem
+from ..snapshot import *
+
+
+class TestTreeDeleter(BasicSetup):
+
+    def make_tree(self, root, depth=3, width=3):
+        """Create a tree of directories, files and symlinks."""
+        os.mkdir(root)
+        for i in range(width):
+            open(os.path.join(root, "file{}".format(i)), "w").close()
+        # This symlink must be removed, not followed.
+        os.symlink(self.testsource, os.path.join(root, "link"))
+        if depth > 0:
+            for i in range(width):
+                self.make_tree(
+                    os.path.join(root, "dir{}".format(i)),
+                    depth - 1,
+                    width,
+                    )
+
+    def test_rmtree(self):
+        root = os.path.join(self.testdest, "tree")
+        self.make_tree(root)
+        deleter = TreeDeleter(workers=4)
+        deleter.rmtree(root)
+        self.assertEqual(os.listdir(self.testdest), [])
+        # 40 directories, each holding 3 files and 1 symlink.
+        self.assertEqual(deleter.count, 40 * 5)
+        # The symlink target was left alone.
+        self.assertEqual(len(os.listdir(self.testsource)), 20)
+
+    def test_resume_partial_tree(self):
+        root = os.path.join(self.testdest, "tree")
+        self.make_tree(root, depth=1)
+        os.unlink(os.path.join(root, "file0"))
+        os.unlink(os.path.join(root, "dir0", "file0"))
+        TreeDeleter(workers=2).rmtree(root)
+        self.assertEqual(os.listdir(self.testdest), [])
+
+    def test_missing_tree(self):
+        with self.assertRaises(FileNotFoundError):
+            TreeDeleter(workers=2).rmtree(os.path.join(self.testdest, "no"))
+
+    def test_snapshot_delete(self):
+        fs = PosixFilesystem(delete_workers=3)
+        s = Snapshot(self.testdest, "hourly", fs=fs)
+        s.mkdir()
+        self.make_tree(os.path.join(s.path, "data"), depth=2)
+        with s:
+            s.delete()
+        self.assertEqual(s.status, Status.deleted)
+        self.assertEqual(os.listdir(self.testdest), [])
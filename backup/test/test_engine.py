@@ -131,6 +131,25 @@ class TestEngine(BasicSetup):
         self.assertIn("--exclude-from={}".format(excludefile), r.args)
         self.assertIn( "--filter=merge {}".format(filterfile), r.args)
 
+    @unittest.mock.patch("subprocess.run")
+    def test_is_unchanged(self, mockrun):
+        r = rsyncWrapper(self.minimal_options)
+        self.assertFalse(r.is_unchanged("/foo/snapshot"))
+        self.assertFalse(mockrun.called)  # skip_unchanged is not set.
+        self.minimal_options['skip_unchanged'] = "True"
+        mockrun.return_value = subprocess.CompletedProcess([], 0, "", "")
+        self.assertTrue(r.is_unchanged("/foo/snapshot"))
+        args = mockrun.call_args[0][0]
+        self.assertEqual(args[1:3], ["--dry-run", "--itemize-changes"])
+        self.assertNotIn("--verbose", args)
+        self.assertEqual(args[-2:], [self.testsource, "/foo/snapshot"])
+        mockrun.return_value = subprocess.CompletedProcess(
+            [], 0, ">f.st...... testfile_01_of_20\n", "",
+            )
+        self.assertFalse(r.is_unchanged("/foo/snapshot"))
+        mockrun.return_value = subprocess.CompletedProcess([], 23, "", "")
+        self.assertFalse(r.is_unchanged("/foo/snapshot"))
+
     @unittest.mock.patch("subprocess.Popen")
     @unittest.mock.patch("backup.engine.PipeLogger")
     def test_wait(self, mockpl, mockpopen):
@@ -0,0 +1,66 @@
+#   Alexandre's backup script
+#   Copyright © 2014  Alexandre A. de Verteuil
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import os
+import os.path
+
+from .basic_setup import BasicSetup
+from .. import events
+from ..snapshot import Snapshot, Status
+
+
+class TestEventLog(BasicSetup):
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.testdest, "events.jsonl")
+        events.start(self.path)
+        self.addCleanup(events.stop)
+
+    def read_events(self):
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_emit(self):
+        events.emit("host_start", host="localhost")
+        events.emit("host_end", host="localhost", status="ok", bytes=10)
+        records = self.read_events()
+        self.assertEqual(
+            [record['event'] for record in records],
+            ["host_start", "host_end"],
+            )
+        self.assertEqual(records[1]['bytes'], 10)
+        self.assertEqual(records[1]['pid'], os.getpid())
+        self.assertIsInstance(records[1]['time'], float)
+
+    def test_status_transitions(self):
+        snapshot = Snapshot(self.testdest, "hourly")
+        snapshot.mkdir()
+        snapshot.status = Status.syncing
+        self.assertEqual(
+            [
+                (record['old'], record['new'])
+                for record in self.read_events()
+                ],
+            [("void", "blank"), ("blank", "syncing")],
+            )
+
+    def test_stopped(self):
+        events.stop()
+        events.emit("host_start", host="localhost")
+        self.assertFalse(os.path.exists(self.path))
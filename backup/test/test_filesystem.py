@@ -0,0 +1,255 @@
+#   Alexandre's backup script
+#   Copyright © 2014  Alexandre A. de Verteuil
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import datetime
+import os
+import os.path
+import tempfile
+import unittest
+import unittest.mock
+
+from ..cycle import *
+from ..filesystem import *
+from ..locking import *
+from ..snapshot import *
+
+
+class TestMemoryFilesystem(unittest.TestCase):
+
+    def setUp(self):
+        self.fs = MemoryFilesystem()
+        self.fs.makedirs("/dest/host")
+
+    def test_files_and_directories(self):
+        fs = self.fs
+        self.assertTrue(fs.isdir("/dest/host"))
+        self.assertFalse(fs.exists("/dest/host/a"))
+        fs.write_text("/dest/host/a", "1")
+        self.assertEqual(fs.read_text("/dest/host/a"), "1")
+        self.assertFalse(fs.isdir("/dest/host/a"))
+        with self.assertRaises(FileNotFoundError):
+            fs.read_text("/dest/host/b")
+        with self.assertRaises(FileExistsError):
+            fs.mkdir("/dest/host")
+        with self.assertRaises(FileNotFoundError):
+            fs.mkdir("/nowhere/dir")
+        with self.assertRaises(OSError):
+            fs.rmdir("/dest/host")  # Not empty.
+        fs.remove("/dest/host/a")
+        fs.rmdir("/dest/host")
+        self.assertEqual(fs.listdir("/dest"), [])
+
+    def test_rename_and_rmtree(self):
+        fs = self.fs
+        old = "/dest/host/hourly.wip"
+        new = "/dest/host/hourly.2014-07-01T00:00"
+        fs.mkdir(old)
+        fs.write_text(old + "/file", "content")
+        fs.rename(old, new)
+        self.assertEqual(fs.read_text(new + "/file"), "content")
+        self.assertFalse(fs.exists(old))
+        fs.rmtree(new)
+        self.assertEqual(fs.listdir("/dest/host"), [])
+
+    def test_glob(self):
+        fs = self.fs
+        for name in ("hourly.a", "hourly.b", "daily.a", ".hourly.a.lock"):
+            fs.mkdir("/dest/host/" + name)
+        self.assertEqual(
+            sorted(fs.glob("/dest/host/hourly.*")),
+            ["/dest/host/hourly.a", "/dest/host/hourly.b"],
+            )
+        self.assertEqual(
+            fs.glob("/dest/host/.hourly.*"),
+            ["/dest/host/.hourly.a.lock"],
+            )
+        self.assertEqual(fs.glob("/nowhere/*"), [])
+
+    def test_symlinks(self):
+        fs = self.fs
+        fs.mkdir("/dest/host/hourly.a")
+        fs.write_text("/dest/host/hourly.a/file", "content")
+        fs.symlink("hourly.a", "/dest/host/hourly.b")
+        self.assertTrue(fs.islink("/dest/host/hourly.b"))
+        self.assertFalse(fs.islink("/dest/host/hourly.a"))
+        self.assertEqual(fs.readlink("/dest/host/hourly.b"), "hourly.a")
+        self.assertTrue(fs.isdir("/dest/host/hourly.b"))
+        self.assertEqual(fs.read_text("/dest/host/hourly.b/file"), "content")
+        with self.assertRaises(OSError):
+            fs.rmtree("/dest/host/hourly.b")
+        # The link is removed, not its target.
+        fs.remove("/dest/host/hourly.b")
+        self.assertEqual(fs.listdir("/dest/host"), ["hourly.a"])
+        fs.symlink("nowhere", "/dest/host/dangling")
+        self.assertFalse(fs.exists("/dest/host/dangling"))
+        self.assertTrue(fs.islink("/dest/host/dangling"))
+
+
+class TestInMemorySnapshots(unittest.TestCase):
+
+    """Snapshot, Cycle and Lockable running without touching the disk."""
+
+    dir = "/dest/host"
+
+    def setUp(self):
+        self.fs = MemoryFilesystem()
+        self.fs.makedirs(self.dir)
+
+    def make_snapshots(self, interval, timestamps):
+        for timestamp in timestamps:
+            path = "{}/{}.{}".format(self.dir, interval, timestamp)
+            self.fs.mkdir(path)
+            self.fs.write_text(path + "/file", "")
+
+    def test_status_and_locking(self):
+        s = Snapshot(self.dir, "hourly", fs=self.fs)
+        self.assertEqual(s.status, Status.void)
+        s.mkdir()
+        self.assertEqual(s.status, Status.blank)
+        with s:
+            s.status = Status.syncing
+            self.assertEqual(
+                sorted(self.fs.listdir(self.dir)),
+                [".hourly.wip.lock", ".hourly.wip.status", "hourly.wip"],
+                )
+            other = Snapshot.from_index(self.dir, "hourly", 0, fs=self.fs)
+            self.assertEqual(other.status, Status.syncing)
+            with self.assertRaises(AlreadyLocked):
+                other.acquire()
+            s.status = Status.complete
+            s.timestamp = datetime.datetime(2014, 7, 1)
+        self.assertEqual(
+            self.fs.listdir(self.dir),
+            ["hourly.2014-07-01T00:00"],
+            )
+        with s:
+            s.delete()
+        self.assertEqual(self.fs.listdir(self.dir), [])
+
+    def test_purge_with_feed_to_cycle(self):
+        self.make_snapshots(
+            "hourly",
+            ["2014-07-01T{:02}:00".format(h) for h in range(1, 5)],
+            )
+        c = Cycle(self.dir, "hourly", fs=self.fs)
+        c.overflow_cycle = (Cycle(self.dir, "daily", fs=self.fs), 1)
+        c.purge(1)
+        self.assertEqual(
+            sorted(self.fs.listdir(self.dir)),
+            ["daily.2014-07-01T01:00", "hourly.2014-07-01T04:00"],
+            )
+
+    def test_aliases(self):
+        self.make_snapshots("hourly", ["2014-07-01T01:00"])
+        c = Cycle(self.dir, "hourly", fs=self.fs)
+        target = c.snapshots[0]
+        for timestamp in ("2014-07-01T02:00", "2014-07-01T03:00"):
+            alias = Snapshot(self.dir, "hourly", timestamp, fs=self.fs)
+            with alias:
+                alias.make_alias(target)
+            self.assertEqual(alias.status, Status.complete)
+            self.assertTrue(alias.is_alias)
+            c.snapshots.insert(0, alias)
+        self.assertEqual(c.get_linkdest().path, target.path)
+        self.assertEqual(len(target.aliases()), 2)
+        # Aliases follow their target to an other cycle.
+        c.overflow_cycle = (Cycle(self.dir, "daily", fs=self.fs), 1)
+        c.purge(2)
+        self.assertEqual(
+            self.fs.readlink(self.dir + "/hourly.2014-07-01T03:00"),
+            "daily.2014-07-01T01:00",
+            )
+        # Deleting the target moves its tree to the newest alias.
+        target = Snapshot.from_path(
+            self.dir + "/daily.2014-07-01T01:00", fs=self.fs,
+            )
+        with target:
+            target.delete()
+        self.assertFalse(self.fs.islink(self.dir + "/hourly.2014-07-01T03:00"))
+        self.assertEqual(
+            self.fs.readlink(self.dir + "/hourly.2014-07-01T02:00"),
+            "hourly.2014-07-01T03:00",
+            )
+        self.assertEqual(
+            sorted(self.fs.listdir(self.dir)),
+            ["hourly.2014-07-01T02:00", "hourly.2014-07-01T03:00"],
+            )
+        # Deleting an alias only removes the link.
+        alias = Snapshot.from_path(
+            self.dir + "/hourly.2014-07-01T02:00", fs=self.fs,
+            )
+        with alias:
+            alias.delete()
+        self.assertEqual(
+            self.fs.listdir(self.dir + "/hourly.2014-07-01T03:00"),
+            ["file"],
+            )
+
+    def test_native_snapshots(self):
+        self.fs.native_snapshots = True
+        self.make_snapshots("hourly", ["2014-07-01T01:00"])
+        c = Cycle(self.dir, "hourly", fs=self.fs)
+        engine = unittest.mock.Mock()
+        engine.parts = [None]
+        engine.is_unchanged.return_value = False
+        engine.wait.return_value = 0
+        engine.kill_switch_event.is_set.return_value = False
+        c.create_new_snapshot(engine)
+        # The new snapshot starts as a copy, rsync gets no link-dest.
+        new = c.snapshots[0]
+        engine.sync_to.assert_called_once_with(
+            self.dir + "/hourly.wip", None, None,
+            )
+        self.assertEqual(new.status, Status.complete)
+        self.assertEqual(self.fs.listdir(new.path), ["file"])
+        self.fs.write_text(new.path + "/file", "changed")
+        self.assertEqual(
+            self.fs.read_text(c.snapshots[1].path + "/file"),
+            "",
+            )
+        with new:
+            new.delete()
+        self.assertFalse(self.fs.exists(new.path))
+
+
+@unittest.skipUnless(
+    os.environ.get("BACKUP_TEST_BTRFS"),
+    "Set BACKUP_TEST_BTRFS to a directory on btrfs, e.g. a loopback image.",
+    )
+class TestBtrfsFilesystem(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(dir=os.environ["BACKUP_TEST_BTRFS"])
+        self.fs = BtrfsFilesystem()
+
+    def tearDown(self):
+        for name in os.listdir(self.dir):
+            self.fs.rmsnapshotdir(os.path.join(self.dir, name))
+        os.rmdir(self.dir)
+
+    def test_snapshots(self):
+        first = os.path.join(self.dir, "hourly.1")
+        second = os.path.join(self.dir, "hourly.2")
+        self.fs.mksnapshotdir(first)
+        self.assertTrue(self.fs.is_subvolume(first))
+        self.fs.write_text(os.path.join(first, "file"), "first")
+        self.fs.mksnapshotdir(second, first)
+        self.fs.write_text(os.path.join(second, "file"), "second")
+        self.assertEqual(self.fs.read_text(first + "/file"), "first")
+        self.fs.rmsnapshotdir(first)
+        self.assertFalse(self.fs.exists(first))
+        self.assertEqual(self.fs.read_text(second + "/file"), "second")
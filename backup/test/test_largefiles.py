@@ -0,0 +1,148 @@
+#   Alexandre's backup script
+#   Copyright © 2014  Alexandre A. de Verteuil
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import configparser
+import os
+import os.path
+
+from .basic_setup import BasicSetup
+from ..engine import *
+from ..largefiles import *
+
+
+class TestLargeFiles(BasicSetup):
+
+    def setUp(self):
+        super().setUp()
+        self.old = os.path.join(self.testdest, "hourly.2014-07-01T00:00")
+        self.new = os.path.join(self.testdest, "hourly.wip")
+        os.makedirs(os.path.join(self.old, "vm"))
+        os.mkdir(self.new)
+        for name in ("vm/disk.img", "vm/notes.txt", "db.img"):
+            with open(os.path.join(self.old, name), "w") as f:
+                f.write("x" * 10000)
+            os.utime(os.path.join(self.old, name), (1404172800, 1404172800))
+
+    def test_reflink(self):
+        src = os.path.join(self.old, "db.img")
+        dst = os.path.join(self.new, "db.img")
+        method = reflink(src, dst)
+        self.assertIn(method, ("reflink", "copy_file_range", "copy"))
+        self.assertNotEqual(os.stat(src).st_ino, os.stat(dst).st_ino)
+        with open(dst) as f:
+            self.assertEqual(f.read(), "x" * 10000)
+        self.assertEqual(os.stat(dst).st_mtime, 1404172800)
+        with self.assertRaises(FileExistsError):
+            reflink(src, dst)
+
+    def test_matches(self):
+        large_files = LargeFiles(["*.img", "/vm/*.txt"])
+        self.assertTrue(large_files.matches("db.img"))
+        self.assertTrue(large_files.matches("vm/disk.img"))
+        self.assertTrue(large_files.matches("vm/notes.txt"))
+        self.assertFalse(large_files.matches("notes.txt"))
+        self.assertEqual(large_files.rsync_patterns, ["*.img", "/vm/*.txt"])
+
+    def test_seed(self):
+        # As if preclone had linked it.
+        os.link(
+            os.path.join(self.old, "db.img"),
+            os.path.join(self.new, "db.img"),
+            )
+        count = LargeFiles(["*.img"]).seed(self.old, self.new)
+        self.assertEqual(count, 2)
+        for name in ("vm/disk.img", "db.img"):
+            st = os.stat(os.path.join(self.new, name))
+            self.assertEqual(st.st_nlink, 1)
+            self.assertEqual(st.st_mtime, 1404172800)
+        self.assertEqual(
+            os.listdir(os.path.join(self.new, "vm")),
+            ["disk.img"],
+            )
+        self.assertEqual(os.stat(os.path.join(self.old, "db.img")).st_nlink, 1)
+        # Nothing left to do.
+        self.assertEqual(LargeFiles(["*.img"]).seed(self.old, self.new), 0)
+
+    def test_engine_parts(self):
+        options = configparser.ConfigParser(
+            defaults={
+                'rsync': "/usr/bin/rsync",
+                'sourcehost': "localhost",
+                'sourcedirs': self.testsource,
+                'dry-run': "False",
+                'configdir': self.configdir,
+                'large_files': "*.img",
+                }
+            )['DEFAULT']
+        r = rsyncWrapper(options)
+        self.assertEqual(r.parts, ["main", "large"])
+        self.assertNotIn("--exclude=*.img", r.args)
+        main = r._args("main")
+        self.assertIn("--exclude=*.img", main)
+        self.assertIn("--partial-dir=.rsync-partial", main)
+        large = r._args("large")
+        self.assertIn("--inplace", large)
+        self.assertNotIn("--partial-dir=.rsync-partial", large)
+        self.assertEqual(
+            large[-4:],
+            [
+                "--include=*/", "--include=*.img", "--exclude=*",
+                self.testsource,
+                ],
+            )
+        options['large_files'] = ""
+        self.assertEqual(rsyncWrapper(options).parts, [None])
+
+    def test_engine_append_parts(self):
+        options = configparser.ConfigParser(
+            defaults={
+                'rsync': "/usr/bin/rsync",
+                'sourcehost': "localhost",
+                'sourcedirs': self.testsource,
+                'dry-run': "False",
+                'configdir': self.configdir,
+                'append_only': "/var/log/*",
+                }
+            )['DEFAULT']
+        r = rsyncWrapper(options)
+        self.assertEqual(r.parts, ["main", "append", "rotated"])
+        self.assertIn("--exclude=/var/log/*", r._args("main"))
+        append = r._args("append")
+        self.assertIn("--append-verify", append)
+        self.assertNotIn("--partial-dir=.rsync-partial", append)
+        self.assertEqual(
+            append[-4:],
+            [
+                "--include=*/", "--include=/var/log/*", "--exclude=*",
+                self.testsource,
+                ],
+            )
+        rotated = r._args("rotated")
+        self.assertIn("--inplace", rotated)
+        self.assertNotIn("--append-verify", rotated)
+        # Large files are left to the large part.
+        options['large_files'] = "*.img"
+        r = rsyncWrapper(options)
+        self.assertEqual(r.parts, ["main", "large", "append", "rotated"])
+        main = r._args("main")
+        self.assertIn("--exclude=*.img", main)
+        self.assertIn("--exclude=/var/log/*", main)
+        append = r._args("append")
+        self.assertLess(
+            append.index("--exclude=*.img"),
+            append.index("--include=/var/log/*"),
+            )
@@ -0,0 +1,63 @@
+#   Alexandre's backup script
+#   Copyright © 2014  Alexandre A. de Verteuil
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import os.path
+import shutil
+
+from .basic_setup import BasicSetup
+from ..links import *
+
+
+class TestLinkRotator(BasicSetup):
+
+    def setUp(self):
+        super().setUp()
+        self.new = os.path.join(self.testdest, "new")
+        shutil.copytree(self.testsource, self.new)
+        self.path = os.path.join(self.new, "testfile_01_of_20")
+        os.chmod(self.path, 0o640)
+        # Two older snapshots share the file.
+        for name in ("old1", "old2"):
+            os.link(self.path, os.path.join(self.testdest, name))
+        # Rotate at 3 links.
+        self.margin = link_max(self.testdest) - 3
+
+    def test_rotate(self):
+        st = os.stat(self.path)
+        rotator = LinkRotator(self.testdest, self.margin)
+        self.assertEqual(rotator.ceiling, 3)
+        self.assertEqual(rotator.rotate(self.new), 1)
+        new_st = os.stat(self.path)
+        self.assertNotEqual(new_st.st_ino, st.st_ino)
+        self.assertEqual(new_st.st_nlink, 1)
+        self.assertEqual(new_st.st_mode, st.st_mode)
+        self.assertEqual(new_st.st_mtime_ns, st.st_mtime_ns)
+        with open(self.path) as f, \
+                open(os.path.join(self.testdest, "old1")) as g:
+            self.assertEqual(f.read(), g.read())
+        self.assertEqual(
+            os.stat(os.path.join(self.testdest, "old1")).st_nlink, 2,
+            )
+        # Nothing left to do.
+        self.assertEqual(rotator.rotate(self.new), 0)
+
+    def test_below_ceiling(self):
+        os.unlink(os.path.join(self.testdest, "old2"))
+        rotator = LinkRotator(self.testdest, self.margin)
+        self.assertEqual(rotator.rotate(self.new), 0)
+        self.assertEqual(os.stat(self.path).st_nlink, 2)
@@ -0,0 +1,230 @@
+#   Alexandre's backup script
+#   Copyright © 2014  Alexandre A. de Verteuil
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import os.path
+import subprocess
+import sys
+import threading
+import time
+import unittest.mock
+
+from .basic_setup import BasicSetup
+from .. import filesystem
+from ..locking import *
+
+
+class Resource(Lockable):
+
+    def __init__(self, path):
+        self.path = path
+        self.lockfile = path + ".lock"
+
+
+class TestLockable(BasicSetup):
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.testdest, "resource")
+
+    def test_unlinked_on_release(self):
+        resource = Resource(self.path)
+        with resource:
+            self.assertTrue(resource.is_locked())
+            self.assertTrue(resource.i_am_locking())
+        self.assertFalse(os.path.exists(resource.lockfile))
+        # A file left behind is not a lock.
+        open(resource.lockfile, "w").close()
+        self.assertFalse(resource.is_locked())
+        with resource:
+            pass
+
+    def test_released_when_process_dies(self):
+        resource = Resource(self.path)
+        child = subprocess.Popen(
+            [
+                sys.executable, "-c",
+                "import fcntl, os, sys, time\n"
+                "fd = os.open(sys.argv[1], os.O_RDWR | os.O_CREAT)\n"
+                "fcntl.flock(fd, fcntl.LOCK_EX)\n"
+                "print(flush=True)\n"
+                "time.sleep(60)\n",
+                resource.lockfile,
+                ],
+            stdout=subprocess.PIPE,
+            )
+        child.stdout.readline()
+        try:
+            with self.assertRaises(AlreadyLocked):
+                resource.acquire()
+        finally:
+            child.kill()
+            child.wait()
+            child.stdout.close()
+        with resource:
+            pass
+
+    def test_legacy_lock(self):
+        resource = Resource(self.path)
+        os.mkdir(resource.lockfile)
+        marker = os.path.join(resource.lockfile, "{}.1.2".format(os.getpid()))
+        open(marker, "w").close()
+        self.assertTrue(resource.is_locked())
+        with self.assertRaises(AlreadyLocked):
+            resource.acquire()
+        # The process is gone.
+        child = subprocess.Popen([sys.executable, "-c", ""])
+        child.wait()
+        os.rename(
+            marker,
+            os.path.join(resource.lockfile, "{}.1.2".format(child.pid)),
+            )
+        self.assertFalse(resource.is_locked())
+        with resource:
+            self.assertTrue(os.path.isfile(resource.lockfile))
+
+    def test_timeout(self):
+        holder = Resource(self.path)
+        waiter = Resource(self.path)
+        locked = threading.Event()
+        def hold():
+            with holder:
+                locked.set()
+                time.sleep(0.5)
+        thread = threading.Thread(target=hold)
+        thread.start()
+        locked.wait()
+        start = time.monotonic()
+        with self.assertRaises(LockTimeout):
+            waiter.acquire(timeout=0.2)
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        # Released while waiting.
+        waiter.acquire(timeout=5)
+        thread.join()
+        self.assertTrue(waiter.i_am_locking())
+        waiter.release()
+
+    def test_shared(self):
+        for fs in (filesystem.default, filesystem.MemoryFilesystem()):
+            fs.makedirs(self.testdest)
+            readers = [Resource(self.path), Resource(self.path)]
+            writer = Resource(self.path)
+            for resource in readers + [writer]:
+                resource.fs = fs
+            readers[0].acquire(shared=True)
+            with readers[1].shared():
+                self.assertTrue(writer.is_locked())
+                self.assertFalse(writer.is_locked(exclusive=True))
+                with self.assertRaises(AlreadyLocked):
+                    writer.acquire()
+            # The other reader still holds the lock file.
+            self.assertTrue(fs.exists(writer.lockfile))
+            with self.assertRaises(AlreadyLocked):
+                writer.acquire()
+            readers[0].release()
+            self.assertFalse(fs.exists(writer.lockfile))
+            with writer:
+                self.assertTrue(readers[0].is_locked(exclusive=True))
+                with self.assertRaises(AlreadyLocked):
+                    readers[0].acquire(shared=True)
+
+    def test_momentary_conflict(self):
+        fs = filesystem.default
+        lockfile = Resource(self.path).lockfile
+        # An other process probing the file.
+        fd = fs.lock(lockfile)
+        def release():
+            time.sleep(0.01)
+            os.close(fd)
+        thread = threading.Thread(target=release)
+        thread.start()
+        reader = Resource(self.path)
+        reader.acquire(shared=True)
+        thread.join()
+        self.assertTrue(reader.i_am_locking())
+        reader.release()
+        self.assertFalse(os.path.exists(lockfile))
+
+    def test_lock_file_removed_by_last_reader(self):
+        fs = filesystem.PosixFilesystem()
+        fs.lock_retries = (0, 0)
+        lockfile = Resource(self.path).lockfile
+        flock = filesystem.fcntl.flock
+        calls = []
+        def upgraded_by_last_reader(fd, operation):
+            # The last reader holds LOCK_EX and removes the file.
+            calls.append(operation)
+            if len(calls) == 1:
+                os.remove(lockfile)
+                raise BlockingIOError()
+            flock(fd, operation)
+        with unittest.mock.patch.object(
+            filesystem.fcntl, "flock", upgraded_by_last_reader,
+            ):
+            handle = fs.lock(lockfile, shared=True)
+        self.assertEqual(len(calls), 2)
+        self.assertTrue(fs.owns(handle, lockfile))
+        fs.unlock(handle, lockfile)
+
+
+class TestSyncSemaphore(BasicSetup):
+
+    def test_slots(self):
+        holders = [SyncSemaphore(self.testdest, 2) for i in range(2)]
+        for semaphore in holders:
+            semaphore.acquire()
+        waiter = SyncSemaphore(self.testdest, 2)
+        synced = threading.Event()
+        def sync():
+            with waiter:
+                synced.set()
+        thread = threading.Thread(target=sync)
+        thread.start()
+        self.assertFalse(synced.wait(0.3))
+        holders[0].release()
+        self.assertTrue(synced.wait(5))
+        thread.join()
+        holders[1].release()
+        self.assertEqual(os.listdir(waiter.path), [])
+
+    def test_fifo(self):
+        holder = SyncSemaphore(self.testdest, 1)
+        holder.acquire()
+        order = []
+        def sync(n):
+            with SyncSemaphore(self.testdest, 1):
+                order.append(n)
+        threads = []
+        for n in range(3):
+            threads.append(threading.Thread(target=sync, args=(n,)))
+            threads[-1].start()
+            # Wait for the ticket of this thread.
+            while len(os.listdir(holder.path)) < n + 2:
+                time.sleep(0.01)
+        holder.release()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, [0, 1, 2])
+
+    def test_stale_ticket(self):
+        semaphore = SyncSemaphore(self.testdest, 1)
+        os.makedirs(semaphore.path)
+        stale = os.path.join(semaphore.path, "{:020d}.1.ticket".format(0))
+        open(stale, "w").close()
+        with semaphore:
+            pass
+        self.assertEqual(os.listdir(semaphore.path), [])
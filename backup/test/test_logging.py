@@ -18,7 +18,9 @@
 import unittest
 import unittest.mock
 
+import gzip
 import logging
+import lzma
 import os
 
 from .basic_setup import BasicSetup
@@ -30,7 +32,7 @@ class TestConfiguration(BasicSetup):
     def test_init_ManualFlushMemoryHandler(self):
         h = ManualFlushMemoryHandler(0)
 
-    def test_log_events_and_keep_buffer_even_when_flushed(self):
+    def test_log_events_and_empty_buffer_when_flushed(self):
         handler = ManualFlushMemoryHandler(0)
         mockhandler = unittest.mock.Mock()
         logger = logging.getLogger("test")
@@ -41,10 +43,37 @@ class TestConfiguration(BasicSetup):
         logger.warning("warning")
         logger.error("error")
         handler.setTarget(mockhandler)
-        buffer_before_flush = handler.buffer.copy()
+        buffer_before_flush = list(handler.buffer)
         handler.flush()
-        self.assertEqual(len(handler.buffer), 4)
-        self.assertEqual(handler.buffer, buffer_before_flush)
+        self.assertEqual(len(handler.buffer), 0)
+        self.assertEqual(
+            [call[0][0] for call in mockhandler.handle.call_args_list],
+            buffer_before_flush,
+            )
+        logger.removeHandler(handler)
+
+    def test_ManualFlushMemoryHandler_capacity(self):
+        handler = ManualFlushMemoryHandler(3)
+        mockhandler = unittest.mock.Mock()
+        logger = logging.getLogger("test")
+        logger.propagate = False
+        logger.addHandler(handler)
+        for i in range(5):
+            logger.warning("line %d", i)
+        self.assertEqual(len(handler.buffer), 3)
+        handler.setTarget(mockhandler)
+        handler.flush()
+        records = [call[0][0] for call in mockhandler.handle.call_args_list]
+        self.assertEqual(
+            [record.getMessage() for record in records],
+            [
+                "2 earlier records were dropped.",
+                "line 2",
+                "line 3",
+                "line 4",
+                ],
+            )
+        logger.removeHandler(handler)
 
     def test_move_log_file(self):
         """Test the concept of moving the log file around."""
@@ -97,3 +126,51 @@ class TestConfiguration(BasicSetup):
         # Cleanup
         logger.removeHandler(h)
         h.close()
+
+    def test_queue_pipeline(self):
+        file1 = os.path.join(self.testdest, "file1")
+        file2 = os.path.join(self.testdest, "file2")
+        logger = logging.getLogger("rsync")
+        logger.propagate = False  # As set up by Configuration.
+        h = MovableFileHandler(file1)
+        attach(h)
+        try:
+            for i in range(1000):
+                logger.warning("line %d", i)
+            drain()
+            h.move_to(file2)
+            logger.warning("after the move")
+        finally:
+            detach(h)
+            h.close()
+        self.assertNotIn(handlers['queue'], logger.handlers)
+        self.assertEqual(os.listdir(self.testdest), ["file2"])
+        with open(file2) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 1001)
+        self.assertEqual(lines[0], "line 0")
+        self.assertEqual(lines[-1], "after the move")
+
+    def test_CompressedFileHandler(self):
+        for compression, opener in (("gzip", gzip.open), ("xz", lzma.open)):
+            file1 = os.path.join(self.testdest, "file1")
+            file2 = os.path.join(self.testdest, "file2")
+            logger = logging.getLogger("test")
+            logger.propagate = False
+            h = CompressedFileHandler(file1, compression)
+            logger.addHandler(h)
+            logger.warning("line 1")
+            h.move_to(file2)
+            logger.warning("line 2")
+            logger.removeHandler(h)
+            h.close()
+            # Reopened, as in a later run.
+            h = CompressedFileHandler(file2, compression)
+            logger.addHandler(h)
+            logger.warning("line 3")
+            logger.removeHandler(h)
+            h.close()
+            self.assertEqual(os.listdir(self.testdest), ["file2"])
+            with opener(file2, "rt") as f:
+                self.assertEqual(f.read(), "line 1\nline 2\nline 3\n")
+            os.unlink(file2)
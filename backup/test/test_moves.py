@@ -0,0 +1,100 @@
+#   Alexandre's backup script
+#   Copyright © 2014  Alexandre A. de Verteuil
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import configparser
+import os
+import os.path
+import shutil
+
+from .basic_setup import BasicSetup
+from ..moves import *
+
+
+class TestMoveDetector(BasicSetup):
+
+    def setUp(self):
+        super().setUp()
+        self.options = configparser.ConfigParser(
+            defaults={
+                'sourcehost': "localhost",
+                'sourcedirs': self.testsource,
+                'ssh': "/usr/bin/ssh",
+                'ssh_port': "22",
+                }
+            )['DEFAULT']
+        self.old = os.path.join(self.testdest, "old")
+        self.new = os.path.join(self.testdest, "new")
+        os.mkdir(self.new)
+        # Simulate a previous backup of the source.
+        shutil.copytree(self.testsource, self.old)
+        MoveDetector(self.options).prepare(self.old)
+
+    def test_fetch(self):
+        listing = MoveDetector(self.options).fetch()
+        self.assertEqual(len(listing), 20)
+        path, inode, size, mtime, mode, uid, gid = listing[0]
+        st = os.stat(os.path.join(self.testsource, path))
+        self.assertEqual(int(inode), st.st_ino)
+        self.assertEqual(int(size), st.st_size)
+        self.assertEqual(int(mode, 8), st.st_mode & 0o7777)
+        # Without a trailing slash, rsync creates the directory.
+        self.options['sourcedirs'] = self.testsource.rstrip("/")
+        listing = MoveDetector(self.options).fetch()
+        basename = os.path.basename(self.testsource.rstrip("/"))
+        self.assertTrue(listing[0][0].startswith(basename + "/"))
+
+    def test_remote_args(self):
+        self.options['sourcehost'] = "root@machine"
+        args = MoveDetector(self.options).args
+        self.assertEqual(
+            args[:6],
+            [
+                "/usr/bin/ssh", "-p", "22",
+                "-o", "BatchMode=yes",
+                "root@machine",
+                ],
+            )
+        self.assertTrue(args[6].startswith("find " + self.testsource))
+
+    def test_prelink_moved_files(self):
+        os.chdir(self.testsource)
+        os.mkdir("photos")
+        os.rename("testfile_01_of_20", "photos/renamed")
+        with open("testfile_02_of_20", "a") as f:
+            f.write("modified")
+        detector = MoveDetector(self.options)
+        detector.prepare(self.new, self.old)
+        self.assertEqual(detector.linked, 1)
+        self.assertEqual(
+            os.stat(os.path.join(self.new, "photos/renamed")).st_ino,
+            os.stat(os.path.join(self.old, "testfile_01_of_20")).st_ino,
+            )
+        self.assertEqual(
+            sorted(os.listdir(self.new)),
+            [MoveDetector.LISTING, "photos"],
+            )
+        self.assertEqual(len(detector.load(self.new)), 20)
+
+    def test_no_listing_in_linkdest(self):
+        os.unlink(os.path.join(self.old, MoveDetector.LISTING))
+        os.rename(
+            os.path.join(self.testsource, "testfile_01_of_20"),
+            os.path.join(self.testsource, "renamed"),
+            )
+        detector = MoveDetector(self.options)
+        detector.prepare(self.new, self.old)
+        self.assertEqual(detector.linked, 0)
@@ -0,0 +1,98 @@
+#   Alexandre's backup script
+#   Copyright © 2014  Alexandre A. de Verteuil
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import os.path
+
+from .basic_setup import BasicSetup
+from .. import prometheus
+
+
+class TestPrometheus(BasicSetup):
+
+    summaries = [
+        {
+            'host': "alpha",
+            'status': "ok",
+            'last_attempt': 1000.5,
+            'last_success': 1000.5,
+            'seconds': 60.0,
+            'bytes': 1024,
+            'files': 3,
+            'phases': {'sync': 50.0, 'purge': 10.0},
+            'snapshots': {'hourly': 24, 'daily': 31},
+            'flagged': False,
+            'purged': 1,
+            'deleted': 0,
+            },
+        {
+            'host': "beta",
+            'status': "error",
+            'last_attempt': 2000.0,
+            'last_success': None,
+            'seconds': 5.0,
+            'flagged': True,
+            },
+        ]
+
+    def test_render(self):
+        lines = prometheus.render(self.summaries).splitlines()
+        for line in [
+            'backup_last_success_timestamp_seconds{host="alpha"} 1000.5',
+            'backup_last_run_success{host="alpha"} 1',
+            'backup_last_run_success{host="beta"} 0',
+            'backup_phase_duration_seconds{host="alpha",phase="sync"} 50.0',
+            'backup_snapshots{cycle="daily",host="alpha"} 31',
+            'backup_flagged{host="beta"} 1',
+            'backup_purged_snapshots{host="alpha"} 1',
+            "# TYPE backup_transferred_bytes gauge",
+            ]:
+            self.assertIn(line, lines)
+        # Beta never succeeded.
+        self.assertFalse(
+            [line for line in lines if line.startswith(
+                'backup_last_success_timestamp_seconds{host="beta"}'
+                )]
+            )
+
+    def test_render_failed_first_run(self):
+        # The host failed before its cycles were read.
+        data = {
+            'host': "gamma",
+            'status': "error",
+            'last_attempt': 3000.0,
+            'last_success': None,
+            'seconds': 1.0,
+            'snapshot': None,
+            'phases': None,
+            'snapshots': None,
+            'flagged': None,
+            }
+        lines = prometheus.render([data]).splitlines()
+        self.assertIn('backup_last_run_success{host="gamma"} 0', lines)
+        self.assertIn('backup_flagged{host="gamma"} 0', lines)
+        self.assertFalse(
+            [line for line in lines if line.startswith("backup_snapshots{")]
+            )
+
+    def test_write(self):
+        path = os.path.join(self.testdest, "backup.prom")
+        prometheus.write(path, self.summaries)
+        prometheus.write(path, self.summaries[:1])
+        self.assertEqual(os.listdir(self.testdest), ["backup.prom"])
+        with open(path) as f:
+            self.assertNotIn('host="beta"', f.read())
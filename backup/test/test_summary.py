@@ -0,0 +1,74 @@
+#   Alexandre's backup script
+#   Copyright © 2014  Alexandre A. de Verteuil
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import os.path
+
+from .basic_setup import BasicSetup
+from .. import summary
+from ..config import Configuration
+from ..controller import Controller
+
+
+class TestSummary(BasicSetup):
+
+    def test_read_write(self):
+        self.assertIsNone(summary.read(self.testdest))
+        summary.write(self.testdest, {'host': "localhost", 'bytes': 1})
+        summary.write(self.testdest, {'host': "localhost", 'bytes': 2})
+        self.assertEqual(
+            summary.read(self.testdest),
+            {'host': "localhost", 'bytes': 2},
+            )
+        self.assertEqual(os.listdir(self.testdest), [summary.FILENAME])
+
+    def test_last_success_kept(self):
+        hostdir = os.path.join(self.testdest, "host_1_0")
+        os.mkdir(hostdir)
+        controller = Controller(
+            Configuration(
+                argv=["-c", self.configfile, "host_1_0"],
+                environ={},
+                ).configure()
+            )
+        controller.stats['host_1_0'] = {'bytes': 5, 'files': 1, 'rotated': 2}
+        controller._end_host("host_1_0", "ok", 1.0)
+        success = summary.read(hostdir)['last_success']
+        self.assertEqual(summary.read(hostdir)['rotated'], 2)
+        controller._end_host("host_1_0", "skipped", 2.0)
+        data = summary.read(hostdir)
+        self.assertEqual(data['status'], "skipped")
+        self.assertEqual(data['last_success'], success)
+        self.assertGreaterEqual(data['last_attempt'], success)
+        self.assertEqual(data['seconds'], 2.0)
+
+    def test_corrupt_summary_replaced(self):
+        hostdir = os.path.join(self.testdest, "host_1_0")
+        os.mkdir(hostdir)
+        with open(os.path.join(hostdir, summary.FILENAME), "w") as f:
+            f.write('{"host": "host_1_0", "sta')
+        self.assertIsNone(summary.read(hostdir))
+        controller = Controller(
+            Configuration(
+                argv=["-c", self.configfile, "host_1_0"],
+                environ={},
+                ).configure()
+            )
+        controller._end_host("host_1_0", "error", 1.0)
+        data = summary.read(hostdir)
+        self.assertEqual(data['status'], "error")
+        self.assertIsNone(data['last_success'])
@@ -0,0 +1,75 @@
+#   Alexandre's backup script
+#   Copyright © 2014  Alexandre A. de Verteuil
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import os.path
+
+from .basic_setup import BasicSetup
+from .. import events
+from .. import timing
+
+
+class TestSpan(BasicSetup):
+
+    def test_nested_durations(self):
+        with timing.span("host") as host:
+            with timing.span("sync") as sync:
+                with timing.span("rsync") as rsync:
+                    pass
+            for i in range(3):
+                with timing.span("delete"):
+                    pass
+        self.assertEqual(rsync.path, "host/sync/rsync")
+        self.assertIs(rsync.parent, sync)
+        self.assertIsNone(host.parent)
+        durations = host.durations()
+        self.assertEqual(
+            list(durations), ["sync", "sync/rsync", "delete"]
+            )
+        self.assertEqual(
+            durations['delete'],
+            sum(child.seconds for child in host.children[1:]),
+            )
+        self.assertGreaterEqual(durations['sync'], durations['sync/rsync'])
+        # The stack is empty again.
+        with timing.span("other") as other:
+            pass
+        self.assertIsNone(other.parent)
+
+    def test_span_exits_on_exception(self):
+        with self.assertRaises(ValueError):
+            with timing.span("host") as host:
+                with timing.span("sync"):
+                    raise ValueError()
+        self.assertEqual(list(host.durations()), ["sync"])
+
+    def test_phase_events(self):
+        path = os.path.join(self.testdest, "events.jsonl")
+        events.start(path)
+        self.addCleanup(events.stop)
+        with timing.span("host", host="localhost"):
+            with timing.span("purge"):
+                pass
+        with open(path) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(
+            [(r['event'], r['phase'], r['host']) for r in records],
+            [
+                ("phase", "host/purge", "localhost"),
+                ("phase", "host", "localhost"),
+                ],
+            )
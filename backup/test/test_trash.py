@@ -0,0 +1,85 @@
+#   Alexandre's backup script
+#   Copyright © 2014  Alexandre A. de Verteuil
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import time
+
+from .basic_setup import BasicSetup
+from ..cycle import *
+from ..deletion import TreeDeleter
+from ..filesystem import PosixFilesystem
+from ..trash import *
+
+
+class TestTrash(BasicSetup):
+
+    def setUp(self):
+        super().setUp()
+        self.hostdir = os.path.join(self.testdest, "host")
+        os.mkdir(self.hostdir)
+        for d in range(1, 5):
+            path = os.path.join(
+                self.hostdir,
+                "hourly.2014-07-{:02}T00:00".format(d),
+                )
+            os.mkdir(path)
+            os.mkdir(os.path.join(path, "dir"))
+            open(os.path.join(path, "dir", "file"), "w").close()
+        self.trash = Trash(os.path.join(self.testdest, ".trash"))
+
+    def test_purge_into_trash(self):
+        fs = PosixFilesystem(trash=self.trash)
+        c = Cycle(self.hostdir, "hourly", fs=fs)
+        c.purge(1)
+        self.assertEqual(
+            os.listdir(self.hostdir),
+            ["hourly.2014-07-04T00:00"],
+            )
+        self.assertEqual(
+            sorted(os.listdir(self.trash.path)),
+            ["host.hourly.2014-07-0{}T00:00".format(d) for d in range(1, 4)],
+            )
+        self.assertEqual(self.trash.reap(workers=2), 3 * 3)
+        self.assertEqual(os.listdir(self.trash.path), [])
+
+    def test_name_collision(self):
+        path = os.path.join(self.hostdir, "hourly.2014-07-01T00:00")
+        self.trash.put(path)
+        os.mkdir(path)
+        self.trash.put(path)
+        self.assertEqual(
+            sorted(os.listdir(self.trash.path)),
+            [
+                "host.hourly.2014-07-01T00:00",
+                "host.hourly.2014-07-01T00:00.1",
+                ],
+            )
+
+    def test_reap_locked_trash(self):
+        self.trash.put(os.path.join(self.hostdir, "hourly.2014-07-01T00:00"))
+        other = Trash(self.trash.path)
+        with other:
+            self.assertEqual(self.trash.reap(), 0)
+        self.assertEqual(len(os.listdir(self.trash.path)), 1)
+        self.assertEqual(Trash(os.path.join(self.testdest, "none")).reap(), 0)
+
+    def test_rate(self):
+        path = os.path.join(self.hostdir, "hourly.2014-07-01T00:00")
+        start = time.monotonic()
+        TreeDeleter(workers=2, rate=30).rmtree(path)
+        # 3 inodes at 30 inodes per second.
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
@@ -0,0 +1,139 @@
+#   Alexandre's backup script
+#   Copyright © 2014  Alexandre A. de Verteuil
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""This module provides the timing of the phases of a run.
+
+Classes:
+    Span
+        Times a phase of the program, nested in the enclosing one.
+
+Functions:
+    span(name, **fields)
+        Return a Span, to be used as a context manager.
+"""
+
+
+import collections
+import threading
+import time
+
+from . import _logging
+from . import events
+
+
+_local = threading.local()
+
+
+def _stack():
+    """Return the stack of the spans entered in this thread."""
+    try:
+        return _local.stack
+    except AttributeError:
+        _local.stack = []
+        return _local.stack
+
+
+class Span(_logging.Logging):
+
+    """Times a phase of the program, nested in the enclosing one.
+
+    A Span is a context manager. Entered while an other Span of the same
+    thread is, it becomes its child; its path is the names of its
+    ancestors and its own, joined by "/", such as "host/sync/rsync".
+    When it exits, its duration is logged at DEBUG level and emitted as
+    a phase event with the fields of the span and its ancestors, such as
+    the host.
+
+    The controller opens a span per host; the durations() of that span
+    go to the summary and to the metrics.
+    """
+
+    def __init__(self, name, **fields):
+        """
+        name -- The name of the phase.
+        fields -- Fields of the phase events of this span and its
+            children.
+        """
+        super().__init__()
+        self.name = name
+        self.fields = fields
+        self.parent = None
+        self.children = []
+        self.seconds = None
+        self._start = None
+
+    def __repr__(self):
+        return "{}({})".format(self.__class__.__name__, self.path)
+
+    @property
+    def path(self):
+        """The names of the ancestors of this span and its own."""
+        names = []
+        span = self
+        while span is not None:
+            names.append(span.name)
+            span = span.parent
+        return "/".join(reversed(names))
+
+    def __enter__(self):
+        stack = _stack()
+        if stack:
+            self.parent = stack[-1]
+            self.fields = dict(self.parent.fields, **self.fields)
+        stack.append(self)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds = time.perf_counter() - self._start
+        stack = _stack()
+        assert stack[-1] is self, stack
+        stack.pop()
+        if self.parent is not None:
+            self.parent.children.append(self)
+        self._logger.debug(
+            "{} took {:.3f} seconds.".format(self.path, self.seconds)
+            )
+        events.emit(
+            "phase",
+            phase=self.path,
+            seconds=round(self.seconds, 3),
+            **self.fields
+            )
+
+    def durations(self):
+        """Return the total duration of each phase below this span.
+
+        The keys are paths relative to this span, such as "sync/rsync".
+        Phases entered several times, such as the deletion of each
+        purged snapshot, are summed.
+        """
+        totals = collections.OrderedDict()
+        stack = [("", child) for child in reversed(self.children)]
+        while stack:
+            prefix, span = stack.pop()
+            path = prefix + span.name
+            totals[path] = totals.get(path, 0) + span.seconds
+            stack.extend(
+                (path + "/", child) for child in reversed(span.children)
+                )
+        return dict(totals)
+
+
+def span(name, **fields):
+    """Return a Span, to be used as a context manager."""
+    return Span(name, **fields)
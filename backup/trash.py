@@ -0,0 +1,120 @@
+#   Alexandre's backup script
+#   Copyright © 2014  Alexandre A. de Verteuil
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""This module provides the Trash class.
+
+Trash
+    Holds expired snapshots until a reaper removes them.
+"""
+
+
+import errno
+import os
+import os.path
+import shutil
+
+from . import _logging
+from .deletion import TreeDeleter
+from .locking import AlreadyLocked, Lockable
+
+
+class Trash(_logging.Logging, Lockable):
+
+    """Holds expired snapshots until a reaper removes them.
+
+    The trash is a directory, typically "<dest>/.trash", on the same
+    filesystem as the snapshots so that put() is a single rename(). The
+    actual removal happens later in reap(), which is meant to run at
+    idle I/O priority after every host has been backed up, or from
+    "backup --reap".
+
+    A reaper holds the lock on the trash. Concurrent reapers skip it.
+    """
+
+    def __init__(self, dir, **kwargs):
+        super().__init__(**kwargs)
+        self.path = dir
+        self.lockfile = os.path.join(
+            os.path.dirname(dir),
+            os.path.basename(dir)+".lock",
+            )
+
+    def __repr__(self):
+        return "{}({})".format(self.__class__.__name__, self.path)
+
+    def put(self, path):
+        """Move the directory tree at path into the trash.
+
+        The entry is named "<parent>.<basename>", i. e. "host.hourly.…",
+        with a numeric suffix in the unlikely case of a collision. If
+        the trash is on another filesystem, path is deleted right away.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        name = "{}.{}".format(
+            os.path.basename(os.path.dirname(path)),
+            os.path.basename(path),
+            )
+        target = os.path.join(self.path, name)
+        n = 1
+        while os.access(target, os.F_OK):
+            target = os.path.join(self.path, "{}.{}".format(name, n))
+            n += 1
+        try:
+            os.rename(path, target)  # Atomic operation.
+        except OSError as err:
+            if err.errno != errno.EXDEV:
+                raise
+            self._logger.warning(
+                "{} is not on the same filesystem as {}. "
+                "Deleting it now.".format(self.path, path)
+                )
+            shutil.rmtree(path)
+        else:
+            self._logger.debug("Moved {} to {}.".format(path, target))
+
+    def reap(self, workers=1, rate=0):
+        """Remove everything in the trash.
+
+        workers and rate are passed on to deletion.TreeDeleter.
+        Return the number of inodes removed.
+        """
+        if not os.access(self.path, os.F_OK):
+            return 0
+        try:
+            self.acquire(timeout=0)
+        except AlreadyLocked:
+            self._logger.info(
+                "{} is already being emptied by an other process.".format(
+                    self.path
+                    )
+                )
+            return 0
+        count = 0
+        try:
+            deleter = TreeDeleter(workers, rate)
+            for name in sorted(os.listdir(self.path)):
+                path = os.path.join(self.path, name)
+                self._logger.info("Reaping {}.".format(path))
+                if os.path.isdir(path) and not os.path.islink(path):
+                    deleter.rmtree(path)
+                    count += deleter.count
+                else:
+                    os.unlink(path)
+                    count += 1
+        finally:
+            self.release()
+        return count